@@ -46,6 +46,10 @@ app_settings = {
     "jwt": {
         "secret": "foobar",
         "algorithm": "HS256"
+    },
+    "conflict_retry": {
+        "attempts": 3,
+        "backoff": 0.05
     }
 }
 
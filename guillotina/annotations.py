@@ -1,5 +1,6 @@
 from collections import UserDict
 from guillotina import configure
+from guillotina.db.interfaces import IWriter
 from guillotina.db.orm.base import BaseObject
 from guillotina.db.reader import reader
 from guillotina.interfaces import IAnnotations
@@ -26,6 +27,9 @@ class AnnotationsAdapter(object):
         annotations = self.obj.__annotations__
         element = annotations.get(key, default)
         if element is None:
+            if getattr(self.obj, '_v_annotations_loaded', False):
+                # the object was loaded with all its annotations
+                raise KeyError(key)
             # Get from DB
             obj = await self.obj._p_jar.get_annotation(self.obj, key)
             if obj:
@@ -33,7 +37,8 @@ class AnnotationsAdapter(object):
         return annotations[key]
 
     async def async_keys(self):
-        return await self.obj._p_jar.get_annotation_keys(self.obj._p_oid)
+        return await self.obj._p_jar.get_annotation_keys(
+            self.obj._p_oid, part=self.obj._p_jar.partition(self.obj))
 
     async def async_set(self, key, value):
         if not isinstance(value, BaseObject):
@@ -43,6 +48,7 @@ class AnnotationsAdapter(object):
         annotations[key] = value
         value.__of__ = self.obj._p_oid
         value.__name__ = key
+        value._v_part = IWriter(self.obj).part
         # we register the value
         value._p_jar = self.obj._p_jar
         value._p_jar.register(value)
@@ -12,18 +12,24 @@ from guillotina.browser import ErrorResponse
 from guillotina.browser import Response
 from guillotina.component import getMultiAdapter
 from guillotina.component import queryMultiAdapter
+from guillotina.content import check_addable
 from guillotina.content import create_content_in_container
 from guillotina.event import notify
 from guillotina.events import BeforeObjectRemovedEvent
 from guillotina.events import ObjectAddedEvent
+from guillotina.events import ObjectCopiedEvent
 from guillotina.events import ObjectModifiedEvent
+from guillotina.events import ObjectMovedEvent
 from guillotina.events import ObjectPermissionsModifiedEvent
 from guillotina.events import ObjectPermissionsViewEvent
 from guillotina.events import ObjectRemovedEvent
 from guillotina.events import ObjectVisitedEvent
 from guillotina.exceptions import ConflictIdOnContainer
+from guillotina.exceptions import NoPermissionToAdd
+from guillotina.exceptions import NotAllowedContentType
 from guillotina.exceptions import PreconditionFailed
 from guillotina.interfaces import IAbsoluteURL
+from guillotina.interfaces import IContainer
 from guillotina.interfaces import IInteraction
 from guillotina.interfaces import IPrincipalPermissionManager
 from guillotina.interfaces import IPrincipalPermissionMap
@@ -32,9 +38,12 @@ from guillotina.interfaces import IPrincipalRoleMap
 from guillotina.interfaces import IResource
 from guillotina.interfaces import IResourceDeserializeFromJson
 from guillotina.interfaces import IResourceSerializeToJson
+from guillotina.interfaces import IResourceSerializeToJsonSummary
 from guillotina.interfaces import IRolePermissionManager
 from guillotina.interfaces import IRolePermissionMap
+from guillotina.interfaces import ISite
 from guillotina.json.exceptions import DeserializationError
+from guillotina.json.serialize_content import MAX_ALLOWED
 from guillotina.security.utils import settings_for_object
 from guillotina.utils import get_authenticated_user_id
 from guillotina.utils import iter_parents
@@ -187,6 +196,38 @@ class DefaultPATCH(Service):
         return Response(response={}, status=204)
 
 
+@configure.service(
+    context=IContainer, method='GET', permission='guillotina.ViewContent',
+    name='@items',
+    description='Paginated list of the items of this container')
+async def items_get(context, request):
+    """Page of the items sorted by id after the `cursor` param
+
+    The response includes the cursor of the next page, null on the last one.
+    """
+    try:
+        page_size = max(min(int(request.GET.get('page_size', 20)), MAX_ALLOWED), 1)
+    except ValueError:
+        return ErrorResponse(
+            'RequiredParam',
+            _("Param 'page_size' must be a number"))
+    cursor = request.GET.get('cursor') or None
+
+    security = IInteraction(request)
+    items = []
+    keys = []
+    async for ident, member in context.async_items(start_after=cursor, limit=page_size):
+        keys.append(ident)
+        if not ident.startswith('_') and bool(
+                security.check_permission('guillotina.AccessContent', member)):
+            items.append(await getMultiAdapter(
+                (member, request), IResourceSerializeToJsonSummary)())
+    return {
+        'items': items,
+        'cursor': keys[-1] if len(keys) == page_size else None
+    }
+
+
 @configure.service(
     context=IResource, method='GET', permission='guillotina.SeePermissions',
     name='@sharing',
@@ -332,6 +373,127 @@ class DefaultDELETE(Service):
         await notify(ObjectRemovedEvent(self.context, parent, content_id))
 
 
+async def get_container(request, path):
+    """Container at path inside the site of the request, None if there is none"""
+    container = getattr(request, 'site', None)
+    path = tuple(id_ for id_ in path.split('/') if id_)
+    if container is None:
+        return None
+    if path:
+        await container._p_jar.prefetch_path(container, path)
+    for id_ in path:
+        try:
+            container = await container.async_get(id_)
+        except (TypeError, KeyError, AttributeError):
+            return None
+        if container is None:
+            return None
+    if not IContainer.providedBy(container):
+        return None
+    return container
+
+
+class RelocateService(Service):
+    """Base of the services that put the resource, and everything below it,
+    in the `destination` container path of the site with the `new_id` id
+    (its current id by default)"""
+
+    async def check_destination(self):
+        """Set the destination and the new id of the request
+
+        Returns an ErrorResponse if they are not valid.
+        """
+        data = await self.get_data()
+        if not data.get('destination'):
+            return ErrorResponse(
+                'RequiredParam',
+                _("Property 'destination' is required"))
+        if ISite.providedBy(self.context):
+            return ErrorResponse(
+                'PreconditionFailed',
+                _('Sites can not be moved or copied'),
+                status=412)
+        self.destination = await get_container(self.request, data['destination'])
+        if self.destination is None:
+            return ErrorResponse(
+                'PreconditionFailed',
+                _('Destination {} is not a container').format(data['destination']),
+                status=412)
+        oids = [self.destination._p_oid]
+        oids.extend(parent._p_oid for parent in iter_parents(self.destination))
+        if self.context._p_oid in oids:
+            return ErrorResponse(
+                'PreconditionFailed',
+                _('Destination is inside the resource'),
+                status=412)
+        self.new_id = data.get('new_id') or self.context.id
+        try:
+            check_addable(self.destination, self.context.portal_type, self.request)
+        except NoPermissionToAdd as e:
+            return ErrorResponse(
+                'Unauthorized',
+                str(e),
+                status=401)
+        except NotAllowedContentType as e:
+            return ErrorResponse(
+                'PreconditionFailed',
+                str(e),
+                status=412)
+        if await self.destination.async_contains(self.new_id):
+            return ErrorResponse(
+                'ConflictId',
+                str(ConflictIdOnContainer(str(self.destination), self.new_id)),
+                status=409)
+
+    async def serialize(self, obj, status):
+        absolute_url = queryMultiAdapter((obj, self.request), IAbsoluteURL)
+        headers = {
+            'Access-Control-Expose-Headers': 'Location',
+            'Location': absolute_url()
+        }
+        serializer = queryMultiAdapter((obj, self.request), IResourceSerializeToJson)
+        return Response(response=await serializer(), headers=headers, status=status)
+
+
+@configure.service(
+    context=IResource, method='POST', permission='guillotina.DeleteContent',
+    name='@move',
+    description='Move resource to another container')
+class MoveService(RelocateService):
+    """Only the resource is stored again, the resources below it are not
+    loaded"""
+
+    async def __call__(self):
+        error = await self.check_destination()
+        if error is not None:
+            return error
+        old_parent = self.context.__parent__
+        old_id = self.context.id
+        self.context._p_jar.move(self.context, self.destination, self.new_id)
+        await notify(ObjectMovedEvent(
+            self.context, old_parent, old_id, self.destination, self.new_id))
+        return await self.serialize(self.context, 200)
+
+
+@configure.service(
+    context=IResource, method='POST', permission='guillotina.ViewContent',
+    name='@copy',
+    description='Copy resource to another container')
+class CopyService(RelocateService):
+    """The rows of the resource and everything below it are copied by the
+    storage without loading them"""
+
+    async def __call__(self):
+        error = await self.check_destination()
+        if error is not None:
+            return error
+        copy, descendants = await self.context._p_jar.copy(
+            self.context, self.destination, self.new_id)
+        await notify(ObjectCopiedEvent(
+            copy, self.context, self.destination, self.new_id, descendants=descendants))
+        return await self.serialize(copy, 201)
+
+
 @configure.service(
     context=IResource, method='OPTIONS', permission='guillotina.AccessPreflight',
     description='Get CORS information for resource')
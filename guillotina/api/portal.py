@@ -25,6 +25,26 @@ class DefaultGET(Service):
         return await serializer()
 
 
+@configure.service(
+    context=IDatabase, method='GET', permission='guillotina.GetPortals',
+    name='@stats',
+    title="Database statistics",
+    description="Conflicts of the write requests and use of the cache and "
+                "connection pools of the database")
+class StatsGET(Service):
+    async def __call__(self):
+        # traversal imports the services
+        from guillotina.traversal import CONFLICT_STATS
+        storage = self.request._tm._storage
+        stats = {
+            'conflicts': dict(CONFLICT_STATS),
+            'cache': storage._cache.stats()
+        }
+        if hasattr(storage, 'pool_stats'):
+            stats['pools'] = storage.pool_stats()
+        return stats
+
+
 @configure.service(
     context=IDatabase, method='POST', permission='guillotina.AddPortal',
     title="Create a new Portal",
@@ -46,3 +46,9 @@ def get_parent_uuid(ob):
     if hasattr(ob, '__parent__')\
             and ob.__parent__ is not None:
         return ob.__parent__.uuid
+
+
+# Accessors computed only from the security, the id and the parents of the
+# object, that DefaultCatalogDataAdapter.fingerprint can account for
+LOCATION_ACCESSORS = (
+    get_access_roles, get_access_users, get_path, get_depth, get_parent_uuid)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from guillotina import configure
+from guillotina.catalog import LOCATION_ACCESSORS
 from guillotina.component import queryAdapter
 from guillotina.content import iter_schemata_for_type
 from guillotina.directives import index
@@ -16,13 +17,21 @@ from guillotina.security.security_code import principal_permission_manager
 from guillotina.security.security_code import role_permission_manager
 from guillotina.security.utils import get_principals_with_access_content
 from guillotina.security.utils import get_roles_with_access_content
+from guillotina.transactions import get_transaction
 from guillotina.utils import apply_coroutine
+from guillotina.utils import get_current_request
 from zope.interface import implementer
 
+import hashlib
+import pickle
+
 
 global_principal_permission_setting = principal_permission_manager.get_setting
 global_roles_for_permission = role_permission_manager.get_roles_for_permission
 
+# portal_type -> fields the catalog data fingerprint is computed from
+FINGERPRINT_FIELDS_CACHE = {}
+
 
 @implementer(ICatalogUtility)
 class DefaultSearchUtility(object):
@@ -34,7 +43,17 @@ class DefaultSearchUtility(object):
         pass
 
     async def get_object_by_uuid(self, uuid):
-        pass
+        objects = await self.get_objects_by_uuids([uuid])
+        if objects:
+            return objects[0]
+
+    async def get_objects_by_uuids(self, uuids):
+        """
+        Objects of the current transaction for a list of uids, loaded with a
+        single query
+        """
+        txn = get_transaction(get_current_request())
+        return await txn.get_many(uuids)
 
     async def get_by_type(self, doc_type, query={}):
         pass
@@ -137,3 +156,62 @@ class DefaultCatalogDataAdapter(object):
                 values[metadata_name] = self.get_data(behavior, schema, metadata_name)
 
         return values
+
+    def fingerprint(self):
+        """Digest of what the catalog data of the content is computed from
+
+        The values of the indexed fields, the acl, the id and the serials of
+        the parents and the loaded annotations of the content. None if it can
+        not be known: an index uses an accessor that may depend on anything
+        else, or a parent or annotation is changed in the transaction.
+        """
+        ob = self.content
+        jar = ob._p_jar
+        if jar is None:
+            return None
+        values = [ob.__name__, ob.__acl__]
+        related = [annotation for _, annotation in sorted(ob.__annotations__.items())]
+        parent = ob.__parent__
+        while parent is not None:
+            related.append(parent)
+            parent = parent.__parent__
+        for related_ob in related:
+            oid = related_ob._p_oid
+            if oid is None or oid in jar.added or oid in jar.modified:
+                return None
+            values.append((oid, related_ob._p_serial))
+
+        fields = get_fingerprint_fields(ob.portal_type)
+        if fields is None:
+            return None
+        for schema, names in fields:
+            behavior = schema(ob)
+            for name in names:
+                values.append(getattr(behavior, name, None))
+        return hashlib.md5(pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)).digest()
+
+
+def get_fingerprint_fields(portal_type):
+    """(schema, names of the indexed fields) of a type, for its fingerprint
+
+    None if an index of the type uses an accessor that is not in
+    LOCATION_ACCESSORS.
+    """
+    if portal_type in FINGERPRINT_FIELDS_CACHE:
+        return FINGERPRINT_FIELDS_CACHE[portal_type]
+    fields = []
+    for schema in iter_schemata_for_type(portal_type):
+        names = []
+        for index_name, index_data in merged_tagged_value_dict(schema, index.key).items():
+            accessor = index_data.get('accessor')
+            if accessor is None:
+                names.append(index_name)
+            elif accessor not in LOCATION_ACCESSORS:
+                fields = None
+                break
+        if fields is None:
+            break
+        names.extend(merged_tagged_value_list(schema, metadata.key))
+        fields.append((schema, names))
+    FINGERPRINT_FIELDS_CACHE[portal_type] = fields
+    return fields
@@ -3,13 +3,17 @@ from guillotina import configure
 from guillotina.api.search import AsyncCatalogReindex
 from guillotina.component import queryUtility
 from guillotina.interfaces import ICatalogUtility
+from guillotina.interfaces import IContainer
 from guillotina.interfaces import IObjectAddedEvent
+from guillotina.interfaces import IObjectCopiedEvent
 from guillotina.interfaces import IObjectModifiedEvent
+from guillotina.interfaces import IObjectMovedEvent
 from guillotina.interfaces import IObjectPermissionsModifiedEvent
 from guillotina.interfaces import IObjectRemovedEvent
 from guillotina.interfaces import IResource
 from guillotina.interfaces import ISite
 from guillotina.transactions import get_transaction
+from guillotina.utils import get_content_depth
 from guillotina.utils import get_content_path
 from guillotina.utils import get_current_request
 
@@ -67,7 +71,7 @@ async def security_changed(obj, event):
 
 
 @configure.subscriber(for_=(IResource, IObjectRemovedEvent))
-def remove_object(obj, event):
+async def remove_object(obj, event):
     uid = getattr(obj, 'uuid', None)
     if uid is None:
         return
@@ -83,6 +87,13 @@ def remove_object(obj, event):
     hook.remove.append((uid, portal_type, content_path))
     if uid in hook.index:
         del hook.index[uid]
+    if IContainer.providedBy(obj) and obj._p_jar is not None:
+        # everything below goes with it, removed in the same call
+        for record in await obj._p_jar.get_descendants(obj):
+            hook.remove.append((
+                record['zoid'], record['type'],
+                '{}/{}'.format(content_path, record['path'])))
+            hook.index.pop(record['zoid'], None)
 
 
 @configure.subscriber(for_=(IResource, IObjectAddedEvent))
@@ -103,6 +114,38 @@ def add_object(obj, event):
         hook.index[uid] = search.get_data(obj)
 
 
+@configure.subscriber(for_=(IResource, IObjectMovedEvent))
+async def move_object(obj, event):
+    if IObjectAddedEvent.providedBy(event) or IObjectRemovedEvent.providedBy(event):
+        return
+    add_object(obj, event)
+    hook = get_hook()
+    if hook is None or not IContainer.providedBy(obj) or obj._p_jar is None:
+        return
+    # everything below is indexed with the catalog data it has stored and
+    # its new path, without loading it
+    content_path = get_content_path(obj)
+    depth = get_content_depth(obj)
+    for record in await obj._p_jar.get_descendants(obj, json=True):
+        if record['json'] is None:
+            continue
+        hook.index[record['zoid']] = dict(
+            record['json'],
+            path='{}/{}'.format(content_path, record['path']),
+            depth=depth + record['path'].count('/') + 1)
+
+
+@configure.subscriber(for_=(IResource, IObjectCopiedEvent))
+def copy_object(obj, event):
+    hook = get_hook()
+    if hook is None:
+        return
+    # the copy itself is indexed by add_object
+    for record in event.descendants:
+        if record['json'] is not None:
+            hook.index[record['zoid']] = record['json']
+
+
 @configure.subscriber(for_=(ISite, IObjectAddedEvent))
 async def initialize_catalog(site, event):
     search = queryUtility(ICatalogUtility)
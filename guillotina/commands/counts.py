@@ -0,0 +1,26 @@
+from guillotina.commands import Command
+from guillotina.component import getUtility
+from guillotina.interfaces import IApplication
+from guillotina.interfaces import IDatabase
+
+
+class CountsCommand(Command):
+    description = 'Count again the children of the objects of each database'
+
+    def get_parser(self):
+        parser = super(CountsCommand, self).get_parser()
+        parser.add_argument('-d', '--database', nargs='?',
+                            help='Only repair this database')
+        return parser
+
+    async def run(self, arguments, settings, app):
+        root = getUtility(IApplication, name='root')
+        for key, db in root:
+            if not IDatabase.providedBy(db) or \
+                    arguments.database not in (None, key):
+                continue
+            storage = db._db.storage
+            if not hasattr(storage, 'repair_children_counts'):
+                continue
+            fixed = await storage.repair_children_counts()
+            print('{}: {} objects fixed'.format(key, fixed))
@@ -0,0 +1,158 @@
+from guillotina.commands import Command
+from guillotina.component import getUtility
+from guillotina.interfaces import IApplication
+from guillotina.interfaces import IContainer
+from guillotina.interfaces import IDatabase
+from guillotina.utils import get_content_path
+
+import gzip
+import ujson
+
+
+# Export files are a gzip stream of a JSON header line followed by the rows
+# of the exported objects in the binary format of Postgres COPY
+EXPORT_FORMAT = 'guillotina-export'
+EXPORT_VERSION = 1
+CHUNK_SIZE = 1 << 20
+
+
+class ExportError(Exception):
+    pass
+
+
+async def export_tree(txn, obj, filename):
+    """Write obj, everything below it and their annotations to filename
+
+    Returns the number of exported rows.
+    """
+    header = {
+        'format': EXPORT_FORMAT,
+        'version': EXPORT_VERSION,
+        'oid': obj._p_oid,
+        'id': obj.id,
+        'type': getattr(obj, 'portal_type', None),
+        'path': get_content_path(obj)
+    }
+    with gzip.open(filename, 'wb') as fi:
+        fi.write(ujson.dumps(header).encode('utf-8') + b'\n')
+
+        async def write(data):
+            fi.write(data)
+
+        return await txn._manager._storage.export_tree(txn, obj._p_oid, write)
+
+
+def read_header(fi):
+    try:
+        header = ujson.loads(fi.readline().decode('utf-8'))
+    except (OSError, ValueError):
+        header = None
+    if not isinstance(header, dict) or header.get('format') != EXPORT_FORMAT:
+        raise ExportError('Not a guillotina export')
+    if header.get('version') != EXPORT_VERSION:
+        raise ExportError('Unknown export version {}'.format(header.get('version')))
+    return header
+
+
+async def import_tree(txn, filename, container, id=None):
+    """Import the export of filename to container, as id or its exported id
+
+    The objects get new oids. Returns the imported object.
+    """
+    with gzip.open(filename, 'rb') as fi:
+        header = read_header(fi)
+
+        async def chunks():
+            while True:
+                data = fi.read(CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+
+        return await txn.import_tree(header['oid'], chunks(), container, id or header['id'])
+
+
+async def traverse(root, path):
+    """Object at path below root, None if there is none"""
+    obj = root
+    for id in (id for id in path.split('/') if id):
+        try:
+            obj = await obj.async_get(id)
+        except (TypeError, KeyError, AttributeError):
+            return None
+        if obj is None:
+            return None
+    return obj
+
+
+class TreeCommand(Command):
+
+    def get_parser(self):
+        parser = super(TreeCommand, self).get_parser()
+        parser.add_argument('-d', '--database', nargs='?',
+                            help='Database of the objects, the first one by default')
+        return parser
+
+    def get_database(self, arguments):
+        root = getUtility(IApplication, name='root')
+        for key, db in root:
+            if IDatabase.providedBy(db) and arguments.database in (None, key):
+                return db
+        raise ExportError('There is no database {}'.format(arguments.database))
+
+
+class ExportCommand(TreeCommand):
+    description = 'Export an object and everything below it to a file'
+
+    def get_parser(self):
+        parser = super(ExportCommand, self).get_parser()
+        parser.add_argument('path', help='Path of the object in the database')
+        parser.add_argument('output', help='File to write')
+        return parser
+
+    async def run(self, arguments, settings, app):
+        tm = self.get_database(arguments).new_transaction_manager()
+        await tm.begin(request=self.request, read_only=True)
+        try:
+            obj = await traverse(await tm.root(), arguments.path)
+            if obj is None:
+                return print('There is no object at {}'.format(arguments.path))
+            rows = await export_tree(tm.get(), obj, arguments.output)
+            print('{} rows exported to {}'.format(rows, arguments.output))
+        finally:
+            await tm.abort()
+
+
+class ImportCommand(TreeCommand):
+    description = 'Import a file of the export command to a container'
+
+    def get_parser(self):
+        parser = super(ImportCommand, self).get_parser()
+        parser.add_argument('input', help='File to import')
+        parser.add_argument('path', help='Path of the container in the database')
+        parser.add_argument('-i', '--id', nargs='?',
+                            help='Id of the imported object, the exported one by default')
+        return parser
+
+    async def run(self, arguments, settings, app):
+        tm = self.get_database(arguments).new_transaction_manager()
+        await tm.begin(request=self.request)
+        root = await tm.root()
+        container = await traverse(root, arguments.path)
+        if container is not root and not IContainer.providedBy(container):
+            await tm.abort()
+            return print('There is no container at {}'.format(arguments.path))
+        id = arguments.id
+        if id is None:
+            with gzip.open(arguments.input, 'rb') as fi:
+                id = read_header(fi)['id']
+        if await container.async_contains(id):
+            await tm.abort()
+            return print('There is already an object {} at {}'.format(id, arguments.path))
+        try:
+            obj = await import_tree(tm.get(), arguments.input, container, id)
+        except Exception:
+            await tm.abort()
+            raise
+        await tm.commit()
+        print('Imported to {}'.format(get_content_path(obj)))
@@ -0,0 +1,44 @@
+from guillotina.commands import Command
+from guillotina.component import getUtility
+from guillotina.interfaces import IApplication
+from guillotina.interfaces import IDatabase
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+
+
+class PartitionsCommand(Command):
+    description = 'Size of the partitions of the objects of each database'
+
+    def get_parser(self):
+        parser = super(PartitionsCommand, self).get_parser()
+        parser.add_argument('-d', '--database', nargs='?',
+                            help='Only show this database')
+        return parser
+
+    async def run(self, arguments, settings, app):
+        root = getUtility(IApplication, name='root')
+        for key, db in root:
+            if not IDatabase.providedBy(db) or \
+                    arguments.database not in (None, key):
+                continue
+            storage = db._db.storage
+            if not hasattr(storage, 'get_partitions'):
+                continue
+            partitions = await storage.get_partitions()
+            if storage.partitioned:
+                summary = '{} partitions'.format(len(partitions))
+            else:
+                summary = 'not partitioned'
+            print('{}: {}, {}'.format(
+                key, summary, format_size(sum(p['size'] for p in partitions))))
+            print('{:>12} {:>24} {:>12} {:>10}'.format('part', 'name', 'rows', 'size'))
+            for partition in partitions:
+                print('{:>12} {:>24} {:>12} {:>10}'.format(
+                    '-' if partition['part'] is None else partition['part'],
+                    partition['name'], partition['rows'],
+                    format_size(partition['size'])))
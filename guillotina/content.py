@@ -166,11 +166,11 @@ async def create_content(type_, **kw):
     return obj
 
 
-async def create_content_in_container(container, type_, id_, request=None, **kw):
-    """Utility to create a content.
+def check_addable(container, type_, request=None):
+    """Check that content of type_ can be added to container
 
-    This method is the one to use to create content.
-    id_ can be None
+    Raises NoPermissionToAdd if the user does not have the add permission
+    of the type and NotAllowedContentType if the container does not allow it.
     """
     factory = get_cached_factory(type_)
 
@@ -193,6 +193,18 @@ async def create_content_in_container(container, type_, id_, request=None, **kw)
         if not constrains.is_type_allowed(type_):
             raise NotAllowedContentType(str(container), type_)
 
+
+async def create_content_in_container(container, type_, id_, request=None, **kw):
+    """Utility to create a content.
+
+    This method is the one to use to create content.
+    id_ can be None
+    """
+    factory = get_cached_factory(type_)
+    if request is None and factory.add_permission:
+        request = get_current_request()
+    check_addable(container, type_, request)
+
     # We create the object with at least the ID
     obj = factory(id=id_)
     obj.__parent__ = container
@@ -393,7 +405,8 @@ class Folder(Resource):
         """
         Asynchronously check if key exists inside this folder
         """
-        return await self._p_jar.contains(self._p_oid, key)
+        return await self._p_jar.contains(
+            self._p_oid, key, part=self._p_jar.partition(self))
 
     async def async_set(self, key: str, value: IResource) -> None:
         """
@@ -424,19 +437,27 @@ class Folder(Resource):
         """
         Asynchronously calculate the len of the folder
         """
-        return await self._p_jar.len(self._p_oid)
+        return await self._p_jar.len(self._p_oid, part=self._p_jar.partition(self))
 
-    async def async_keys(self) -> typing.List[str]:
+    async def async_keys(self, start_after: str=None, limit: int=None) -> typing.List[str]:
         """
         Asynchronously get the sub object keys in this folder
+
+        With start_after or limit, keys are sorted and only the ones after
+        start_after are returned, up to limit.
         """
-        return await self._p_jar.keys(self._p_oid)
+        return await self._p_jar.keys(
+            self._p_oid, start_after, limit, part=self._p_jar.partition(self))
 
-    async def async_items(self) -> typing.Iterator[typing.Tuple[str, IResource]]:
+    async def async_items(self, start_after: str=None,
+                          limit: int=None) -> typing.Iterator[typing.Tuple[str, IResource]]:
         """
         Asynchronously iterate through contents of folder
+
+        With start_after or limit, items are sorted by key and only the ones
+        after start_after are returned, up to limit.
         """
-        async for key, value in self._p_jar.items(self):
+        async for key, value in self._p_jar.items(self, start_after, limit):
             yield key, value
 
 
@@ -1,3 +1,5 @@
 # -*- encoding: utf-8 -*-
 
-ROOT_ID = '0' * 32
\ No newline at end of file
+ROOT_ID = '0' * 32
+# Parent of the deleted objects until they are vacuumed
+TRASHED_ID = 'D' * 32
@@ -0,0 +1,269 @@
+from collections import OrderedDict
+
+import time
+
+
+# Same meaning as BaseObject.__cache__
+NO_CACHE = -1
+NO_EXPIRATION = 0
+
+# get_child of a key that is not cached
+NOT_CACHED = object()
+
+
+def _field(record, name):
+    # records of some queries do not have every column
+    try:
+        return record[name]
+    except KeyError:
+        return None
+
+
+class ObjectCache(object):
+    """Process wide LRU cache of object records
+
+    The cache stores the raw records returned by the storage (zoid, tid,
+    state, ...) and not the objects, so every transaction builds its own
+    instance from them. It is bounded by the size of the stored states.
+
+    The policy for a record is taken from the `policies` mapping using its
+    type. If the type is not configured, the `__cache__` attribute of the
+    loaded object is used:
+
+    -1 : never cached
+    0 : cached without expiration
+    X : cached for X seconds
+
+    It also keeps the oid of the child of an object by its id, or that it
+    has no such child, for up to `max_children` keys. They are dropped when
+    the child is invalidated and when a commit adds or moves a child to the
+    object.
+    """
+
+    def __init__(self, max_size=1 << 26, policies=None, max_invalidations=10000,
+                 max_children=10000):
+        self._max_size = max_size
+        self._policies = policies or {}
+        self._max_invalidations = max_invalidations
+        self._max_children = max_children
+        # oid -> (record, size, expires)
+        self._entries = OrderedDict()
+        # oid -> last tid that invalidated the entry
+        self._invalidated = OrderedDict()
+        self._size = 0
+        # (parent oid, id) -> (oid, tid) of the child, None if there is none
+        self._children = OrderedDict()
+        # parent oid -> ids of its cached children
+        self._parents = {}
+        # oid -> (parent oid, id) of the cached children
+        self._child_keys = {}
+        # parent oid -> generation that invalidated its children
+        self._invalidated_parents = OrderedDict()
+        # generation of the oldest invalidation that was forgotten
+        self._oldest_generation = 0
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.child_hits = 0
+        self.child_misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, oid):
+        return oid in self._entries
+
+    @property
+    def size(self):
+        return self._size
+
+    def get_policy(self, type_name, default=NO_CACHE):
+        return self._policies.get(type_name, default)
+
+    def get(self, oid):
+        entry = self._entries.get(oid)
+        if entry is None:
+            self.misses += 1
+            return None
+        record, size, expires = entry
+        if expires is not None and expires < time.time():
+            self._remove(oid)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(oid)
+        self.hits += 1
+        return record
+
+    def set(self, oid, record, default=NO_CACHE):
+        """Store the record of oid if the policy of its type allows it
+
+        default is the policy of the object, used if its type is not
+        configured.
+        """
+        ttl = self.get_policy(record['type'], default)
+        if ttl is None or ttl < 0:
+            return False
+
+        invalidated = self._invalidated.get(oid)
+        if invalidated is not None and record['tid'] < invalidated:
+            # someone committed a newer version while we were loading it
+            return False
+
+        size = record['state_size'] or 0
+        if size > self._max_size:
+            return False
+
+        current = self._entries.get(oid)
+        if current is not None:
+            if current[0]['tid'] > record['tid']:
+                return False
+            self._remove(oid)
+
+        expires = time.time() + ttl if ttl > 0 else None
+        self._entries[oid] = (record, size, expires)
+        self._size += size
+        while self._size > self._max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        return True
+
+    def invalidate(self, oid, tid=None):
+        if oid in self._entries:
+            self._remove(oid)
+        if oid in self._child_keys:
+            self._remove_child(self._child_keys[oid])
+        if tid is not None:
+            self._invalidated[oid] = tid
+            self._invalidated.move_to_end(oid)
+            while len(self._invalidated) > self._max_invalidations:
+                self._invalidated.popitem(last=False)
+
+    def invalidate_below(self, oids):
+        """Drop the cached records below the deleted oids
+
+        Only the ones with every parent up to a deleted oid in the cache are
+        found, the poll of the storage drops the rest.
+        """
+        parents = {}
+        for oid, entry in self._entries.items():
+            record = entry[0]
+            parent = _field(record, 'parent_id') or _field(record, 'of')
+            if parent is None and oid in self._child_keys:
+                parent = self._child_keys[oid][0]
+            parents[oid] = parent
+        below = set(oids)
+        alive = set()
+        for oid in parents:
+            chain = []
+            while oid in parents and oid not in below and oid not in alive:
+                chain.append(oid)
+                oid = parents[oid]
+            if oid in below:
+                below.update(chain)
+            else:
+                alive.update(chain)
+        for oid in below.intersection(parents):
+            self.invalidate(oid)
+
+    def get_child(self, parent_oid, id):
+        """Oid of the child id of parent_oid
+
+        None if it is known to not exist, NOT_CACHED if it is not known.
+        """
+        key = (parent_oid, id)
+        if key not in self._children:
+            self.child_misses += 1
+            return NOT_CACHED
+        self._children.move_to_end(key)
+        self.child_hits += 1
+        entry = self._children[key]
+        return None if entry is None else entry[0]
+
+    def set_child(self, parent_oid, id, record, generation):
+        """Store the record of the child id of parent_oid, or None if there
+        is no such child
+
+        generation is the one of the cache when the transaction that found it
+        began: it is not stored if the children of parent_oid were
+        invalidated after that, or the child changed after it was loaded.
+        """
+        invalidated = self._invalidated_parents.get(parent_oid, self._oldest_generation)
+        if invalidated > generation:
+            return False
+        if record is not None:
+            invalidated = self._invalidated.get(record['zoid'])
+            if invalidated is not None and record['tid'] < invalidated:
+                return False
+        key = (parent_oid, id)
+        if key in self._children:
+            self._remove_child(key)
+        if record is None:
+            self._children[key] = None
+        else:
+            if record['zoid'] in self._child_keys:
+                self._remove_child(self._child_keys[record['zoid']])
+            self._children[key] = (record['zoid'], record['tid'])
+            self._child_keys[record['zoid']] = key
+        self._parents.setdefault(parent_oid, set()).add(id)
+        while len(self._children) > self._max_children:
+            self._remove_child(next(iter(self._children)))
+        return True
+
+    def invalidate_children(self, parent_oid):
+        """Drop the cached children of parent_oid, which got new ones"""
+        for id in list(self._parents.get(parent_oid, ())):
+            self._remove_child((parent_oid, id))
+        self.generation += 1
+        self._invalidated_parents[parent_oid] = self.generation
+        self._invalidated_parents.move_to_end(parent_oid)
+        while len(self._invalidated_parents) > self._max_invalidations:
+            self._oldest_generation = self._invalidated_parents.popitem(last=False)[1]
+
+    def clear_children(self):
+        """Drop the cached children, when the invalidations may have been
+        lost"""
+        self._children.clear()
+        self._parents.clear()
+        self._child_keys.clear()
+        self.generation += 1
+        self._invalidated_parents.clear()
+        self._oldest_generation = self.generation
+
+    def tids(self):
+        """Tid of the record of every cached oid, and of the cached children"""
+        tids = dict(entry for entry in self._children.values() if entry is not None)
+        tids.update((oid, entry[0]['tid']) for oid, entry in self._entries.items())
+        return tids
+
+    def clear(self):
+        self._entries.clear()
+        self._invalidated.clear()
+        self._size = 0
+        self.clear_children()
+
+    def _remove(self, oid):
+        self._size -= self._entries.pop(oid)[1]
+
+    def _remove_child(self, key):
+        entry = self._children.pop(key)
+        if entry is not None:
+            del self._child_keys[entry[0]]
+        ids = self._parents[key[0]]
+        ids.discard(key[1])
+        if not ids:
+            del self._parents[key[0]]
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self._size,
+            'max_size': self._max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'children': len(self._children),
+            'child_hits': self.child_hits,
+            'child_misses': self.child_misses
+        }
@@ -0,0 +1,270 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from guillotina.component import ComponentLookupError
+from guillotina.db.compression import decompress
+from guillotina.db.compression import is_compressed
+from guillotina.db.interfaces import IStateCodec
+from guillotina.db.orm.base import BaseObject
+from guillotina.interfaces import IResource
+from guillotina.interfaces.security import Allow
+from guillotina.interfaces.security import AllowSingle
+from guillotina.interfaces.security import Deny
+from guillotina.interfaces.security import PermissionSetting
+from guillotina.interfaces.security import Unset
+from guillotina.security.securitymap import SecurityMap
+from guillotina.utils import get_class_dotted_name
+from guillotina.utils import resolve_dotted_name
+from zope.interface import implementer
+from zope.interface.declarations import Provides
+from zope.interface.declarations import ProvidesClass
+
+import pickle
+import zlib
+
+
+# first byte of the stored state -> codec
+CODECS = {}
+# name of the codec -> codec
+CODEC_NAMES = {}
+
+
+class StateCodecError(Exception):
+    pass
+
+
+def register_codec(codec):
+    CODECS[codec.tag] = codec
+    CODEC_NAMES[codec.name] = codec
+    return codec
+
+
+def get_codec(name):
+    try:
+        return CODEC_NAMES[name]
+    except KeyError:
+        raise StateCodecError('Unknown state codec {}'.format(name))
+
+
+def decode(state):
+    """Load the object of a stored state with the codec that wrote it"""
+    if is_compressed(state):
+        state = decompress(state)
+    try:
+        codec = CODECS[state[0]]
+    except KeyError:
+        raise StateCodecError('Unknown state codec tag {}'.format(state[0]))
+    return codec.decode(state)
+
+
+@implementer(IStateCodec)
+class PickleCodec(object):
+    """Plain pickle of the object
+
+    Pickle protocol 2 and higher states start with the PROTO opcode, which
+    is used as the tag so the states written before codecs existed are
+    still readable.
+    """
+
+    name = 'pickle'
+    tag = 0x80
+
+    def encode(self, obj):
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, state):
+        return pickle.loads(state)
+
+    def layouts(self):
+        return {}
+
+
+# Attributes every resource has, stored before the fields of its schema
+BASE_LAYOUT = (
+    '__name__', 'portal_type', 'created', 'modified', '__provides__',
+    '__acl__', '__behaviors__', 'title')
+
+# Marker of a field of the layout that the object does not have
+MISSING = Ellipsis
+
+# Pickle protocol of the compact states, fixed so every Python 3 reads them
+PROTOCOL = 4
+
+PERMISSION_SETTINGS = {
+    setting.get_name(): setting for setting in (Allow, AllowSingle, Deny, Unset)}
+
+
+def _is_acl(value):
+    for security_map in value.values():
+        if type(security_map) is not SecurityMap or \
+                security_map.__dict__.keys() != {'_byrow', '_bycol'}:
+            return False
+        for cells in security_map._byrow.values():
+            for setting in cells.values():
+                if type(setting) is not PermissionSetting:
+                    return False
+    return True
+
+
+@implementer(IStateCodec)
+class CompactCodec(object):
+    """Schema aware codec
+
+    The state is a pickle of (class, type, layout fingerprint, values,
+    special values, extra attributes). The values of the fields of the
+    layout of the type are stored by position, without their names, and
+    datetimes, interfaces, acls and inline objects as special values. States
+    with a layout that is not known any more can be read after registering
+    it with `register_layout`.
+    """
+
+    name = 'compact'
+    tag = 0x01
+
+    def __init__(self):
+        # type name -> (layout, fingerprint)
+        self._layouts = {}
+        # fingerprint -> layout
+        self._fingerprints = {}
+        self._classes = {}
+        self._timezones = {}
+
+    def register_layout(self, names):
+        layout = tuple(names)
+        fingerprint = zlib.crc32('\n'.join(layout).encode('utf-8'))
+        self._fingerprints[fingerprint] = layout
+        return layout, fingerprint
+
+    def layouts(self):
+        """Layout of every known fingerprint"""
+        return self._fingerprints
+
+    def get_layout(self, type_name):
+        """Layout and fingerprint of the current schema of the type"""
+        try:
+            return self._layouts[type_name]
+        except KeyError:
+            pass
+        names = []
+        if type_name is not None:
+            from guillotina.content import get_cached_factory
+            from guillotina.schema import getFieldNamesInOrder
+            names.extend(BASE_LAYOUT)
+            try:
+                schema = get_cached_factory(type_name).schema
+            except ComponentLookupError:
+                schema = None
+            if schema is not None:
+                for name in getFieldNamesInOrder(schema):
+                    if name not in names:
+                        names.append(name)
+        result = self._layouts[type_name] = self.register_layout(names)
+        return result
+
+    def encode(self, obj):
+        state = obj.__getstate__()
+        if not isinstance(state, dict):
+            # objects with slots keep the pickle format
+            return CODEC_NAMES['pickle'].encode(obj)
+        type_name = obj.portal_type if IResource.providedBy(obj) else None
+        layout, fingerprint = self.get_layout(type_name)
+        state = state.copy()
+        values = []
+        special = {}
+        for idx, name in enumerate(layout):
+            value = state.pop(name, MISSING)
+            if value is not MISSING:
+                value = self._pack(idx, value, special)
+            values.append(value)
+        for name, value in tuple(state.items()):
+            state[name] = self._pack(name, value, special)
+        return bytes((self.tag,)) + pickle.dumps((
+            get_class_dotted_name(obj), type_name, fingerprint,
+            values, special, state), protocol=PROTOCOL)
+
+    def _pack(self, key, value, special):
+        kind = type(value)
+        if kind is dict and value and _is_acl(value):
+            special[key] = ('a', {
+                name: {
+                    row: {col: setting.get_name() for col, setting in cells.items()}
+                    for row, cells in security_map._byrow.items()}
+                for name, security_map in value.items()})
+        elif kind is datetime:
+            offset = value.utcoffset()
+            special[key] = ('d', (
+                value.year, value.month, value.day, value.hour, value.minute,
+                value.second, value.microsecond,
+                None if offset is None else offset.days * 86400 + offset.seconds))
+        elif kind is ProvidesClass:
+            special[key] = ('i', tuple(
+                get_class_dotted_name(spec) for spec in value.__reduce__()[1]))
+        elif isinstance(value, BaseObject):
+            special[key] = ('o', self.encode(value))
+        else:
+            return value
+        return None
+
+    def decode(self, state):
+        klass, type_name, fingerprint, values, special, extra = pickle.loads(
+            memoryview(state)[1:])
+        layout = self._fingerprints.get(fingerprint)
+        if layout is None:
+            layout, current = self.get_layout(type_name)
+            if current != fingerprint:
+                raise StateCodecError(
+                    'Unknown layout {} for {}'.format(fingerprint, type_name))
+        for name, value in zip(layout, values):
+            if value is not MISSING:
+                extra[name] = value
+        for key, value in special.items():
+            if type(key) is int:
+                key = layout[key]
+            extra[key] = self._unpack(value)
+        try:
+            klass = self._classes[klass]
+        except KeyError:
+            klass = self._classes[klass] = resolve_dotted_name(klass)
+        obj = klass.__new__(klass)
+        if klass.__setstate__ is BaseObject.__setstate__:
+            # the state has no slots, skip looking them up on every load
+            obj.__dict__.update(extra)
+        else:
+            obj.__setstate__(extra)
+        return obj
+
+    def _unpack(self, value):
+        kind, data = value
+        if kind == 'd':
+            offset = data[7]
+            if offset is None:
+                return datetime(*data[:7])
+            try:
+                tz = self._timezones[offset]
+            except KeyError:
+                tz = self._timezones[offset] = timezone(timedelta(seconds=offset))
+            return datetime(*data[:7], tzinfo=tz)
+        elif kind == 'i':
+            specs = []
+            for name in data:
+                try:
+                    spec = self._classes[name]
+                except KeyError:
+                    spec = self._classes[name] = resolve_dotted_name(name)
+                specs.append(spec)
+            return Provides(*specs)
+        elif kind == 'a':
+            acl = {}
+            for name, rows in data.items():
+                security_map = acl[name] = SecurityMap()
+                for row, cells in rows.items():
+                    for col, setting in cells.items():
+                        setting = PERMISSION_SETTINGS[setting]
+                        security_map._byrow.setdefault(row, {})[col] = setting
+                        security_map._bycol.setdefault(col, {})[row] = setting
+            return acl
+        return decode(data)
+
+
+register_codec(PickleCodec())
+register_codec(CompactCodec())
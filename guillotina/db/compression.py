@@ -0,0 +1,101 @@
+import asyncio
+import struct
+import time
+import zlib
+
+
+# first byte of compressed states, followed by the size of the state and
+# its zlib stream
+COMPRESSED_TAG = 0x02
+HEADER = struct.Struct('>BI')
+
+
+def compress(state, level=6):
+    return HEADER.pack(COMPRESSED_TAG, len(state)) + zlib.compress(state, level)
+
+
+def decompress(state):
+    return zlib.decompress(memoryview(state)[HEADER.size:], bufsize=raw_size(state))
+
+
+def raw_size(state):
+    return HEADER.unpack_from(state)[1]
+
+
+def is_compressed(state):
+    return state is not None and len(state) > 0 and state[0] == COMPRESSED_TAG
+
+
+class Compressor(object):
+    """Compression of the states stored by a storage
+
+    States of `threshold` bytes or more are compressed with zlib at `level`,
+    and kept raw if that does not make them smaller. A threshold of None
+    disables compression; compressed states are always read.
+
+    States of `executor_size` bytes or more are (de)compressed in the default
+    executor to not block the loop.
+    """
+
+    def __init__(self, threshold=None, level=6, executor_size=1 << 18):
+        self._threshold = threshold
+        self._level = level
+        self._executor_size = executor_size
+
+        self.compressed = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.compress_time = 0.0
+        self.decompressed = 0
+        self.decompress_time = 0.0
+
+    async def _run(self, func, state, size):
+        if size >= self._executor_size:
+            return await asyncio.get_event_loop().run_in_executor(None, func, state)
+        return func(state)
+
+    def _compress(self, state):
+        start = time.perf_counter()
+        result = compress(state, self._level)
+        return result, time.perf_counter() - start
+
+    def _decompress(self, state):
+        start = time.perf_counter()
+        result = decompress(state)
+        return result, time.perf_counter() - start
+
+    async def compress(self, state):
+        if self._threshold is None or state is None or len(state) < self._threshold:
+            return state
+        result, elapsed = await self._run(self._compress, state, len(state))
+        self.compress_time += elapsed
+        if len(result) >= len(state):
+            self.skipped += 1
+            return state
+        self.compressed += 1
+        self.raw_bytes += len(state)
+        self.stored_bytes += len(result)
+        return result
+
+    async def decompress(self, state):
+        if not is_compressed(state):
+            return state
+        result, elapsed = await self._run(self._decompress, state, raw_size(state))
+        self.decompressed += 1
+        self.decompress_time += elapsed
+        return result
+
+    def stats(self):
+        return {
+            'threshold': self._threshold,
+            'level': self._level,
+            'compressed': self.compressed,
+            'skipped': self.skipped,
+            'raw_bytes': self.raw_bytes,
+            'stored_bytes': self.stored_bytes,
+            'ratio': self.stored_bytes / self.raw_bytes if self.raw_bytes else None,
+            'compress_time': self.compress_time,
+            'decompressed': self.decompressed,
+            'decompress_time': self.decompress_time
+        }
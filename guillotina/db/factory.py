@@ -1,21 +1,59 @@
 from guillotina import configure
+from guillotina.db.cache import ObjectCache
+from guillotina.db.compression import Compressor
 from guillotina.db.db import GuillotinaDB
-from guillotina.db.dummy import DummyStorage
+from guillotina.db.memory import MemoryStorage
 from guillotina.db.storage import APgStorage
 from guillotina.factory.content import Database
 from guillotina.interfaces import IDatabaseConfigurationFactory
 from guillotina.utils import resolve_dotted_name
 
 
+def _make_cache(config):
+    return ObjectCache(
+        max_size=config.get('cache_size', 1 << 26),
+        policies=config.get('cache_policies', {}),
+        max_children=config.get('child_cache_size', 10000))
+
+
+def _make_compressor(config):
+    return Compressor(
+        threshold=config.get('compression_threshold'),
+        level=config.get('compression_level', 6),
+        executor_size=config.get('compression_executor_size', 1 << 18))
+
+
 @configure.utility(provides=IDatabaseConfigurationFactory, name="postgresql")
 async def DatabaseConfigurationFactory(key, dbconfig, app):
     config = dbconfig.get('configuration', {})
     dsn = "{scheme}://{user}:{password}@{host}:{port}/{dbname}".format(**dbconfig['dsn'])  # noqa
+    replica_dsns = [
+        "{scheme}://{user}:{password}@{host}:{port}/{dbname}".format(**replica)  # noqa
+        for replica in dbconfig.get('replicas', [])]
     partition_object = None
     if 'partition' in dbconfig:
         partition_object = resolve_dotted_name(dbconfig['partition'])
     pool_size = config.get('pool_size', 100)
-    aps = APgStorage(dsn=dsn, partition=partition_object, name=key, pool_size=pool_size)
+    aps = APgStorage(dsn=dsn, partition=partition_object, name=key, pool_size=pool_size,
+                     cache=_make_cache(config),
+                     commit_strategy=config.get('commit_strategy', 'temp_table'),
+                     replica_dsns=replica_dsns,
+                     invalidation_channel=config.get(
+                         'invalidation_channel', 'guillotina_invalidations'),
+                     poll_interval=config.get('invalidation_poll_interval', 5),
+                     codec=config.get('state_codec', 'pickle'),
+                     type_codecs=config.get('type_state_codecs'),
+                     compressor=_make_compressor(config),
+                     store_json=config.get('catalog_json', True),
+                     partitioning=config.get('partitioning', False),
+                     eager_annotations=config.get('eager_annotations', False),
+                     children_count=config.get('children_count', 'counter'),
+                     approximate_threshold=config.get('approximate_threshold', 10000),
+                     pool_min_size=config.get('pool_min_size'),
+                     pool_max_size=config.get('pool_max_size'),
+                     pool_long_hold=config.get('pool_long_hold', 1.0),
+                     pool_resize_interval=config.get('pool_resize_interval', 10),
+                     vacuum_batch_size=config.get('vacuum_batch_size', 1000))
     if app is not None:
         await aps.initialize(loop=app.loop)
     else:
@@ -27,11 +65,26 @@ async def DatabaseConfigurationFactory(key, dbconfig, app):
     return Database(key, db)
 
 
-@configure.utility(provides=IDatabaseConfigurationFactory, name="DUMMY")
-async def DummyDatabaseConfigurationFactory(key, dbconfig, app):
-    dss = DummyStorage()
+@configure.utility(provides=IDatabaseConfigurationFactory, name="memory")
+async def MemoryDatabaseConfigurationFactory(key, dbconfig, app):
+    config = dbconfig.get('configuration', {})
+    storage = MemoryStorage(cache=_make_cache(config),
+                            codec=config.get('state_codec', 'pickle'),
+                            type_codecs=config.get('type_state_codecs'),
+                            compressor=_make_compressor(config),
+                            latency=config.get('latency', 0),
+                            eager_annotations=config.get('eager_annotations', False))
+    if app is not None:
+        await storage.initialize(loop=app.loop)
+    else:
+        await storage.initialize()
     dbc = {}
     dbc['database_name'] = key
-    db = GuillotinaDB(dss, **dbc)
+    db = GuillotinaDB(storage, **dbc)
     await db.initialize()
     return Database(key, db)
+
+
+@configure.utility(provides=IDatabaseConfigurationFactory, name="DUMMY")
+async def DummyDatabaseConfigurationFactory(key, dbconfig, app):
+    return await MemoryDatabaseConfigurationFactory(key, dbconfig, app)
@@ -12,3 +12,7 @@ class IWriter(Interface):
 
 class IContainer(IContainer):
     pass
+
+
+class IStateCodec(Interface):
+    """Encodes the state of objects for DB storage and loads them back"""
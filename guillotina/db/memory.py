@@ -0,0 +1,422 @@
+from collections import Counter
+from guillotina.db.storage import BaseStorage
+
+import asyncio
+import uuid
+
+
+class MemoryTransaction(object):
+    """State of a transaction of a MemoryStorage, kept on txn._db_txn"""
+
+    def __init__(self, snapshot):
+        # number of the last commit the transaction sees
+        self.snapshot = snapshot
+        # oid -> record written by the transaction
+        self.stored = {}
+        self.deleted = set()
+        self.locked = False
+        self.ended = False
+
+
+class MemoryStorage(BaseStorage):
+    """Storage that keeps the objects in memory
+
+    Every committed version of an object is kept with the number of the
+    commit that wrote it, and transactions only see the versions committed
+    before they began. On vote a transaction conflicts if one of the objects
+    it stores or deletes was committed by someone else after the version it
+    is based on; votes and finishes of different transactions do not
+    interleave. Versions that no open transaction can see are dropped on
+    commit.
+
+    Records have the same columns as the ones of APgStorage. Every operation
+    that would be a round trip to a database server waits `latency` seconds.
+    """
+
+    def __init__(self, read_only=False, cache=None, codec='pickle', type_codecs=None,
+                 compressor=None, latency=0, eager_annotations=False):
+        super(MemoryStorage, self).__init__(
+            read_only, cache=cache, codec=codec, type_codecs=type_codecs,
+            compressor=compressor)
+        self._latency = latency
+        self.eager_annotations = eager_annotations
+        self._lock = None
+        self._reset()
+
+    def _reset(self):
+        self._tid = 1
+        # number of the last commit
+        self._seq = 0
+        # oid -> [(commit, record or None if deleted)], oldest first
+        self._versions = {}
+        # oids with versions that may be dropped
+        self._history = set()
+        # (kind, parent) -> {oid: True} of the objects that had that parent
+        # in any version, kind is 'parent' for children and 'of' for
+        # annotations
+        self._members = {}
+        # (kind, parent, id) -> {oid: True}
+        self._named = {}
+        # snapshot -> open transactions that read from it
+        self._snapshots = Counter()
+
+    async def finalize(self):
+        pass
+
+    async def initialize(self, loop=None):
+        self._lock = asyncio.Lock(loop=loop)
+
+    async def remove(self):
+        """Reset the tables"""
+        self._reset()
+
+    async def open(self, read_only=False, min_lsn=None):
+        return self
+
+    async def close(self, con):
+        pass
+
+    async def _delay(self):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+
+    def _get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    # Versions
+
+    def _snapshot(self, txn):
+        db_txn = getattr(txn, '_db_txn', None)
+        if isinstance(db_txn, MemoryTransaction):
+            return db_txn.snapshot
+        return self._seq
+
+    def _visible(self, oid, snapshot):
+        for seq, record in reversed(self._versions.get(oid, ())):
+            if seq <= snapshot:
+                return record
+        return None
+
+    def _latest(self, oid):
+        versions = self._versions.get(oid)
+        if not versions:
+            return None, None
+        return versions[-1]
+
+    @staticmethod
+    def _key(record):
+        if record['of'] is None:
+            return ('parent', record['parent_id'], record['id'])
+        return ('of', record['of'], record['id'])
+
+    def _index(self, oid, record):
+        key = self._key(record)
+        self._members.setdefault(key[:2], {})[oid] = True
+        self._named.setdefault(key, {})[oid] = True
+
+    def _unindex(self, oid, key):
+        for index, index_key in ((self._members, key[:2]), (self._named, key)):
+            oids = index.get(index_key)
+            if oids is not None:
+                oids.pop(oid, None)
+                if not oids:
+                    del index[index_key]
+
+    def _find(self, snapshot, kind, parent, id):
+        for oid in self._named.get((kind, parent, id), ()):
+            record = self._visible(oid, snapshot)
+            if record is not None and self._key(record) == (kind, parent, id):
+                return record
+        return None
+
+    def _children(self, snapshot, kind, parent):
+        records = []
+        for oid in self._members.get((kind, parent), ()):
+            record = self._visible(oid, snapshot)
+            if record is not None and self._key(record)[:2] == (kind, parent):
+                records.append(record)
+        return records
+
+    def _prune(self):
+        """Drop the versions that no open transaction can see"""
+        oldest = min(self._snapshots) if self._snapshots else self._seq
+        for oid in tuple(self._history):
+            versions = self._versions[oid]
+            idx = len(versions) - 1
+            while idx > 0 and versions[idx][0] > oldest:
+                idx -= 1
+            kept = versions[idx:]
+            removed = versions[:len(versions) - len(kept)]
+            if len(kept) == 1 and kept[0][1] is None:
+                removed = versions
+                kept = []
+            keys = {self._key(record) for seq, record in kept if record is not None}
+            for seq, record in removed:
+                if record is not None and self._key(record) not in keys:
+                    self._unindex(oid, self._key(record))
+            if kept:
+                self._versions[oid] = kept
+            else:
+                del self._versions[oid]
+            if len(kept) < 2:
+                self._history.discard(oid)
+
+    # Transactions
+
+    async def last_transaction(self, txn):
+        return self._tid
+
+    async def next_tid(self, txn):
+        self._tid += 1
+        return self._tid
+
+    async def tpc_begin(self, txn, conn):
+        txn._db_conn = conn
+        txn._db_txn = MemoryTransaction(self._seq)
+        self._snapshots[self._seq] += 1
+
+    def _end(self, db_txn):
+        if db_txn is None or db_txn.ended:
+            return
+        db_txn.ended = True
+        self._snapshots[db_txn.snapshot] -= 1
+        if db_txn.locked:
+            db_txn.locked = False
+            self._get_lock().release()
+        if self._snapshots[db_txn.snapshot] <= 0:
+            del self._snapshots[db_txn.snapshot]
+            self._prune()
+
+    async def precommit(self, txn):
+        tid = await self.next_tid(txn)
+        if tid is not None:
+            txn._tid = tid
+
+    async def store(self, oid, old_serial, writer, obj, txn):
+        assert oid is not None
+        p = writer.serialize(self.get_codec(writer.type))  # This calls __getstate__ of obj
+        p = await self._compressor.compress(p)
+        part = writer.part
+        if part is None:
+            part = 0
+        txn._db_txn.stored[oid] = {
+            'zoid': oid,
+            'tid': txn._tid,
+            'state_size': len(p),
+            'part': part,
+            'resource': writer.resource,
+            'of': writer.of,
+            'otid': old_serial,
+            'parent_id': writer.parent_id,
+            'id': writer.id,
+            'type': writer.type,
+            'json': await writer.get_json(),
+            'state': p
+        }
+        obj._p_estimated_size = len(p)
+        return txn._tid, len(p)
+
+    async def delete(self, txn, oid):
+        txn._db_txn.deleted.add(oid)
+
+    def _conflicts(self, db_txn):
+        for oid, record in db_txn.stored.items():
+            seq, current = self._latest(oid)
+            if record['otid'] is None:
+                if current is not None:
+                    return True
+            elif seq is not None and seq > db_txn.snapshot and (
+                    current is None or current['tid'] != record['otid']):
+                return True
+        for oid in db_txn.deleted:
+            seq, current = self._latest(oid)
+            if seq is not None and seq > db_txn.snapshot:
+                return True
+        return False
+
+    async def tpc_vote(self, transaction):
+        await self._delay()
+        db_txn = transaction._db_txn
+        await self._get_lock().acquire()
+        db_txn.locked = True
+        if self._conflicts(db_txn):
+            db_txn.locked = False
+            self._get_lock().release()
+            return False
+        return True
+
+    async def tpc_finish(self, transaction):
+        await self._delay()
+        db_txn = transaction._db_txn
+        self._seq += 1
+        seq = self._seq
+        for oid, record in db_txn.stored.items():
+            self._add_version(oid, seq, record)
+
+        # children and annotations of the deleted objects go with them
+        pending = [(oid, None) for oid in db_txn.deleted]
+        while pending:
+            oid, parent = pending.pop()
+            record = self._latest(oid)[1]
+            if record is None or (parent is not None and self._key(record)[:2] != parent):
+                continue
+            self._add_version(oid, seq, None)
+            for kind in ('parent', 'of'):
+                pending.extend(
+                    (child, (kind, oid)) for child in self._members.get((kind, oid), ()))
+
+        self._end(db_txn)
+        return transaction._tid
+
+    def _add_version(self, oid, seq, record):
+        versions = self._versions.setdefault(oid, [])
+        versions.append((seq, record))
+        if record is not None:
+            self._index(oid, record)
+        if len(versions) > 1 or record is None:
+            self._history.add(oid)
+
+    async def abort(self, transaction):
+        self._end(transaction._db_txn)
+
+    # Introspection
+
+    async def load(self, txn, oid):
+        await self._delay()
+        db_txn = getattr(txn, '_db_txn', None)
+        if isinstance(db_txn, MemoryTransaction) and oid in db_txn.stored:
+            # copies are written before the commit
+            return db_txn.stored[oid]
+        record = self._visible(oid, self._snapshot(txn))
+        if record is None:
+            raise KeyError(oid)
+        return record
+
+    async def load_annotated(self, txn, oid):
+        """Records of oid and its annotations"""
+        record = await self.load(txn, oid)
+        return [record] + self._children(self._snapshot(txn), 'of', oid)
+
+    async def load_many(self, txn, oids):
+        await self._delay()
+        snapshot = self._snapshot(txn)
+        records = [self._visible(oid, snapshot) for oid in oids]
+        return [record for record in records if record is not None]
+
+    async def keys(self, txn, oid, start_after=None, limit=None, part=None):
+        return [record async for record in self.items(txn, oid, start_after, limit)]
+
+    async def get_child(self, txn, parent_id, id, part=None):
+        await self._delay()
+        record = self._find(self._snapshot(txn), 'parent', parent_id, id)
+        if record is None:
+            raise KeyError(id)
+        return record
+
+    async def get_child_annotated(self, txn, parent_id, id, part=None):
+        """Records of the child and its annotations, the child is the one without of"""
+        record = await self.get_child(txn, parent_id, id)
+        return [record] + self._children(self._snapshot(txn), 'of', record['zoid'])
+
+    async def get_path(self, txn, parent_id, path, part=None):
+        await self._delay()
+        snapshot = self._snapshot(txn)
+        records = []
+        for id in path:
+            record = self._find(snapshot, 'parent', parent_id, id)
+            if record is None:
+                break
+            records.append(record)
+            parent_id = record['zoid']
+        return records
+
+    async def get_path_annotated(self, txn, parent_id, path, part=None):
+        """Records of the path ordered by depth followed by their annotations"""
+        records = await self.get_path(txn, parent_id, path)
+        snapshot = self._snapshot(txn)
+        for record in tuple(records):
+            records.extend(self._children(snapshot, 'of', record['zoid']))
+        return records
+
+    async def has_key(self, txn, parent_id, id, part=None):
+        await self._delay()
+        return self._find(self._snapshot(txn), 'parent', parent_id, id) is not None
+
+    async def len(self, txn, oid, part=None):
+        await self._delay()
+        return len(self._children(self._snapshot(txn), 'parent', oid))
+
+    async def items(self, txn, oid, start_after=None, limit=None, part=None):
+        await self._delay()
+        records = self._children(self._snapshot(txn), 'parent', oid)
+        if start_after is not None or limit is not None:
+            records = sorted(records, key=lambda record: record['id'])
+            if start_after is not None:
+                records = [r for r in records if r['id'] > start_after]
+            records = records[:limit]
+        for record in records:
+            yield record
+
+    async def get_descendants(self, txn, oid, json=False):
+        """Records of the resources below oid, with their path relative to it
+
+        With json they include their catalog data.
+        """
+        await self._delay()
+        snapshot = self._snapshot(txn)
+        records = []
+        pending = [(oid, None)]
+        while pending:
+            parent, path = pending.pop()
+            for record in self._children(snapshot, 'parent', parent):
+                child_path = record['id'] if path is None else path + '/' + record['id']
+                descendant = {
+                    'zoid': record['zoid'], 'type': record['type'], 'path': child_path}
+                if json:
+                    descendant['json'] = record['json']
+                records.append(descendant)
+                pending.append((record['zoid'], child_path))
+        return records
+
+    async def copy(self, txn, oid, new_oid, parent_id, id, path, depth):
+        """Copy oid with the resources below it and their annotations
+
+        The copies are kept on the transaction, see APgStorage.copy.
+        """
+        await self._delay()
+        snapshot = self._snapshot(txn)
+        stored = txn._db_txn.stored
+        tid = await self.next_tid(txn)
+        record = self._visible(oid, snapshot)
+        if record is None:
+            raise KeyError(oid)
+        copied = []
+        pending = [(record, new_oid, parent_id, id, path, depth)]
+        while pending:
+            record, zoid, parent, id, path, depth = pending.pop()
+            json = record['json']
+            if json is not None:
+                json = dict(json, uuid=zoid, parent_uuid=parent, path=path, depth=depth)
+            stored[zoid] = dict(
+                record, zoid=zoid, tid=tid, otid=None, parent_id=parent, id=id, json=json)
+            if zoid != new_oid:
+                copied.append({'zoid': zoid, 'type': record['type'], 'json': json})
+            for annotation in self._children(snapshot, 'of', record['zoid']):
+                annotation_oid = uuid.uuid4().hex
+                stored[annotation_oid] = dict(
+                    annotation, zoid=annotation_oid, tid=tid, otid=None, of=zoid)
+            for child in self._children(snapshot, 'parent', record['zoid']):
+                pending.append((
+                    child, uuid.uuid4().hex, zoid, child['id'],
+                    path + '/' + child['id'], depth + 1))
+        return copied
+
+    async def get_annotation(self, txn, oid, id, part=None):
+        await self._delay()
+        return self._find(self._snapshot(txn), 'of', oid, id)
+
+    async def get_annotation_keys(self, txn, oid, part=None):
+        await self._delay()
+        return self._children(self._snapshot(txn), 'of', oid)
@@ -2,17 +2,38 @@ from guillotina import configure
 from guillotina.db.interfaces import IPartition
 from guillotina.interfaces import IResource
 
+import zlib
+
 
 @configure.adapter(
     for_=IResource,
     provides=IPartition)
 class PartitionDataAdapter(object):
+    """Partition of a resource
+
+    Every child of the root starts a partition, the value of its
+    `parent_datasource` attribute or a number computed from its oid, and all
+    the resources below it are stored in the same partition.
+
+    Resources loaded without their parents up to the root, like the ones
+    loaded by oid, keep the partition they were loaded from.
+    """
 
     def __init__(self, content):
         self.content = content
 
     def __call__(self):
-        if hasattr(self.content, 'parent_datasource'):
-            return self.content.parent_datasource
-        else:
+        content = self.content
+        parent = content.__parent__
+        # parents without a transaction are the copies kept in the state
+        if parent is None or parent._p_jar is None:
+            return getattr(self.content, '_v_part', None)
+        while parent.__parent__ is not None:
+            content, parent = parent, parent.__parent__
+            if parent._p_jar is None:
+                return getattr(self.content, '_v_part', None)
+        if hasattr(content, 'parent_datasource'):
+            return content.parent_datasource
+        if content._p_oid is None:
             return None
+        return zlib.crc32(content._p_oid.encode('utf-8'))
@@ -0,0 +1,253 @@
+from collections import deque
+from collections import OrderedDict
+from guillotina.exceptions import RequestNotFound
+from guillotina.utils import get_current_request
+
+import asyncio
+import logging
+import time
+
+
+log = logging.getLogger('guillotina')
+
+
+def get_request_path():
+    """Method and path of the request being served, if there is one"""
+    try:
+        request = get_current_request()
+    except RequestNotFound:
+        return None
+    path = getattr(request, 'path', None)
+    if path is None:
+        return None
+    return '{} {}'.format(getattr(request, 'method', ''), path)
+
+
+class PoolAcquireContext(object):
+    """Result of `acquire`, awaited or used with `async with`"""
+
+    __slots__ = ('pool', 'connection')
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.connection = None
+
+    def __await__(self):
+        return self.pool._acquire().__await__()
+
+    async def __aenter__(self):
+        self.connection = await self.pool._acquire()
+        return self.connection
+
+    async def __aexit__(self, *exc):
+        connection, self.connection = self.connection, None
+        await self.pool.release(connection)
+
+
+class InstrumentedPool(object):
+    """Pool of connections that measures how it is used
+
+    Wraps an asyncpg pool, which must be able to open `max_size`
+    connections, and lets `size` of them be used at the same time. It keeps
+    the time spent waiting for a connection, the time they are held and
+    how many are in use. Connections held `long_hold` seconds or more are
+    logged and counted by the path of the request that held them.
+
+    If `min_size` and `max_size` are different, `resize` adapts `size` to the
+    use of the pool since its last call: it grows if connections had to be
+    waited for and shrinks if less than half of them were used. Idle
+    connections are closed by asyncpg after `max_inactive_connection_lifetime`.
+    """
+
+    def __init__(self, pool, size, min_size=None, max_size=None, long_hold=1.0,
+                 max_paths=100, name=None, loop=None):
+        self._pool = pool
+        self.min_size = min_size or size
+        self.max_size = max(max_size or size, size)
+        self.size = size
+        self.long_hold = long_hold
+        self._max_paths = max_paths
+        self.__name__ = name
+        self._loop = loop
+        self._in_use = 0
+        # futures of the acquires waiting for a free slot
+        self._waiters = deque()
+        # connection -> time it was acquired
+        self._acquired = {}
+        # request path -> [long holds, total time, max time]
+        self._long_holds = OrderedDict()
+        self._resizer = None
+
+        self.acquires = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.holds = 0
+        self.hold_time = 0.0
+        self.max_hold = 0.0
+        self.max_in_use = 0
+        self.resizes = 0
+        # use since the last resize
+        self._window_waits = 0
+        self._window_in_use = 0
+
+    @property
+    def adaptive(self):
+        return self.min_size != self.max_size
+
+    @property
+    def in_use(self):
+        return len(self._acquired)
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def acquire(self):
+        return PoolAcquireContext(self)
+
+    async def _acquire(self):
+        start = time.monotonic()
+        if self._in_use < self.size and not self._waiters:
+            self._in_use += 1
+        else:
+            if self._loop is None:
+                self._loop = asyncio.get_event_loop()
+            waiter = self._loop.create_future()
+            self._waiters.append(waiter)
+            self.waits += 1
+            self._window_waits += 1
+            try:
+                # the slot is taken by _wake before the waiter is done
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._free()
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        try:
+            conn = await self._pool.acquire()
+        except BaseException:
+            self._free()
+            raise
+        now = time.monotonic()
+        self._acquired[conn] = now
+        wait = now - start
+        self.acquires += 1
+        self.wait_time += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+        in_use = len(self._acquired)
+        if in_use > self.max_in_use:
+            self.max_in_use = in_use
+        if in_use > self._window_in_use:
+            self._window_in_use = in_use
+        return conn
+
+    async def release(self, conn):
+        acquired = self._acquired.pop(conn, None)
+        try:
+            await self._pool.release(conn)
+        finally:
+            if acquired is not None:
+                self._free()
+        if acquired is not None:
+            self._record_hold(time.monotonic() - acquired)
+
+    def _free(self):
+        self._in_use -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._in_use < self.size:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_use += 1
+                waiter.set_result(None)
+
+    def _record_hold(self, hold):
+        self.holds += 1
+        self.hold_time += hold
+        if hold > self.max_hold:
+            self.max_hold = hold
+        if hold < self.long_hold:
+            return
+        path = get_request_path()
+        entry = self._long_holds.pop(path, None)
+        if entry is None:
+            entry = [0, 0.0, 0.0]
+            if len(self._long_holds) >= self._max_paths:
+                self._long_holds.popitem(last=False)
+        entry[0] += 1
+        entry[1] += hold
+        entry[2] = max(entry[2], hold)
+        self._long_holds[path] = entry
+        log.warning('Connection of %s held for %.3fs by %s', self.__name__, hold, path)
+
+    def resize(self):
+        """Adapt the size to the use of the pool since the last call"""
+        size = self.size
+        step = max(1, size // 4)
+        if self._window_waits:
+            size = min(self.max_size, size + max(step, self._window_waits))
+        elif self._window_in_use < size // 2:
+            size = max(self.min_size, self._window_in_use * 2, size - step)
+        self._window_waits = 0
+        self._window_in_use = len(self._acquired)
+        if size != self.size:
+            log.info('Resizing pool of %s from %d to %d connections',
+                     self.__name__, self.size, size)
+            self.size = size
+            self.resizes += 1
+            self._wake()
+        return size
+
+    async def resize_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval, loop=self._loop)
+            self.resize()
+
+    def start(self, interval=10):
+        """Start resizing the pool every interval seconds, if it is adaptive"""
+        if self.adaptive and self._resizer is None:
+            self._resizer = asyncio.ensure_future(
+                self.resize_periodically(interval), loop=self._loop)
+
+    async def close(self):
+        if self._resizer is not None:
+            self._resizer.cancel()
+            self._resizer = None
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.cancel()
+        self._waiters.clear()
+        await self._pool.close()
+
+    def long_holds(self):
+        """Long holds by request path, the longest in total first"""
+        return sorted((
+            {'path': path, 'count': count, 'time': total, 'max': longest}
+            for path, (count, total, longest) in self._long_holds.items()),
+            key=lambda entry: entry['time'], reverse=True)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'in_use': self.in_use,
+            'waiting': self.waiting,
+            'max_in_use': self.max_in_use,
+            'acquires': self.acquires,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'max_wait': self.max_wait,
+            'avg_wait': self.wait_time / self.acquires if self.acquires else None,
+            'holds': self.holds,
+            'hold_time': self.hold_time,
+            'max_hold': self.max_hold,
+            'avg_hold': self.hold_time / self.holds if self.holds else None,
+            'long_holds': self.long_holds(),
+            'resizes': self.resizes
+        }
@@ -1,9 +1,12 @@
-import pickle
+from guillotina.db.codecs import decode
 
 
 def reader(result):
-    obj = pickle.loads(result['state'])
+    obj = decode(result['state'])
     obj._p_oid = result['zoid']
     obj._p_serial = result['tid']
     obj.__name__ = result['id']
+    if 'part' in result:
+        # partition it was stored in, see PartitionDataAdapter
+        obj._v_part = result['part']
     return obj
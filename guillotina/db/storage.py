@@ -1,7 +1,20 @@
+from collections import Counter
+from collections import OrderedDict
+from guillotina.db import TRASHED_ID
+from guillotina.db.cache import ObjectCache
+from guillotina.db.codecs import get_codec
+from guillotina.db.compression import Compressor
+from guillotina.db.compression import is_compressed
+from guillotina.db.pool import InstrumentedPool
+from guillotina.exceptions import ConflictError
+
 import asyncio
 import asyncpg
+import itertools
 import logging
+import re
 import ujson
+import uuid
 
 
 class ReadOnlyError(Exception):
@@ -15,18 +28,61 @@ GET_LAST_TID = """
     WHERE tid > $1::int
     """
 
-GET_OID = """
-    SELECT zoid, tid, state_size, resource, of, parent_id, id, type, state
-    FROM objects
-    WHERE zoid = $1::varchar(32)
+# Ancestors of the objects of a query, and of the annotations through their
+# object, to skip the ones below a deleted object until VACUUM_TRASH removes
+# them
+ANCESTORS = """
+    WITH RECURSIVE ancestors AS (
+        SELECT zoid, COALESCE(parent_id, of) AS parent_id
+        FROM objects
+        WHERE {where}
+        UNION ALL
+        SELECT ancestors.zoid, COALESCE(ob.parent_id, ob.of)
+        FROM objects ob JOIN ancestors ON ob.zoid = ancestors.parent_id
+    )
     """
 
+NOT_TRASHED = """
+    NOT EXISTS (
+        SELECT 1 FROM ancestors
+        WHERE ancestors.zoid = objects.zoid AND ancestors.parent_id = '{trash}')
+    """.format(trash=TRASHED_ID)
+
+GET_OID = ANCESTORS.format(where='zoid = $1::varchar(32)') + """
+    SELECT zoid, tid, state_size, part, resource, of, parent_id, id, type, state
+    FROM objects
+    WHERE zoid = $1::varchar(32) AND {not_trashed}
+    """.format(not_trashed=NOT_TRASHED)
+
+GET_OIDS = ANCESTORS.format(where='zoid = ANY($1::varchar(32)[])') + """
+    SELECT zoid, tid, state_size, part, resource, of, parent_id, id, type, state
+    FROM objects
+    WHERE zoid = ANY($1::varchar(32)[]) AND {not_trashed}
+    """.format(not_trashed=NOT_TRASHED)
+
 GET_SONS_KEYS = """
     SELECT id
     FROM objects
     WHERE parent_id = $1::varchar(32)
     """
 
+# Keyset pagination of children on the (parent_id, id) index
+GET_SONS_KEYS_PAGE = """
+    SELECT id
+    FROM objects
+    WHERE parent_id = $1::varchar(32)
+    ORDER BY id
+    LIMIT $2::int
+    """
+
+GET_SONS_KEYS_AFTER = """
+    SELECT id
+    FROM objects
+    WHERE parent_id = $1::varchar(32) AND id > $2::text
+    ORDER BY id
+    LIMIT $3::int
+    """
+
 GET_ANNOTATIONS_KEYS = """
     SELECT id
     FROM objects
@@ -39,6 +95,70 @@ GET_CHILD = """
     WHERE parent_id = $1::varchar(32) AND id = $2::text
     """
 
+# Children of each segment of the path $2 below $1, ordered by depth
+GET_PATH = """
+    WITH RECURSIVE path AS (
+        SELECT zoid, tid, state_size, resource, type, state, id, parent_id,
+               1 AS depth
+        FROM objects
+        WHERE parent_id = $1::varchar(32) AND id = ($2::text[])[1]
+        UNION ALL
+        SELECT ob.zoid, ob.tid, ob.state_size, ob.resource, ob.type, ob.state,
+               ob.id, ob.parent_id, path.depth + 1
+        FROM objects ob JOIN path ON ob.parent_id = path.zoid
+        WHERE ob.id = ($2::text[])[path.depth + 1]
+    )
+    SELECT zoid, tid, state_size, resource, type, state, id, parent_id
+    FROM path
+    ORDER BY depth
+    """
+
+# The objects of the next queries are returned with all their annotations,
+# which are the rows with `of` set
+
+GET_OID_ANNOTATED = ANCESTORS.format(where='zoid = $1::varchar(32)') + """
+    SELECT zoid, tid, state_size, part, resource, of, parent_id, id, type, state
+    FROM objects
+    WHERE (zoid = $1::varchar(32) AND {not_trashed})
+    OR of = $1::varchar(32)
+    """.format(not_trashed=NOT_TRASHED)
+
+GET_CHILD_ANNOTATED = """
+    WITH child AS (
+        SELECT zoid, tid, state_size, resource, type, state, id, of
+        FROM objects
+        WHERE parent_id = $1::varchar(32) AND id = $2::text
+    )
+    SELECT * FROM child
+    UNION ALL
+    SELECT ob.zoid, ob.tid, ob.state_size, ob.resource, ob.type, ob.state, ob.id, ob.of
+    FROM objects ob, child
+    WHERE ob.of = child.zoid
+    """
+
+GET_PATH_ANNOTATED = """
+    WITH RECURSIVE path AS (
+        SELECT zoid, tid, state_size, resource, type, state, id, parent_id,
+               1 AS depth
+        FROM objects
+        WHERE parent_id = $1::varchar(32) AND id = ($2::text[])[1]
+        UNION ALL
+        SELECT ob.zoid, ob.tid, ob.state_size, ob.resource, ob.type, ob.state,
+               ob.id, ob.parent_id, path.depth + 1
+        FROM objects ob JOIN path ON ob.parent_id = path.zoid
+        WHERE ob.id = ($2::text[])[path.depth + 1]
+    )
+    SELECT zoid, tid, state_size, resource, type, state, id, parent_id,
+           NULL AS of, depth
+    FROM path
+    UNION ALL
+    SELECT ob.zoid, ob.tid, ob.state_size, ob.resource, ob.type, ob.state,
+           ob.id, ob.parent_id, ob.of, NULL
+    FROM objects ob, path
+    WHERE ob.of = path.zoid
+    ORDER BY depth
+    """
+
 EXIST_CHILD = """
     SELECT zoid
     FROM objects
@@ -51,10 +171,41 @@ GET_ANNOTATION = """
     WHERE of = $1::varchar(32) AND id = $2::text
     """
 
+GET_TIDS = ANCESTORS.format(where='zoid = ANY($1::varchar(32)[])') + """
+    SELECT zoid, tid
+    FROM objects
+    WHERE zoid = ANY($1::varchar(32)[]) AND {not_trashed}
+    """.format(not_trashed=NOT_TRASHED)
+
+# Publishes each payload of $2 on the $1 channel when the transaction commits
+NOTIFY = """
+    SELECT pg_notify($1::text, payload) FROM unnest($2::text[]) AS payload
+    """
+
+# Notification payloads are limited to 8000 bytes, each one has up to
+# NOTIFY_OIDS changed oids and as many oids of objects with new children
+NOTIFY_OIDS = 100
+
+# Cached oids checked against the database on every poll
+CHECK_OIDS = 1000
+
 MAX_TID = """
     SELECT max(tid) FROM objects
     """
 
+# Position of the WAL after a commit on the primary, and whether a replica
+# already replayed a position. Tids are taken before the commits, so unlike
+# the WAL they do not follow the order in which they become visible.
+# The functions were renamed in Postgres 10, see lsn_query.
+CURRENT_LSN = """
+    SELECT pg_current_{wal}_{lsn}()::text
+    """
+
+REPLAYED_LSN = """
+    SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_{wal}_replay_{lsn}()
+                ELSE pg_current_{wal}_{lsn}() END >= $1::text::pg_lsn
+    """
+
 MOVE_FROM_TEMP = """
     WITH moved_rows AS (
         DELETE FROM current_objects
@@ -63,7 +214,7 @@ MOVE_FROM_TEMP = """
         RETURNING *
     )
     INSERT INTO objects
-    SELECT * FROM moved_rows
+    SELECT * FROM moved_rows ORDER BY zoid
     ON CONFLICT (zoid) DO UPDATE SET
         tid = EXCLUDED.tid,
         state_size = EXCLUDED.state_size,
@@ -74,31 +225,164 @@ MOVE_FROM_TEMP = """
         parent_id = EXCLUDED.parent_id,
         id = EXCLUDED.id,
         type = EXCLUDED.type,
-        json = EXCLUDED.json,
+        json = COALESCE(EXCLUDED.json, objects.json),
         state = EXCLUDED.state;
     """
 
-INSERT_TEMP = """
-    INSERT INTO current_objects
-    (zoid, tid, state_size, part, resource, of, otid, parent_id, id, type, json, state)
-    VALUES ($1::varchar(32), $2::int, $3::int, $4::int, $5::boolean, $6::varchar(32), $7::int,
-    $8::varchar(32), $9::text, $10::text, $11::json, $12::bytea)
-    """
+# Columns of current_objects written with COPY on vote
+STORE_COLUMNS = (
+    'zoid', 'tid', 'state_size', 'part', 'resource', 'of', 'otid',
+    'parent_id', 'id', 'type', 'json', 'state', 'children')
 
 NEXT_TID = "SELECT nextval('tid_seq');"
 
+# Tables of the temp_table commit strategy, created once on every connection
+# of the primary: they are kept with the connection and emptied by each
+# commit
+CREATE_TEMP_TABLES = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS current_objects (
+        zoid        VARCHAR(32) NOT NULL PRIMARY KEY,
+        tid         BIGINT NOT NULL,
+        state_size  BIGINT NOT NULL,
+        part        BIGINT NOT NULL,
+        resource    BOOLEAN NOT NULL,
+        of          VARCHAR(32),
+        otid        BIGINT,
+        parent_id   VARCHAR(32),
+        id          TEXT,
+        type        TEXT NOT NULL,
+        json        JSONB,
+        state       BYTEA,
+        children    BIGINT
+    )  ON COMMIT DELETE ROWS;
+    CREATE INDEX IF NOT EXISTS current_object_tid ON current_objects (tid);
+    CREATE TEMPORARY TABLE IF NOT EXISTS delete_objects (
+        zoid        VARCHAR(32) NOT NULL PRIMARY KEY,
+        tid         BIGINT NOT NULL
+    ) ON COMMIT DELETE ROWS;
+    """
+
+# Objects of the commit stored after another commit read them
+GET_CONFLICTS = """
+    SELECT ob.zoid, ob.tid FROM objects ob JOIN current_objects co
+    USING (zoid) WHERE ob.tid > co.otid AND co.tid = $1::bigint
+    """
+
 NUM_CHILDS = "SELECT count(*) FROM objects WHERE parent_id = $1::varchar(32)"
 
+GET_CHILDREN_COUNT = "SELECT children FROM objects WHERE zoid = $1::varchar(32)"
+
+ESTIMATE_CHILDS = """
+    EXPLAIN (FORMAT JSON) SELECT 1 FROM objects WHERE parent_id = $1::varchar(32)
+    """
+
+# Count of children of the parents of the stored and deleted objects of a
+# commit, before they are written. The count of the new objects is set when
+# they are inserted, since all their children are in the same commit.
+# Parents are locked in order, like the rows stored after them, so
+# concurrent commits do not deadlock.
+COUNT_CHILDREN = """
+    WITH deltas AS (
+        SELECT co.parent_id, 1 AS delta
+        FROM current_objects co LEFT JOIN objects ob USING (zoid)
+        WHERE co.tid = $1::int AND co.parent_id IS NOT NULL
+        AND co.parent_id IS DISTINCT FROM ob.parent_id
+        UNION ALL
+        SELECT ob.parent_id, -1
+        FROM current_objects co JOIN objects ob USING (zoid)
+        WHERE co.tid = $1::int AND ob.parent_id IS NOT NULL
+        AND ob.parent_id IS DISTINCT FROM co.parent_id
+        UNION ALL
+        SELECT ob.parent_id, -1
+        FROM delete_objects d JOIN objects ob USING (zoid)
+        WHERE d.tid = $1::int AND ob.parent_id IS NOT NULL
+    ),
+    counts AS (
+        SELECT parent_id, sum(delta) AS delta FROM deltas GROUP BY parent_id
+    ),
+    locked AS (
+        SELECT ob.zoid, counts.delta
+        FROM objects ob JOIN counts ON ob.zoid = counts.parent_id
+        WHERE counts.delta <> 0
+        ORDER BY ob.zoid
+        FOR UPDATE OF ob
+    )
+    UPDATE objects SET children = objects.children + locked.delta
+    FROM locked
+    WHERE objects.zoid = locked.zoid
+    """
+
+# Same as COUNT_CHILDREN for the arrays of stored oids and parents and the
+# deleted oids of the unnest commit strategy
+COUNT_CHILDREN_UNNEST = """
+    WITH rows AS (
+        SELECT * FROM unnest($1::varchar(32)[], $2::varchar(32)[])
+        AS t (zoid, parent_id)
+    ),
+    deltas AS (
+        SELECT rows.parent_id, 1 AS delta
+        FROM rows LEFT JOIN objects ob USING (zoid)
+        WHERE rows.parent_id IS NOT NULL
+        AND rows.parent_id IS DISTINCT FROM ob.parent_id
+        UNION ALL
+        SELECT ob.parent_id, -1
+        FROM rows JOIN objects ob USING (zoid)
+        WHERE ob.parent_id IS NOT NULL
+        AND ob.parent_id IS DISTINCT FROM rows.parent_id
+        UNION ALL
+        SELECT ob.parent_id, -1
+        FROM objects ob
+        WHERE ob.zoid = ANY($3::varchar(32)[]) AND ob.parent_id IS NOT NULL
+    ),
+    counts AS (
+        SELECT parent_id, sum(delta) AS delta FROM deltas GROUP BY parent_id
+    ),
+    locked AS (
+        SELECT ob.zoid, counts.delta
+        FROM objects ob JOIN counts ON ob.zoid = counts.parent_id
+        WHERE counts.delta <> 0
+        ORDER BY ob.zoid
+        FOR UPDATE OF ob
+    )
+    UPDATE objects SET children = objects.children + locked.delta
+    FROM locked
+    WHERE objects.zoid = locked.zoid
+    """
+
+REPAIR_CHILDREN = """
+    UPDATE objects ob SET children = counts.children
+    FROM (
+        SELECT parent.zoid, count(child.zoid) AS children
+        FROM objects parent LEFT JOIN objects child ON child.parent_id = parent.zoid
+        GROUP BY parent.zoid
+    ) counts
+    WHERE ob.zoid = counts.zoid AND ob.children IS DISTINCT FROM counts.children
+    """
+
 GET_CHILDS = """
     SELECT zoid, tid, state_size, resource, type, state, id
     FROM objects
     WHERE parent_id = $1::VARCHAR(32)
     """
 
-DELETE_TMP = '''
-    INSERT INTO delete_objects (zoid, tid) VALUES ($1::varchar(32), $2::int)
-'''
+GET_CHILDS_PAGE = """
+    SELECT zoid, tid, state_size, resource, type, state, id
+    FROM objects
+    WHERE parent_id = $1::VARCHAR(32)
+    ORDER BY id
+    LIMIT $2::int
+    """
 
+GET_CHILDS_AFTER = """
+    SELECT zoid, tid, state_size, resource, type, state, id
+    FROM objects
+    WHERE parent_id = $1::VARCHAR(32) AND id > $2::text
+    ORDER BY id
+    LIMIT $3::int
+    """
+
+# Deleted objects are moved to the trash in the commit, without their
+# children and annotations, and removed with them by VACUUM_TRASH later
 DELETE_FROM_OBJECTS = """
     WITH deleted_rows AS (
         DELETE FROM delete_objects
@@ -106,24 +390,508 @@ DELETE_FROM_OBJECTS = """
             "tid" = $1::int
         RETURNING *
     )
-    DELETE FROM objects WHERE zoid = (SELECT zoid FROM deleted_rows);
+    UPDATE objects SET parent_id = '{trash}', of = NULL, tid = deleted_rows.tid
+    FROM deleted_rows
+    WHERE objects.zoid = deleted_rows.zoid;
+    """.format(trash=TRASHED_ID)
+
+# Field names of the layouts of the compact states, see CompactCodec
+CREATE_LAYOUTS = """
+    CREATE TABLE IF NOT EXISTS state_layouts (
+        fingerprint BIGINT NOT NULL PRIMARY KEY,
+        names       TEXT[] NOT NULL
+    )
+    """
+
+GET_LAYOUTS = """
+    SELECT fingerprint, names FROM state_layouts
+    """
+
+STORE_LAYOUT = """
+    INSERT INTO state_layouts (fingerprint, names) VALUES ($1, $2::text[])
+    ON CONFLICT DO NOTHING
+    """
+
+CREATE_TRASH = """
+    INSERT INTO objects (zoid, tid, state_size, part, resource, type)
+    SELECT '{trash}', 0, 0, 0, FALSE, 'TRASH_REF'
+    WHERE NOT EXISTS (SELECT 1 FROM objects WHERE zoid = '{trash}')
+    """.format(trash=TRASHED_ID)
+
+# The trashed objects and their descendants, leaves first so deleting them in
+# this order the foreign key never cascades to more rows
+TRASH_TREE = """
+    WITH RECURSIVE tree AS (
+        SELECT zoid, 1 AS depth FROM objects WHERE parent_id = '{trash}'
+        UNION ALL
+        SELECT ob.zoid, tree.depth + 1
+        FROM objects ob JOIN tree ON ob.parent_id = tree.zoid
+    )
+    SELECT zoid FROM tree ORDER BY depth DESC
+    """.format(trash=TRASHED_ID)
+
+# A batch of the rows of TRASH_TREE with their annotations
+VACUUM_TRASH = """
+    WITH annotations AS (
+        DELETE FROM objects WHERE of = ANY($1::varchar(32)[])
+        RETURNING zoid
+    ),
+    leaves AS (
+        DELETE FROM objects WHERE zoid = ANY($1::varchar(32)[])
+        RETURNING zoid
+    )
+    SELECT zoid FROM annotations UNION ALL SELECT zoid FROM leaves
+    """
+
+# Resources below an object with their path relative to it
+GET_DESCENDANTS = """
+    WITH RECURSIVE tree AS (
+        SELECT zoid, type, id AS path
+        FROM objects
+        WHERE parent_id = $1::varchar(32)
+        UNION ALL
+        SELECT ob.zoid, ob.type, tree.path || '/' || ob.id
+        FROM objects ob JOIN tree ON ob.parent_id = tree.zoid
+    )
+    SELECT zoid, type, path FROM tree
+    """
+
+GET_DESCENDANTS_JSON = """
+    WITH RECURSIVE tree AS (
+        SELECT zoid, type, id AS path, json
+        FROM objects
+        WHERE parent_id = $1::varchar(32)
+        UNION ALL
+        SELECT ob.zoid, ob.type, tree.path || '/' || ob.id, ob.json
+        FROM objects ob JOIN tree ON ob.parent_id = tree.zoid
+    )
+    SELECT zoid, type, path, json FROM tree
+    """
+
+# Copy of an object of the {source} table with the resources below it and
+# their annotations to objects, in a single statement. The root of the copy
+# gets the oid, parent and id of the parameters and the rest random oids.
+# The catalog data of the copied resources gets their new uuid, parent, path
+# and depth, and the count of children of the new parent is increased if it
+# is kept. The rows keep their partition unless $9 is given.
+COPY_TREE_FROM = """
+    WITH RECURSIVE tree AS (
+        SELECT zoid, $2::text AS new_zoid, $3::text AS new_parent,
+               $4::text AS id, $5::text AS path, $6::int AS depth
+        FROM {source}
+        WHERE zoid = $1::varchar(32)
+        UNION ALL
+        SELECT ob.zoid, md5(random()::text || clock_timestamp()::text || ob.zoid),
+               tree.new_zoid, ob.id, tree.path || '/' || ob.id, tree.depth + 1
+        FROM {source} ob JOIN tree ON ob.parent_id = tree.zoid
+    ),
+    resources AS (
+        INSERT INTO objects (zoid, tid, state_size, part, resource, of, otid,
+                             parent_id, id, type, json, state, children)
+        SELECT tree.new_zoid, $7::bigint, ob.state_size, COALESCE($9::bigint, ob.part),
+               ob.resource, NULL, NULL, tree.new_parent, tree.id, ob.type,
+               ob.json || jsonb_build_object(
+                   'uuid', tree.new_zoid, 'parent_uuid', tree.new_parent,
+                   'path', tree.path, 'depth', tree.depth),
+               ob.state, ob.children
+        FROM tree JOIN {source} ob ON ob.zoid = tree.zoid
+        RETURNING zoid, type, json
+    ),
+    annotations AS (
+        INSERT INTO objects (zoid, tid, state_size, part, resource, of, otid,
+                             parent_id, id, type, json, state, children)
+        SELECT md5(random()::text || clock_timestamp()::text || ob.zoid), $7::bigint,
+               ob.state_size, COALESCE($9::bigint, ob.part), ob.resource,
+               tree.new_zoid, NULL, NULL, ob.id, ob.type, ob.json, ob.state, ob.children
+        FROM tree JOIN {source} ob ON ob.of = tree.zoid
+        RETURNING zoid
+    ),
+    counted AS (
+        UPDATE objects SET children = children + 1
+        WHERE zoid = $3::varchar(32) AND $8::boolean AND children IS NOT NULL
+        RETURNING zoid
+    )
+    {result}
+    """
+
+# The copied resources below the root
+COPY_TREE = COPY_TREE_FROM.format(
+    source='objects',
+    result='SELECT zoid, type, json FROM resources WHERE zoid <> $2::varchar(32)')
+
+# Rows of an export, that are copied to the import_objects temporary table
+# first. Only the number of imported rows is returned.
+IMPORT_TREE = COPY_TREE_FROM.format(
+    source='import_objects',
+    result='SELECT (SELECT count(*) FROM resources) + (SELECT count(*) FROM annotations)')
+
+CREATE_IMPORT = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS import_objects (
+        zoid        VARCHAR(32) NOT NULL PRIMARY KEY,
+        tid         BIGINT NOT NULL,
+        state_size  BIGINT NOT NULL,
+        part        BIGINT NOT NULL,
+        resource    BOOLEAN NOT NULL,
+        of          VARCHAR(32),
+        otid        BIGINT,
+        parent_id   VARCHAR(32),
+        id          TEXT,
+        type        TEXT NOT NULL,
+        json        JSONB,
+        state       BYTEA,
+        children    BIGINT
+    ) ON COMMIT DELETE ROWS;
+    CREATE INDEX IF NOT EXISTS import_object_parent ON import_objects (parent_id);
+    CREATE INDEX IF NOT EXISTS import_object_of ON import_objects (of);
+    """
+
+# Rows of an object, the objects below it and their annotations, with the
+# columns of STORE_COLUMNS
+EXPORT_TREE = """
+    WITH RECURSIVE tree AS (
+        SELECT zoid FROM objects WHERE zoid = $1::varchar(32)
+        UNION ALL
+        SELECT ob.zoid FROM objects ob JOIN tree ON ob.parent_id = tree.zoid
+    )
+    SELECT ob.zoid, ob.tid, ob.state_size, ob.part, ob.resource, ob.of, ob.otid,
+           ob.parent_id, ob.id, ob.type, ob.json, ob.state, ob.children
+    FROM tree JOIN objects ob ON ob.zoid = tree.zoid
+    UNION ALL
+    SELECT ob.zoid, ob.tid, ob.state_size, ob.part, ob.resource, ob.of, ob.otid,
+           ob.parent_id, ob.id, ob.type, ob.json, ob.state, ob.children
+    FROM tree JOIN objects ob ON ob.of = tree.zoid
+    """
+
+# Partition of the objects below an object and of its annotations, to
+# follow it when it is moved or copied to another partition
+SET_PART = """
+    WITH RECURSIVE tree AS (
+        SELECT zoid FROM objects WHERE parent_id = $1::varchar(32)
+        UNION ALL
+        SELECT ob.zoid FROM objects ob JOIN tree ON ob.parent_id = tree.zoid
+    ),
+    moved AS (
+        SELECT zoid FROM tree
+        UNION ALL
+        SELECT ob.zoid FROM objects ob JOIN tree ON ob.of = tree.zoid
+        UNION ALL
+        SELECT zoid FROM objects WHERE of = $1::varchar(32)
+    )
+    UPDATE objects SET part = $2::bigint
+    FROM moved
+    WHERE objects.zoid = moved.zoid AND objects.part <> $2::bigint
+    """
+
+# Conflict check, upsert and delete of a whole commit in one statement.
+# Nothing is written if any of the stored objects has a newer tid and the
+# conflicting oids are returned.
+STORE_UNNEST = """
+    WITH rows AS (
+        SELECT * FROM unnest(
+            $1::varchar(32)[], $2::bigint[], $3::bigint[], $4::bigint[],
+            $5::boolean[], $6::varchar(32)[], $7::bigint[], $8::varchar(32)[],
+            $9::text[], $10::text[], $11::jsonb[], $12::bytea[], $14::bigint[])
+        AS t (zoid, tid, state_size, part, resource, of, otid, parent_id, id,
+              type, json, state, children)
+    ),
+    conflicts AS (
+        SELECT ob.zoid FROM objects ob JOIN rows USING (zoid)
+        WHERE ob.tid > rows.otid
+    ),
+    stored AS (
+        INSERT INTO objects
+        SELECT * FROM rows
+        WHERE NOT EXISTS (SELECT 1 FROM conflicts)
+        ORDER BY zoid
+        ON CONFLICT (zoid) DO UPDATE SET
+            tid = EXCLUDED.tid,
+            state_size = EXCLUDED.state_size,
+            part = EXCLUDED.part,
+            resource = EXCLUDED.resource,
+            of = EXCLUDED.of,
+            otid = EXCLUDED.otid,
+            parent_id = EXCLUDED.parent_id,
+            id = EXCLUDED.id,
+            type = EXCLUDED.type,
+            json = COALESCE(EXCLUDED.json, objects.json),
+            state = EXCLUDED.state
+        RETURNING zoid
+    ),
+    deleted AS (
+        UPDATE objects SET parent_id = '{trash}', of = NULL, tid = $15::bigint
+        WHERE zoid = ANY($13::varchar(32)[])
+        AND NOT EXISTS (SELECT 1 FROM conflicts)
+        RETURNING zoid
+    )
+    SELECT zoid FROM conflicts
+    """.format(trash=TRASHED_ID)
+
+# Versions of the statements for a table partitioned on part.
+#
+# The primary key has to include the partition key, so the rows of an object
+# that changed of partition are deleted from its previous one. There is no
+# parent_id foreign key, the children of the deleted objects are found by
+# VACUUM_TRASH like the ones of the table without partitions.
+
+CREATE_PARTITIONED = """
+    CREATE TABLE IF NOT EXISTS objects (
+        zoid        VARCHAR(32) NOT NULL,
+        tid         BIGINT NOT NULL,
+        state_size  BIGINT NOT NULL,
+        part        BIGINT NOT NULL,
+        resource    BOOLEAN NOT NULL,
+        of          VARCHAR(32),
+        otid        BIGINT,
+        parent_id   VARCHAR(32),
+        id          TEXT,
+        type        TEXT NOT NULL,
+        json        JSONB,
+        state       BYTEA,
+        children    BIGINT,
+        PRIMARY KEY (zoid, part)
+    ) PARTITION BY LIST (part);
+    """
+
+IS_PARTITIONED = """
+    SELECT relkind = 'p' FROM pg_class WHERE oid = 'objects'::regclass
+    """
+
+# Partitions are created empty and then attached, which does not lock the
+# reads and writes of the other transactions like CREATE TABLE PARTITION OF
+CREATE_PARTITION = """
+    CREATE TABLE IF NOT EXISTS "{name}" (LIKE objects INCLUDING DEFAULTS);
+    ALTER TABLE objects ATTACH PARTITION "{name}" FOR VALUES IN ({part});
+    """
+
+PARTITIONS = """
+    SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound,
+           greatest(c.reltuples, 0)::bigint AS rows,
+           pg_total_relation_size(c.oid) AS size
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'objects'::regclass
+    ORDER BY size DESC
+    """
+
+TABLE_SIZE = """
+    SELECT 'objects' AS name, NULL AS bound,
+           greatest(reltuples, 0)::bigint AS rows,
+           pg_total_relation_size(oid) AS size
+    FROM pg_class WHERE oid = 'objects'::regclass
+    """
+
+MOVE_FROM_TEMP_PARTITIONED = """
+    WITH moved_rows AS (
+        DELETE FROM current_objects
+        WHERE
+            "tid" = $1::int
+        RETURNING *
+    ),
+    moved_partition AS (
+        DELETE FROM objects ob USING moved_rows
+        WHERE ob.zoid = moved_rows.zoid AND ob.part <> moved_rows.part
+    )
+    INSERT INTO objects
+    SELECT * FROM moved_rows ORDER BY zoid
+    ON CONFLICT (zoid, part) DO UPDATE SET
+        tid = EXCLUDED.tid,
+        state_size = EXCLUDED.state_size,
+        resource = EXCLUDED.resource,
+        of = EXCLUDED.of,
+        otid = EXCLUDED.otid,
+        parent_id = EXCLUDED.parent_id,
+        id = EXCLUDED.id,
+        type = EXCLUDED.type,
+        json = COALESCE(EXCLUDED.json, objects.json),
+        state = EXCLUDED.state;
+    """
+
+STORE_UNNEST_PARTITIONED = """
+    WITH rows AS (
+        SELECT * FROM unnest(
+            $1::varchar(32)[], $2::bigint[], $3::bigint[], $4::bigint[],
+            $5::boolean[], $6::varchar(32)[], $7::bigint[], $8::varchar(32)[],
+            $9::text[], $10::text[], $11::jsonb[], $12::bytea[], $14::bigint[])
+        AS t (zoid, tid, state_size, part, resource, of, otid, parent_id, id,
+              type, json, state, children)
+    ),
+    conflicts AS (
+        SELECT ob.zoid FROM objects ob JOIN rows USING (zoid)
+        WHERE ob.tid > rows.otid
+    ),
+    moved_partition AS (
+        DELETE FROM objects ob USING rows
+        WHERE ob.zoid = rows.zoid AND ob.part <> rows.part
+        AND NOT EXISTS (SELECT 1 FROM conflicts)
+    ),
+    stored AS (
+        INSERT INTO objects
+        SELECT * FROM rows
+        WHERE NOT EXISTS (SELECT 1 FROM conflicts)
+        ORDER BY zoid
+        ON CONFLICT (zoid, part) DO UPDATE SET
+            tid = EXCLUDED.tid,
+            state_size = EXCLUDED.state_size,
+            resource = EXCLUDED.resource,
+            of = EXCLUDED.of,
+            otid = EXCLUDED.otid,
+            parent_id = EXCLUDED.parent_id,
+            id = EXCLUDED.id,
+            type = EXCLUDED.type,
+            json = COALESCE(EXCLUDED.json, objects.json),
+            state = EXCLUDED.state
+        RETURNING zoid
+    ),
+    deleted AS (
+        UPDATE objects SET parent_id = '{trash}', of = NULL, tid = $15::bigint
+        WHERE zoid = ANY($13::varchar(32)[])
+        AND NOT EXISTS (SELECT 1 FROM conflicts)
+        RETURNING zoid
+    )
+    SELECT zoid FROM conflicts
+    """.format(trash=TRASHED_ID)
+
+
+def in_partition(query, param):
+    """query restricted to the partition given in the parameter number param"""
+    return query.replace('WHERE ', 'WHERE part = ${}::bigint AND '.format(param))
+
+
+# Queries on the children or annotations of an object -> the same query
+# restricted to their partition, so Postgres only scans that one
+PARTITION_QUERIES = {
+    query: in_partition(query, param) for query, param in (
+        (GET_SONS_KEYS, 2),
+        (GET_SONS_KEYS_PAGE, 3),
+        (GET_SONS_KEYS_AFTER, 4),
+        (GET_ANNOTATIONS_KEYS, 2),
+        (GET_CHILD, 3),
+        (GET_PATH, 3),
+        (GET_CHILD_ANNOTATED, 3),
+        (GET_PATH_ANNOTATED, 3),
+        (EXIST_CHILD, 3),
+        (GET_ANNOTATION, 3),
+        (NUM_CHILDS, 2),
+        (GET_CHILDREN_COUNT, 2),
+        (ESTIMATE_CHILDS, 2),
+        (GET_CHILDS, 2),
+        (GET_CHILDS_PAGE, 3),
+        (GET_CHILDS_AFTER, 4))
+}
+
+# How the rows of a commit are written:
+# temp_table: COPY into temporary tables, checked and moved on finish
+# unnest: a single STORE_UNNEST statement on vote
+COMMIT_STRATEGIES = ('temp_table', 'unnest')
+
+# How the children of an object are counted:
+# counter: count kept in the children column by every commit
+# approximate: estimate of the planner, counted if it is below a threshold
+# count: counted on every call
+CHILDREN_COUNTS = ('counter', 'approximate', 'count')
+
+
+def lsn_query(conn, query):
+    """query with the WAL function names of the server of conn"""
+    if conn.get_server_version().major >= 10:
+        return query.format(wal='wal', lsn='lsn')
+    return query.format(wal='xlog', lsn='location')
+
+
+class PreparedStatementCache(object):
+    """Prepared statements of each pooled connection
+
+    Statements are prepared the first time a transaction uses them on a
+    connection and reused by the next transactions that get the same
+    connection from the pool.
     """
 
+    def __init__(self):
+        # connection -> {query: prepared statement}
+        self._statements = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def prepare(self, conn, query):
+        # pool connections are proxies created on every acquire
+        con = getattr(conn, '_con', conn)
+        statements = self._statements.get(con)
+        if statements is None:
+            self._cleanup()
+            statements = self._statements[con] = {}
+        stmt = statements.get(query)
+        if stmt is None:
+            self.misses += 1
+            stmt = statements[query] = await conn.prepare(query)
+        else:
+            self.hits += 1
+        return stmt
+
+    def _cleanup(self):
+        for con in [c for c in self._statements if c.is_closed()]:
+            del self._statements[con]
+
+    def clear(self):
+        self._statements.clear()
+
+    def stats(self):
+        return {
+            'connections': len(self._statements),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
 
 class BaseStorage(object):
 
-    _cache = {}
+    _cache = None
+    _compressor = None
     _read_only = False
+    # objects are loaded with their annotations, see load_annotated
+    eager_annotations = False
 
-    def __init__(self, read_only=False):
+    def __init__(self, read_only=False, cache=None, codec='pickle', type_codecs=None,
+                 compressor=None):
         self._read_only = read_only
+        if cache is None:
+            cache = ObjectCache()
+        self._cache = cache
+        if compressor is None:
+            compressor = Compressor()
+        self._compressor = compressor
+        self._codec = get_codec(codec)
+        self._type_codecs = {
+            type_name: get_codec(name)
+            for type_name, name in (type_codecs or {}).items()}
 
     def use_cache(self, value):
         self._cache = value
 
+    def get_codec(self, type_name):
+        """Codec used to store the objects of a type"""
+        return self._type_codecs.get(type_name, self._codec)
+
+    async def inflate(self, record):
+        """Record with its state decompressed, if it was compressed"""
+        if record is None or not is_compressed(record['state']):
+            return record
+        record = dict(record.items())
+        record['state'] = await self._compressor.decompress(record['state'])
+        return record
+
     def isReadOnly(self):
         return self._read_only
 
+    @property
+    def partitioned(self):
+        return False
+
+    def reads_replica(self, txn):
+        """Whether txn reads from a replica, that may lag behind"""
+        return False
+
+    async def load_layouts(self, txn=None):
+        """Register the state layouts stored by other processes"""
+
 
 class APgStorage(BaseStorage):
     """Storage to a relational database, based on invalidation polling"""
@@ -136,33 +904,133 @@ class APgStorage(BaseStorage):
 
     _ltid = None
     _conn = None
-    _lock = None
 
     _blobhelper = None
     _large_record_size = 1 << 24
+    _commit_strategy = 'temp_table'
+    _children_count = 'counter'
+    _approximate_threshold = 10000
+    _max_json_fingerprints = 100000
+
+    _replica_dsns = ()
+    _replica_pools = ()
+
+    _invalidation_channel = None
+    _listener = None
+    _poller = None
+    _loop = None
 
-    def __init__(self, dsn=None, partition=None, read_only=False, name=None, pool_size=10):
-        super(APgStorage, self).__init__(read_only)
+    _partitioning = False
+    _partitioned = False
+
+    _vacuum = None
+
+    def __init__(self, dsn=None, partition=None, read_only=False, name=None, pool_size=10,
+                 cache=None, commit_strategy='temp_table', replica_dsns=None,
+                 invalidation_channel='guillotina_invalidations', poll_interval=5,
+                 codec='pickle', type_codecs=None, compressor=None, store_json=True,
+                 partitioning=False, eager_annotations=False, children_count='counter',
+                 approximate_threshold=10000, pool_min_size=None, pool_max_size=None,
+                 pool_long_hold=1.0, pool_resize_interval=10, vacuum_batch_size=1000):
+        if commit_strategy not in COMMIT_STRATEGIES:
+            raise ValueError('Unknown commit strategy {}'.format(commit_strategy))
+        if children_count not in CHILDREN_COUNTS:
+            raise ValueError('Unknown children count {}'.format(children_count))
+        super(APgStorage, self).__init__(
+            read_only, cache=cache, codec=codec, type_codecs=type_codecs,
+            compressor=compressor)
         self._dsn = dsn
         self._pool_size = pool_size
+        # the size of the pools adapts between these bounds, see InstrumentedPool
+        self._pool_min_size = min(pool_min_size or pool_size, pool_size)
+        self._pool_max_size = max(pool_max_size or pool_size, pool_size)
+        self._pool_long_hold = pool_long_hold
+        self._pool_resize_interval = pool_resize_interval
         self._partition_class = partition
         self._read_only = read_only
         self.__name__ = name
-        self._lock = asyncio.Lock()
-        self.read_conn = None
+        self._statements = PreparedStatementCache()
+        self._commit_strategy = commit_strategy
+        self._store_json = store_json
+        # oid -> (tid, fingerprint of the catalog data stored with that tid)
+        self._json_fingerprints = OrderedDict()
+        self.json_skipped = 0
+        self._replica_dsns = replica_dsns or ()
+        self._replica_pools = []
+        self._next_replica = 0
+        # connection -> pool of the replica it was acquired from
+        self._replica_conns = {}
+        # Other processes publish the oids they commit on this channel
+        self._invalidation_channel = invalidation_channel
+        self._poll_interval = poll_interval
+        self._check_offset = 0
+        self._node_id = uuid.uuid4().hex
+        self.notifications = 0
+        # New tables are partitioned on part, see initialize
+        self._partitioning = partitioning
+        # Parts that have a partition
+        self._parts = set()
+        self.eager_annotations = eager_annotations
+        self._children_count = children_count
+        self._approximate_threshold = approximate_threshold
+        self._vacuum_batch_size = vacuum_batch_size
+        self._vacuum_pending = False
+        self.vacuumed = 0
+        # Fingerprints of the layouts in the state_layouts table
+        self._layouts = set()
+
+    async def init_connection(self, conn):
+        await conn.execute(CREATE_TEMP_TABLES)
+
+    async def create_pool(self, dsn, name, loop, init=None):
+        pool = InstrumentedPool(
+            await asyncpg.create_pool(
+                dsn=dsn,
+                max_size=self._pool_max_size,
+                min_size=min(2, self._pool_min_size),
+                init=init,
+                loop=loop),
+            self._pool_size,
+            min_size=self._pool_min_size,
+            max_size=self._pool_max_size,
+            long_hold=self._pool_long_hold,
+            name=name,
+            loop=loop)
+        pool.start(self._pool_resize_interval)
+        return pool
+
+    def pool_stats(self):
+        """Use of the pool of the primary and of each replica"""
+        return {
+            'primary': self._pool.stats(),
+            'replicas': [pool.stats() for pool in self._replica_pools]
+        }
 
     async def finalize(self):
-        await self._pool.release(self.read_conn)
+        for task in (self._vacuum, self._poller):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        if self._listener is not None:
+            await self._listener.close()
+        for pool in self._replica_pools:
+            await pool.close()
         await self._pool.close()
 
     async def initialize(self, loop=None):
         if loop is None:
             loop = asyncio.get_event_loop()
-        self._pool = await asyncpg.create_pool(
-            dsn=self._dsn,
-            max_size=self._pool_size,
-            min_size=2,
-            loop=loop)
+        self._loop = loop
+        # vacuums of the background and the ones called directly
+        self._vacuum_lock = asyncio.Lock(loop=loop)
+        self._pool = await self.create_pool(
+            self._dsn, self.__name__, loop, init=self.init_connection)
+        for idx, dsn in enumerate(self._replica_dsns):
+            self._replica_pools.append(await self.create_pool(
+                dsn, '{} replica {}'.format(self.__name__, idx), loop))
 
         # Check DB
         stmt = """
@@ -178,36 +1046,16 @@ class APgStorage(BaseStorage):
                 id          TEXT,
                 type        TEXT NOT NULL,
                 json        JSONB,
-                state       BYTEA
+                state       BYTEA,
+                children    BIGINT
             ) ;
+            ALTER TABLE objects ADD COLUMN IF NOT EXISTS children BIGINT;
             CREATE INDEX IF NOT EXISTS object_tid ON objects (tid);
             CREATE INDEX IF NOT EXISTS object_of ON objects (of);
             CREATE INDEX IF NOT EXISTS object_part ON objects (part);
             CREATE INDEX IF NOT EXISTS object_parent ON objects (parent_id);
             CREATE INDEX IF NOT EXISTS object_id ON objects (id);
-            """
-
-        func = """
-        CREATE OR REPLACE FUNCTION create_partition_and_insert() RETURNS trigger AS
-              $BODY$
-                DECLARE
-                  partition_id TEXT;
-                  partition TEXT;
-                BEGIN
-                  partition_id := to_char(NEW.part);
-                  partition := 'objects_' || partition_id;
-                  IF NOT EXISTS(SELECT relname FROM pg_class WHERE relname=partition) THEN
-                    RAISE NOTICE 'A partition has been created %',partition;
-                    EXECUTE 'CREATE TABLE ' || partition ||
-                        ' (check (part = ''' || NEW.part || ''')) INHERITS (objects);';
-                  END IF;
-                  EXECUTE 'INSERT INTO ' || partition ||
-                    ' SELECT(objects ' || quote_literal(NEW) || ').* RETURNING patent_id;';
-                  RETURN NULL;
-                END;
-              $BODY$
-            LANGUAGE plpgsql VOLATILE
-            COST 100;
+            CREATE INDEX IF NOT EXISTS object_parent_id ON objects (parent_id, id);
             """
 
         zoid = """
@@ -218,13 +1066,148 @@ class APgStorage(BaseStorage):
             """
         async with self._pool.acquire() as conn:
             async with conn.transaction():
+                if self._partitioning:
+                    await conn.execute(CREATE_PARTITIONED)
                 await conn.execute(stmt)
-                await conn.execute(func)
                 await conn.execute(zoid)
                 await conn.execute(tid)
+                self._partitioned = await conn.fetchval(IS_PARTITIONED)
+        if self._partitioning and not self._partitioned:
+            log.warn('The objects table of %s was created without partitions, '
+                     'it can not be partitioned', self.__name__)
+        if self._partitioned:
+            self._parts = {
+                partition['part'] for partition in await self.get_partitions()}
+            await self.create_partition(0)
+        async with self._pool.acquire() as conn:
+            await conn.execute(CREATE_TRASH)
+            await conn.execute(CREATE_LAYOUTS)
+        await self.load_layouts()
+        # objects deleted before the last shutdown
+        self.schedule_vacuum()
+
+        if self._invalidation_channel is not None:
+            await self.listen(loop)
+            self._poller = asyncio.ensure_future(self.poll_invalidations(), loop=loop)
 
-        self.read_conn = await self.open()
-        self.stmt_next_tid = await self.read_conn.prepare(NEXT_TID)
+    async def listen(self, loop=None):
+        """Invalidate the cache with the commits notified by other processes"""
+        self._listener = await asyncpg.connect(dsn=self._dsn, loop=loop)
+        await self._listener.add_listener(
+            self._invalidation_channel, self.receive_invalidations)
+
+    def receive_invalidations(self, conn, pid, channel, payload):
+        data = ujson.loads(payload)
+        if data['node'] == self._node_id:
+            return
+        self.notifications += 1
+        for oid in data['oids']:
+            self._cache.invalidate(oid, data['tid'])
+        for oid in data.get('parents', ()):
+            self._cache.invalidate_children(oid)
+
+    async def notify_invalidations(self, txn):
+        oids = txn._to_invalidate
+        if self._invalidation_channel is None or not oids:
+            return
+        parents = list(txn._to_invalidate_parents)
+        payloads = [
+            ujson.dumps({
+                'node': self._node_id,
+                'tid': txn._tid,
+                'oids': oids[idx:idx + NOTIFY_OIDS],
+                'parents': parents[idx:idx + NOTIFY_OIDS]
+            }) for idx in range(0, max(len(oids), len(parents)), NOTIFY_OIDS)]
+        stmt = await self.prepare(txn, NOTIFY)
+        await stmt.fetch(self._invalidation_channel, payloads)
+
+    async def check_cache(self):
+        """Drop the cached records that changed or were deleted
+
+        Covers the notifications lost while the listener was not connected.
+        Every call checks the next CHECK_OIDS of them, so a big cache is
+        checked in several polls.
+        """
+        tids = self._cache.tids()
+        if self._check_offset >= len(tids):
+            self._check_offset = 0
+        tids = dict(itertools.islice(
+            tids.items(), self._check_offset, self._check_offset + CHECK_OIDS))
+        self._check_offset += CHECK_OIDS
+        if not tids:
+            return
+        stmt = await self._statements.prepare(self._listener, GET_TIDS)
+        found = {}
+        for record in await stmt.fetch(list(tids.keys())):
+            found[record['zoid']] = record['tid']
+        for oid, tid in tids.items():
+            if oid not in found:
+                self._cache.invalidate(oid)
+            elif found[oid] > tid:
+                self._cache.invalidate(oid, found[oid])
+
+    async def poll_invalidations(self):
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            try:
+                if self._listener.is_closed():
+                    await self.listen()
+                    # the children added meanwhile were not notified
+                    self._cache.clear_children()
+                await self.check_cache()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.warn('Could not check the cache', exc_info=True)
+
+    @property
+    def partitioned(self):
+        return self._partitioned
+
+    async def get_partitions(self):
+        """Name, part, estimated rows and size of each partition
+
+        A table without partitions is returned as a single one with no part.
+        """
+        async with self._pool.acquire() as conn:
+            records = await conn.fetch(PARTITIONS if self._partitioned else TABLE_SIZE)
+        partitions = []
+        for record in records:
+            partition = dict(record.items())
+            bound = partition.pop('bound')
+            if bound is not None:
+                bound = int(re.search(r'-?\d+', bound).group())
+            partition['part'] = bound
+            partitions.append(partition)
+        return partitions
+
+    async def create_partition(self, part):
+        """Create the partition of part if it does not exist
+
+        It is created on its own connection, so it is there for every
+        transaction even if the one that needs it fails.
+        """
+        if part in self._parts:
+            return
+        async with self._pool.acquire() as conn:
+            try:
+                await conn.execute(CREATE_PARTITION.format(
+                    name='objects_{}'.format(part), part=int(part)))
+            except asyncpg.exceptions.PostgresError:
+                # another process may have created it at the same time
+                parts = {partition['part'] for partition in await self.get_partitions()}
+                if part not in parts:
+                    raise
+        self._parts.add(part)
+
+    async def prepare_partition(self, txn, query, part):
+        """Prepare query restricted to the partition of part, if it is known
+
+        Returns the statement and the extra arguments it needs.
+        """
+        if part is None or not self._partitioned:
+            return await self.prepare(txn, query), ()
+        return await self.prepare(txn, PARTITION_QUERIES[query]), (part,)
 
     async def remove(self):
         """Reset the tables"""
@@ -234,25 +1217,67 @@ class APgStorage(BaseStorage):
             await conn.execute(stmt)
             await conn.execute(stmt1)
 
-    async def open(self):
+    async def open(self, read_only=False, min_lsn=None):
+        """Acquire a connection
+
+        Read only connections come from the replicas, in turns, if there
+        are any. When min_lsn is given a replica is only used if it already
+        replayed that position of the WAL of the primary, otherwise the
+        primary is used.
+        """
+        if read_only and self._replica_pools:
+            pool = self._replica_pools[self._next_replica % len(self._replica_pools)]
+            self._next_replica += 1
+            conn = await pool.acquire()
+            if min_lsn is None or await self.replayed(conn, min_lsn):
+                self._replica_conns[conn] = pool
+                return conn
+            await pool.release(conn)
         conn = await self._pool.acquire()
         return conn
 
     async def close(self, con):
-        await self._pool.release(con)
+        pool = self._replica_conns.pop(con, self._pool)
+        await pool.release(con)
+
+    def reads_replica(self, txn):
+        return txn._db_conn in self._replica_conns
+
+    async def replayed(self, conn, lsn):
+        stmt = await self._statements.prepare(conn, lsn_query(conn, REPLAYED_LSN))
+        return await stmt.fetchval(lsn)
 
     async def last_transaction(self, txn):
-        value = await txn._max_tid.fetchval()
+        stmt = await self.prepare(txn, MAX_TID)
+        value = await stmt.fetchval()
         return 0 if value is None else value
 
     async def load(self, txn, oid):
         int_oid = oid
-        objects = await txn._get_oid.fetchrow(int_oid)
+        stmt = await self.prepare(txn, GET_OID)
+        objects = await stmt.fetchrow(int_oid)
         if objects is None:
             raise KeyError(oid)
         return objects
 
+    async def load_annotated(self, txn, oid):
+        """Records of oid and its annotations"""
+        stmt = await self.prepare(txn, GET_OID_ANNOTATED)
+        records = await stmt.fetch(oid)
+        if not any(record['zoid'] == oid for record in records):
+            raise KeyError(oid)
+        return records
+
+    async def load_many(self, txn, oids):
+        """Records of the oids found, in any order"""
+        stmt = await self.prepare(txn, GET_OIDS)
+        return await stmt.fetch(list(oids))
+
     async def tpc_begin(self, txn, conn):
+        if txn.read_only:
+            # The connection is taken on the first load, see get_connection
+            return
+
         # Add the new tid
         if self._read_only:
             raise ReadOnlyError()
@@ -261,146 +1286,427 @@ class APgStorage(BaseStorage):
         txn._db_txn = conn.transaction()
         await txn._db_txn.start()
 
-        # Prepare DB
-        txn._get_from_tid = await conn.prepare(GET_LAST_TID)
-        txn._max_tid = await conn.prepare(MAX_TID)
-        txn._get_oid = await conn.prepare(GET_OID)
-        txn._get_sons_keys = await conn.prepare(GET_SONS_KEYS)
-        txn._get_child = await conn.prepare(GET_CHILD)
-        txn._exist_child = await conn.prepare(EXIST_CHILD)
-        txn._num_childs = await conn.prepare(NUM_CHILDS)
-        txn._get_childs = await conn.prepare(GET_CHILDS)
-        txn._get_annotation = await conn.prepare(GET_ANNOTATION)
-        txn._get_annotations_keys = await conn.prepare(GET_ANNOTATIONS_KEYS)
+    async def get_connection(self, txn):
+        """Connection of the transaction
+
+        Read only transactions acquire it the first time they need it and
+        read from a single snapshot until the transaction manager releases it.
+        """
+        if txn._db_conn is None:
+            txn._db_conn = await self.open(read_only=True, min_lsn=txn.min_lsn)
+            txn._db_txn = txn._db_conn.transaction(isolation='repeatable_read')
+            await txn._db_txn.start()
+        return txn._db_conn
+
+    async def prepare(self, txn, query):
+        conn = await self.get_connection(txn)
+        return await self._statements.prepare(conn, query)
+
+    async def next_tid(self, txn):
+        # nextval is not transactional, so every committing transaction can
+        # take its tid on its own connection without blocking the others
+        stmt = await self.prepare(txn, NEXT_TID)
+        return await stmt.fetchval()
 
     async def precommit(self, txn):
-        async with self._lock:
-            tid = await self.stmt_next_tid.fetchval()
+        tid = await self.next_tid(txn)
         if tid is not None:
             txn._tid = tid
-        current = """
-            CREATE TEMPORARY TABLE IF NOT EXISTS current_objects (
-                zoid        VARCHAR(32) NOT NULL PRIMARY KEY,
-                tid         BIGINT NOT NULL,
-                state_size  BIGINT NOT NULL,
-                part        BIGINT NOT NULL,
-                resource    BOOLEAN NOT NULL,
-                of          VARCHAR(32),
-                otid        BIGINT,
-                parent_id   VARCHAR(32),
-                id          TEXT,
-                type        TEXT NOT NULL,
-                json        JSONB,
-                state       BYTEA
-            )  ON COMMIT DELETE ROWS;
-            CREATE INDEX IF NOT EXISTS current_object_tid ON current_objects (tid);
-            CREATE INDEX IF NOT EXISTS current_object_oid ON current_objects (zoid);
-            CREATE TEMPORARY TABLE IF NOT EXISTS delete_objects (
-                zoid        VARCHAR(32) NOT NULL PRIMARY KEY,
-                tid         BIGINT NOT NULL
-            ) ON COMMIT DELETE ROWS;
-            """
-        await txn._db_conn.execute(current)
+        # Rows are written in one go on vote
+        txn._pending_store = []
+        txn._pending_delete = []
+        txn._pending_layouts = set()
+
+    async def load_layouts(self, txn=None):
+        """Register the state layouts stored by any process in the codec"""
+        if txn is None:
+            async with self._pool.acquire() as conn:
+                records = await conn.fetch(GET_LAYOUTS)
+        else:
+            stmt = await self.prepare(txn, GET_LAYOUTS)
+            records = await stmt.fetch()
+        codec = get_codec('compact')
+        for record in records:
+            codec.register_layout(record['names'])
+            self._layouts.add(record['fingerprint'])
+
+    async def store_layouts(self, txn, codec):
+        """Store the layouts of codec that are not in the table yet
+
+        They are written in txn, so they are committed with the states that
+        use them.
+        """
+        layouts = codec.layouts()
+        if len(layouts) <= len(self._layouts) + len(txn._pending_layouts):
+            return
+        stmt = await self.prepare(txn, STORE_LAYOUT)
+        for fingerprint, names in layouts.items():
+            if fingerprint not in self._layouts and fingerprint not in txn._pending_layouts:
+                await stmt.fetch(fingerprint, list(names))
+                txn._pending_layouts.add(fingerprint)
 
     async def store(self, oid, old_serial, writer, obj, txn):
         assert oid is not None
-        p = writer.serialize()  # This calls __getstate__ of obj
+        codec = self.get_codec(writer.type)
+        p = writer.serialize(codec)  # This calls __getstate__ of obj
+        await self.store_layouts(txn, codec)
         if len(p) >= self._large_record_size:
-            self._log.warn("Too long object %d" % (obj.__class__, len(p)))
-        json_dict = await writer.get_json()
-        json = ujson.dumps(json_dict)
+            log.warn("Too long object %s (%d bytes)", obj.__class__, len(p))
+        p = await self._compressor.compress(p)
+        json = await self.get_json(writer, oid, old_serial, txn._tid)
         part = writer.part
         if part is None:
             part = 0
-        # (zoid, tid, state_size, part, main, parent_id, type, json, state)
-        output = await txn._db_conn.execute(  # noqa
-            INSERT_TEMP,         # Insert on temp table
+        if self._partitioned and part not in self._parts:
+            await self.create_partition(part)
+        txn._pending_store.append((
             oid,                 # The OID of the object
             txn._tid,            # Our TID
             len(p),              # Len of the object
             part,                # Partition indicator
-            writer.resource,    # Is a resource ?
-            writer.of,                # It belogs to a main
+            writer.resource,     # Is a resource ?
+            writer.of,           # It belogs to a main
             old_serial,          # Old serial
-            writer.parent_id,           # Parent OID
-            writer.id,                  # Traversal ID
-            writer.type,               # Guillotina type
+            writer.parent_id,    # Parent OID
+            writer.id,           # Traversal ID
+            writer.type,         # Guillotina type
             json,                # JSON catalog
             p                    # Pickle state
-        )
+        ))
         obj._p_estimated_size = len(p)
         return txn._tid, len(p)
 
+    async def get_json(self, writer, oid, old_serial, tid):
+        """Catalog JSON of an object to store
+
+        None keeps the JSON already stored: when the column is disabled, or
+        when the catalog data has the fingerprint it had when this process
+        stored the version of the object that is being replaced.
+        """
+        if not self._store_json:
+            return None
+        stored = self._json_fingerprints.pop(oid, None)
+        fingerprint = writer.catalog_fingerprint()
+        if fingerprint is not None:
+            self._json_fingerprints[oid] = (tid, fingerprint)
+            if len(self._json_fingerprints) > self._max_json_fingerprints:
+                self._json_fingerprints.popitem(last=False)
+            if old_serial is not None and stored == (old_serial, fingerprint):
+                self.json_skipped += 1
+                return None
+        return ujson.dumps(await writer.get_json())
+
     async def delete(self, txn, oid):
-        await txn._db_conn.execute(
-            DELETE_TMP,         # delete on temp table
-            oid,
-            txn._tid)
+        txn._pending_delete.append((oid, txn._tid))
+
+    def count_new_children(self, rows):
+        """Pending rows with the count of children of the new objects
+
+        All the children of a new object are stored in the same commit. The
+        count is None for the rest of objects, their stored count is kept,
+        and for every object if the counts are not kept.
+        """
+        if self._children_count != 'counter':
+            return [row + (None,) for row in rows]
+        new = {row[0] for row in rows if row[6] is None}
+        counts = Counter(row[7] for row in rows if row[7] in new)
+        return [row + (counts[row[0]] if row[6] is None else None,) for row in rows]
+
+    async def repair_children_counts(self):
+        """Count the children of every object again
+
+        Returns the number of objects that had a wrong count.
+        """
+        async with self._pool.acquire() as conn:
+            result = await conn.execute(REPAIR_CHILDREN)
+        return int(result.split()[-1])
+
+    def schedule_vacuum(self):
+        """Vacuum the trash in the background"""
+        self._vacuum_pending = True
+        if self._vacuum is None or self._vacuum.done():
+            self._vacuum = asyncio.ensure_future(self._run_vacuum(), loop=self._loop)
+
+    async def _run_vacuum(self):
+        while self._vacuum_pending:
+            self._vacuum_pending = False
+            try:
+                await self.vacuum()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.error('Error vacuuming the trash of %s', self.__name__, exc_info=True)
+
+    async def vacuum(self):
+        """Delete the trashed objects with their descendants and annotations
+
+        The objects to delete are found once, and deleted in batches of
+        vacuum_batch_size with their annotations, each one in its own
+        transaction. Returns the number of deleted rows.
+        """
+        total = 0
+        async with self._vacuum_lock:
+            async with self._pool.acquire() as conn:
+                oids = [record['zoid'] for record in await conn.fetch(TRASH_TREE)]
+            for idx in range(0, len(oids), self._vacuum_batch_size):
+                async with self._pool.acquire() as conn:
+                    records = await conn.fetch(
+                        VACUUM_TRASH, oids[idx:idx + self._vacuum_batch_size])
+                for record in records:
+                    self._cache.invalidate(record['zoid'])
+                total += len(records)
+                self.vacuumed += len(records)
+        return total
+
+    async def copy(self, txn, oid, new_oid, parent_id, id, path, depth):
+        """Copy oid with the resources below it and their annotations
+
+        The rows are copied by the database in the transaction, the copy of
+        oid gets new_oid and is stored as id of parent_id. path and depth
+        are the ones of the copy, for its catalog data. Returns the records
+        of the copied resources below it with their catalog data, decoded.
+        """
+        tid = await self.next_tid(txn)
+        stmt = await self.prepare(txn, COPY_TREE)
+        records = await stmt.fetch(
+            oid, new_oid, parent_id, id, path, depth, tid,
+            self._children_count == 'counter', None)
+        return [{
+            'zoid': record['zoid'],
+            'type': record['type'],
+            'json': ujson.loads(record['json']) if record['json'] is not None else None
+        } for record in records]
+
+    async def export_tree(self, txn, oid, output):
+        """Stream the rows of oid, the objects below it and their annotations
+
+        output is a coroutine function that gets the chunks of the rows in
+        the binary format of COPY, with the columns of STORE_COLUMNS.
+        Returns the number of rows.
+        """
+        conn = await self.get_connection(txn)
+        result = await conn.copy_from_query(EXPORT_TREE, oid, output=output, format='binary')
+        return int(result.split()[-1])
+
+    async def import_tree(self, txn, source, oid, new_oid, parent_id, id, path, depth):
+        """Import the rows of an export_tree of oid as a copy of it
+
+        source is an asynchronous iterable of the chunks of the export. The
+        rows are streamed to a temporary table and copied from it like copy
+        does, to the partition 0 on partitioned tables. Returns the number of
+        imported rows.
+        """
+        conn = await self.get_connection(txn)
+        await conn.execute(CREATE_IMPORT)
+        await conn.copy_to_table(
+            'import_objects', source=source, columns=STORE_COLUMNS, format='binary')
+        await conn.execute('ANALYZE import_objects')
+        tid = await self.next_tid(txn)
+        stmt = await self.prepare(txn, IMPORT_TREE)
+        return await stmt.fetchval(
+            oid, new_oid, parent_id, id, path, depth, tid,
+            self._children_count == 'counter', 0 if self._partitioned else None)
+
+    async def set_part(self, txn, oid, part):
+        """Move the objects below oid and its annotations to the partition part"""
+        if part is None:
+            part = 0
+        if part not in self._parts:
+            await self.create_partition(part)
+        stmt = await self.prepare(txn, SET_PART)
+        await stmt.fetch(oid, part)
+
+    async def flush(self, txn):
+        """Write the pending rows of the transaction on the temporary tables"""
+        if txn._pending_store:
+            await txn._db_conn.copy_records_to_table(
+                'current_objects', records=self.count_new_children(txn._pending_store),
+                columns=STORE_COLUMNS)
+            txn._pending_store = []
+        if txn._pending_delete:
+            await txn._db_conn.copy_records_to_table(
+                'delete_objects', records=txn._pending_delete, columns=('zoid', 'tid'))
+            txn._pending_delete = []
+
+    async def store_unnest(self, txn):
+        """Check conflicts and write the pending rows with one statement
+
+        Returns the oids in conflict, nothing is written if there are any.
+        """
+        if txn._pending_store:
+            columns = [list(c) for c in zip(*self.count_new_children(txn._pending_store))]
+        else:
+            columns = [[] for _ in STORE_COLUMNS]
+        deleted = [oid for oid, _ in txn._pending_delete]
+        txn._pending_store = []
+        txn._pending_delete = []
+        if self._children_count == 'counter':
+            # a commit with conflicts is rolled back with the counts
+            stmt = await self.prepare(txn, COUNT_CHILDREN_UNNEST)
+            await stmt.fetch(columns[0], columns[7], deleted)
+        stmt = await self.prepare(
+            txn, STORE_UNNEST_PARTITIONED if self._partitioned else STORE_UNNEST)
+        return await stmt.fetch(*columns[:12], deleted, columns[12], txn._tid)
 
     async def tpc_vote(self, transaction):
+        if self._commit_strategy == 'unnest':
+            try:
+                return len(await self.store_unnest(transaction)) == 0
+            except asyncpg.exceptions.DeadlockDetectedError:
+                raise ConflictError(transaction, None)
+
+        await self.flush(transaction)
         # Check if there is any commit bigger than the one we already have
         # For each object going to be written we need to check if it has
         # a new TID
-        r = await transaction._db_conn.fetch(
-            """
-            SELECT ob.zoid, ob.tid FROM objects ob JOIN current_objects co
-            USING (zoid) WHERE ob.tid > co.otid AND co.tid = $1""",
-            transaction._tid)
+        stmt = await self.prepare(transaction, GET_CONFLICTS)
+        r = await stmt.fetch(transaction._tid)
         if len(r) == 0:
             return True
         else:
             return False
 
     async def tpc_finish(self, transaction):
-        await transaction._db_conn.execute(
-            MOVE_FROM_TEMP,
-            transaction._tid
-        )
-        await transaction._db_conn.execute(
-            DELETE_FROM_OBJECTS,
-            transaction._tid
-        )
+        await self.notify_invalidations(transaction)
+        if self._commit_strategy == 'temp_table':
+            try:
+                queries = [
+                    MOVE_FROM_TEMP_PARTITIONED if self._partitioned else MOVE_FROM_TEMP,
+                    DELETE_FROM_OBJECTS]
+                if self._children_count == 'counter':
+                    queries.insert(0, COUNT_CHILDREN)
+                # the only argument is the integer tid, so the statements
+                # are sent together in a single round trip
+                tid = str(int(transaction._tid))
+                await transaction._db_conn.execute(';'.join(
+                    query.strip().rstrip(';').replace('$1', tid)
+                    for query in queries))
+            except asyncpg.exceptions.DeadlockDetectedError:
+                # commits that lock the same rows in another order, the
+                # request can be run again like on any other conflict
+                raise ConflictError(transaction, None)
         if transaction._db_txn is not None:
             await transaction._db_txn.commit()
+            if self._replica_pools:
+                conn = transaction._db_conn
+                stmt = await self._statements.prepare(
+                    conn, lsn_query(conn, CURRENT_LSN))
+                transaction.lsn = await stmt.fetchval()
         else:
             log.warn('Do not have db transaction to commit')
+        self._layouts.update(transaction._pending_layouts)
+        if transaction.deleted:
+            self.schedule_vacuum()
         return transaction._tid
 
     async def abort(self, transaction):
         if transaction._db_txn is not None:
             await transaction._db_txn.rollback()
-        else:
+        elif not transaction.read_only:
             log.warn('Do not have db transaction to rollback')
 
     # Introspection
+    #
+    # part is the partition of the children or annotations, when the
+    # transaction knows it
 
-    async def keys(self, txn, oid):
-        result = await txn._get_sons_keys.fetch(oid)
+    async def keys(self, txn, oid, start_after=None, limit=None, part=None):
+        if start_after is not None:
+            stmt, args = await self.prepare_partition(txn, GET_SONS_KEYS_AFTER, part)
+            return await stmt.fetch(oid, start_after, limit, *args)
+        if limit is not None:
+            stmt, args = await self.prepare_partition(txn, GET_SONS_KEYS_PAGE, part)
+            return await stmt.fetch(oid, limit, *args)
+        stmt, args = await self.prepare_partition(txn, GET_SONS_KEYS, part)
+        result = await stmt.fetch(oid, *args)
         return result
 
-    async def get_child(self, txn, parent_id, id):
-        result = await txn._get_child.fetchrow(parent_id, id)
+    async def get_child(self, txn, parent_id, id, part=None):
+        stmt, args = await self.prepare_partition(txn, GET_CHILD, part)
+        result = await stmt.fetchrow(parent_id, id, *args)
         return result
 
-    async def has_key(self, txn, parent_id, id):
-        result = await txn._exist_child.fetchrow(parent_id, id)
+    async def get_child_annotated(self, txn, parent_id, id, part=None):
+        """Records of the child and its annotations, the child is the one without of"""
+        stmt, args = await self.prepare_partition(txn, GET_CHILD_ANNOTATED, part)
+        return await stmt.fetch(parent_id, id, *args)
+
+    async def get_path(self, txn, parent_id, path, part=None):
+        stmt, args = await self.prepare_partition(txn, GET_PATH, part)
+        return await stmt.fetch(parent_id, list(path), *args)
+
+    async def get_path_annotated(self, txn, parent_id, path, part=None):
+        """Records of the path ordered by depth followed by their annotations"""
+        stmt, args = await self.prepare_partition(txn, GET_PATH_ANNOTATED, part)
+        return await stmt.fetch(parent_id, list(path), *args)
+
+    async def has_key(self, txn, parent_id, id, part=None):
+        stmt, args = await self.prepare_partition(txn, EXIST_CHILD, part)
+        result = await stmt.fetchrow(parent_id, id, *args)
         if result is None:
             return False
         else:
             return True
 
-    async def len(self, txn, oid):
-        result = await txn._num_childs.fetchval(oid)
+    async def len(self, txn, oid, part=None):
+        if self._children_count == 'counter':
+            stmt, args = await self.prepare_partition(txn, GET_CHILDREN_COUNT, part)
+            result = await stmt.fetchval(oid, *args)
+            if result is not None:
+                return result
+            # objects stored before the counts were kept
+        elif self._children_count == 'approximate':
+            stmt, args = await self.prepare_partition(txn, ESTIMATE_CHILDS, part)
+            plan = ujson.loads(await stmt.fetchval(oid, *args))
+            estimate = plan[0]['Plan']['Plan Rows']
+            if estimate >= self._approximate_threshold:
+                return estimate
+        stmt, args = await self.prepare_partition(txn, NUM_CHILDS, part)
+        result = await stmt.fetchval(oid, *args)
         return result
 
-    async def items(self, txn, oid):
-        async for record in txn._get_childs.cursor(oid):
+    async def items(self, txn, oid, start_after=None, limit=None, part=None):
+        """Children records of oid
+
+        Without arguments all the children are streamed with a cursor. With
+        start_after or limit a page of children ordered by id is returned.
+        """
+        if start_after is not None:
+            stmt, args = await self.prepare_partition(txn, GET_CHILDS_AFTER, part)
+            records = await stmt.fetch(oid, start_after, limit, *args)
+        elif limit is not None:
+            stmt, args = await self.prepare_partition(txn, GET_CHILDS_PAGE, part)
+            records = await stmt.fetch(oid, limit, *args)
+        else:
+            stmt, args = await self.prepare_partition(txn, GET_CHILDS, part)
+            async for record in stmt.cursor(oid, *args):
+                yield record
+            return
+        for record in records:
             yield record
 
-    async def get_annotation(self, txn, oid, id):
-        result = await txn._get_annotation.fetchrow(oid, id)
+    async def get_descendants(self, txn, oid, json=False):
+        """Records of the resources below oid, with their path relative to it
+
+        With json they include their catalog data, decoded.
+        """
+        if not json:
+            stmt = await self.prepare(txn, GET_DESCENDANTS)
+            return await stmt.fetch(oid)
+        stmt = await self.prepare(txn, GET_DESCENDANTS_JSON)
+        return [{
+            'zoid': record['zoid'],
+            'type': record['type'],
+            'path': record['path'],
+            'json': ujson.loads(record['json']) if record['json'] is not None else None
+        } for record in await stmt.fetch(oid)]
+
+    async def get_annotation(self, txn, oid, id, part=None):
+        stmt, args = await self.prepare_partition(txn, GET_ANNOTATION, part)
+        result = await stmt.fetchrow(oid, id, *args)
         return result
 
-    async def get_annotation_keys(self, txn, oid):
-        result = await txn._get_annotations_keys.fetch(oid)
+    async def get_annotation_keys(self, txn, oid, part=None):
+        stmt, args = await self.prepare_partition(txn, GET_ANNOTATIONS_KEYS, part)
+        result = await stmt.fetch(oid, *args)
         return result
@@ -1,6 +1,11 @@
+from guillotina.db.cache import NOT_CACHED
+from guillotina.db.codecs import StateCodecError
 from guillotina.db.interfaces import IWriter
 from guillotina.db.reader import reader
+from guillotina.exceptions import ConflictError
 from guillotina.exceptions import Unauthorized
+from guillotina.utils import get_content_depth
+from guillotina.utils import get_content_path
 from guillotina.utils import get_current_request
 
 import logging
@@ -9,13 +14,6 @@ import time
 import uuid
 
 
-HARD_CACHE = {}
-
-
-class ConflictError(Exception):
-    pass
-
-
 logger = logging.getLogger(__name__)
 
 
@@ -29,7 +27,7 @@ class Status:
 
 class Transaction(object):
 
-    def __init__(self, manager, request=None):
+    def __init__(self, manager, request=None, read_only=False):
         self._txn_time = None
         self._tid = None
         self.status = Status.ACTIVE
@@ -41,12 +39,25 @@ class Transaction(object):
         self.added = {}
         self.modified = {}
         self.deleted = {}
+        # Objects moved or copied, the objects below them follow them to
+        # their partition on commit
+        self._relocated = {}
 
         # Cache for the transaction
         self._cache = manager._storage._cache
+        self._cache_generation = self._cache.generation
 
         # OIDS to invalidate
         self._to_invalidate = []
+        # Objects that got new children, their cached children are dropped
+        self._to_invalidate_parents = set()
+
+        # (parent oid, id) -> child record, or None if missing, found by
+        # prefetch_path and used once by get_child
+        self._path_records = {}
+        # oid -> annotation records of the objects of _path_records, when
+        # the storage loads them eagerly
+        self._path_annotations = {}
 
         # List of (hook, args, kws) tuples added by addBeforeCommitHook().
         self._before_commit = []
@@ -60,6 +71,12 @@ class Transaction(object):
         self._db_conn = None
         # Transaction on DB
         self._db_txn = None
+        # Read only transactions get the connection lazily
+        self.read_only = read_only
+        # Position of the WAL of the primary the transaction must see
+        self.min_lsn = None
+        # Position of the WAL of the primary after the commit
+        self.lsn = None
         self.request = request
 
     def get_before_commit_hooks(self):
@@ -112,13 +129,17 @@ class Transaction(object):
     async def tpc_begin(self, conn):
         """Begin commit of a transaction
 
-        conn is a real db that will be got by db.open()
+        conn is a real db that will be got by db.open(), None on read only
+        transactions
         """
         self._txn_time = time.time()
         await self._manager._storage.tpc_begin(self, conn)
         self._cache = self._manager._storage._cache
+        self._cache_generation = self._cache.generation
 
     def check_read_only(self):
+        if self.read_only:
+            raise Unauthorized('Read only transaction')
         if self.request is None:
             self.request = get_current_request()
         if hasattr(self.request, '_db_write_enabled') and not self.request._db_write_enabled:
@@ -148,9 +169,95 @@ class Transaction(object):
                 del self.modified[oid]
             self.deleted[oid] = obj
 
+    def move(self, obj, new_parent, new_id):
+        """Move obj to new_parent as new_id
+
+        Only obj is stored again, the objects below it keep their parent.
+        """
+        self.register(obj)
+        obj.__parent__ = new_parent
+        obj.__name__ = new_id
+        self._relocated[obj._p_oid] = obj
+
+    async def copy(self, obj, new_parent, new_id):
+        """Copy obj and the objects below it to new_parent as new_id
+
+        The storage copies their rows without loading them. Returns the copy
+        and the records of the resources below it with their catalog data.
+        """
+        self.check_read_only()
+        new_oid = uuid.uuid4().hex
+        records = await self._manager._storage.copy(
+            self, obj._p_oid, new_oid, new_parent._p_oid, new_id,
+            *self._location(new_parent, new_id))
+        return await self._adopt(new_oid, new_parent), records
+
+    async def import_tree(self, oid, source, new_parent, new_id):
+        """Import the export of oid from source to new_parent as new_id
+
+        source is an asynchronous iterable of the chunks of the export of
+        the storage. Returns the imported object, see copy.
+        """
+        self.check_read_only()
+        new_oid = uuid.uuid4().hex
+        await self._manager._storage.import_tree(
+            self, source, oid, new_oid, new_parent._p_oid, new_id,
+            *self._location(new_parent, new_id))
+        return await self._adopt(new_oid, new_parent)
+
+    def _location(self, parent, id):
+        """Path and depth of the child id of parent"""
+        return ('{}/{}'.format(get_content_path(parent).rstrip('/'), id),
+                get_content_depth(parent) + 1)
+
+    async def _adopt(self, oid, parent):
+        """Object of oid, written by the storage in the transaction, as a
+        child of parent
+
+        Its state keeps the parent it was copied with, so it is stored again.
+        """
+        # not cached, it does not exist until the commit
+        obj = await self._read(await self._manager._storage.load(self, oid))
+        obj._p_jar = self
+        obj.__parent__ = parent
+        self.register(obj)
+        self._relocated[oid] = obj
+        return obj
+
     async def clean_cache(self):
-        HARD_CACHE.clean()
-        await self._cache.clear()
+        self._cache.clear()
+
+    def _cache_record(self, record, obj):
+        self._cache.set(record['zoid'], record, obj.__cache__)
+
+    async def _read(self, record):
+        # records are cached with their stored state, maybe compressed
+        record = await self._manager._storage.inflate(record)
+        try:
+            return reader(record)
+        except StateCodecError:
+            # written with a layout that another process stored
+            await self._manager._storage.load_layouts(self)
+            return reader(record)
+
+    async def _read_annotations(self, obj, records):
+        """Fill the annotations of obj with the records of all of them
+
+        The annotations that are not there are known to not exist, see
+        AnnotationsAdapter.async_get.
+        """
+        annotations = obj.__annotations__
+        part = IWriter(obj).part if records else None
+        for record in records:
+            if record['id'] in annotations:
+                continue
+            annotation = await self._read(record)
+            annotation.__of__ = obj._p_oid
+            annotation._p_jar = self
+            annotation._v_part = part
+            self._cache_record(record, annotation)
+            annotations[record['id']] = annotation
+        obj._v_annotations_loaded = True
 
     # GET AN OBJECT
 
@@ -160,24 +267,57 @@ class Transaction(object):
         if obj is not None:
             return obj
 
-        obj = self._cache.get(oid, None)
-        if obj is not None:
-            return obj
-
-        result = HARD_CACHE.get(oid, None)
+        result = self._cache.get(oid)
         if result is not None:
-            obj = reader(result)
+            obj = await self._read(result)
             obj._p_jar = self
             return obj
 
-        result = await self._manager._storage.load(self, oid)
-        obj = reader(result)
+        storage = self._manager._storage
+        if storage.eager_annotations:
+            annotations = []
+            for record in await storage.load_annotated(self, oid):
+                if record['zoid'] == oid:
+                    result = record
+                else:
+                    annotations.append(record)
+        else:
+            result = await storage.load(self, oid)
+        obj = await self._read(result)
         obj._p_jar = self
+        self._cache_record(result, obj)
+        if storage.eager_annotations:
+            await self._read_annotations(obj, annotations)
+        return obj
 
-        if obj.__cache__ == 0:
-            HARD_CACHE[oid] = result
+    async def get_many(self, oids):
+        """Getting the objects of a list of oids from the db
 
-        return obj
+        Objects not found in the transaction or the cache are loaded with a
+        single query. Missing oids are skipped, the rest keep their order.
+        """
+        found = {}
+        missing = set()
+        for oid in oids:
+            obj = self.modified.get(oid, None)
+            if obj is None:
+                result = self._cache.get(oid)
+                if result is not None:
+                    obj = await self._read(result)
+                    obj._p_jar = self
+            if obj is not None:
+                found[oid] = obj
+            else:
+                missing.add(oid)
+
+        if missing:
+            for result in await self._manager._storage.load_many(self, missing):
+                obj = await self._read(result)
+                obj._p_jar = self
+                self._cache_record(result, obj)
+                found[result['zoid']] = obj
+
+        return [found[oid] for oid in oids if oid in found]
 
     async def commit(self):
         await self._call_before_commit_hooks()
@@ -206,13 +346,15 @@ class Transaction(object):
             if obj._p_jar is not self and obj._p_jar is not None:
                 raise Exception('Invalid reference to txn')
 
+            writer = IWriter(obj)
             s, l = await self._manager._storage.store(
-                oid, None, IWriter(obj), obj, self)
+                oid, None, writer, obj, self)
             obj._p_serial = s
             obj._p_oid = oid
             if obj._p_jar is None:
                 obj._p_jar = self
             self._to_invalidate.append(oid)
+            self._invalidate_parent(writer)
         for oid, obj in self.modified.items():
             # Modified objects
             if obj._p_jar is not self and obj._p_jar is not None:
@@ -220,17 +362,29 @@ class Transaction(object):
 
             # There is no serial
             serial = getattr(obj, "_p_serial", 0)
+            writer = IWriter(obj)
             s, l = await self._manager._storage.store(
-                oid, serial, IWriter(obj), obj, self)
+                oid, serial, writer, obj, self)
             obj._p_serial = s
             if obj._p_jar is None:
                 obj._p_jar = self
             self._to_invalidate.append(oid)
+            # it may have been moved
+            self._invalidate_parent(writer)
         for oid, obj in self.deleted.items():
             if obj._p_jar is not self and obj._p_jar is not None:
                 raise Exception('Invalid reference to txn')
             await self._manager._storage.delete(self, oid)
             self._to_invalidate.append(oid)
+        if self._manager._storage.partitioned:
+            for oid, obj in self._relocated.items():
+                if oid not in self.deleted:
+                    await self._manager._storage.set_part(self, oid, IWriter(obj).part)
+
+    def _invalidate_parent(self, writer):
+        parent_id = writer.parent_id
+        if parent_id is not None:
+            self._to_invalidate_parents.add(parent_id)
 
     async def tpc_vote(self):
         """Verify that a data manager can commit the transaction."""
@@ -244,58 +398,182 @@ class Transaction(object):
         """Indicate confirmation that the transaction is done.
         """
         await self._manager._storage.tpc_finish(self)
-        # Set on cache
-        # for key, obj in self.added.items():
-        #     self._cache.set(obj._p_oid, obj, obj.__cache__)
-        # for key, obj in self.modified.items():
-        #     self._cache.set(obj._p_oid, obj, obj.__cache__)
-        # for key, obj in self.deleted.items():
-        #     self._cache.set(obj._p_oid, obj, obj.__cache__)
+        for oid in self._to_invalidate:
+            self._cache.invalidate(oid, self._tid)
+        for oid in self._to_invalidate_parents:
+            self._cache.invalidate_children(oid)
+        if self.deleted:
+            self._cache.invalidate_below(self.deleted)
         self.tpc_cleanup()
 
     def tpc_cleanup(self):
         self.added = {}
         self.modified = {}
         self.deleted = {}
+        self._relocated = {}
         self._to_invalidate = []
+        self._to_invalidate_parents = set()
+        self._path_records = {}
+        self._path_annotations = {}
         self._db_txn = None
 
     # Inspection
 
-    async def keys(self, oid):
+    def partition(self, obj):
+        """Partition of the children and annotations of obj
+
+        None if the storage is not partitioned or they may be on any
+        partition, like the children of the root.
+        """
+        if not self._manager._storage.partitioned:
+            return None
+        return IWriter(obj).part or None
+
+    async def keys(self, oid, start_after=None, limit=None, part=None):
         keys = []
-        for record in await self._manager._storage.keys(self, oid):
+        storage = self._manager._storage
+        for record in await storage.keys(self, oid, start_after, limit, part=part):
             keys.append(record['id'])
         return keys
 
+    async def prefetch_path(self, container, path):
+        """Load the objects of a path below container with one query
+
+        get_child takes them from here instead of asking the storage. The
+        beginning of the path that is in the cache is not loaded again.
+        """
+        if (container._p_oid, path[0]) in self._path_records:
+            return
+        parent_oid = container._p_oid
+        for idx, id in enumerate(path):
+            oid = self._cache.get_child(parent_oid, id)
+            if oid is None:
+                # the rest of the path is not there
+                return
+            if oid is NOT_CACHED or oid not in self._cache:
+                path = path[idx:]
+                break
+            parent_oid = oid
+        else:
+            return
+        storage = self._manager._storage
+        if storage.eager_annotations:
+            records = []
+            for record in await storage.get_path_annotated(
+                    self, parent_oid, path, part=self.partition(container)):
+                if record['of'] is None:
+                    records.append(record)
+                    self._path_annotations[record['zoid']] = []
+                else:
+                    self._path_annotations[record['of']].append(record)
+        else:
+            records = await storage.get_path(
+                self, parent_oid, path, part=self.partition(container))
+        for record in records:
+            self._path_records[(parent_oid, record['id'])] = record
+            self._cache_child(parent_oid, record['id'], record)
+            parent_oid = record['zoid']
+        if len(records) < len(path):
+            self._path_records[(parent_oid, path[len(records)])] = None
+            self._cache_child(parent_oid, path[len(records)], None)
+
     async def get_child(self, container, key):
-        result = await self._manager._storage.get_child(self, container._p_oid, key)
-        obj = reader(result)
+        storage = self._manager._storage
+        annotations = None
+        if (container._p_oid, key) in self._path_records:
+            result = self._path_records.pop((container._p_oid, key))
+            if result is None:
+                raise KeyError(key)
+            annotations = self._path_annotations.pop(result['zoid'], None)
+        else:
+            oid = self._cache.get_child(container._p_oid, key)
+            if oid is None:
+                raise KeyError(key)
+            result = None if oid is NOT_CACHED else self._cache.get(oid)
+            if result is None:
+                result = await self._load_child(container, key)
+                if storage.eager_annotations:
+                    result, annotations = result
+        obj = await self._read(result)
         obj.__parent__ = container
         obj._p_jar = self
+        self._cache_record(result, obj)
+        if annotations is not None:
+            await self._read_annotations(obj, annotations)
         return obj
 
-    async def contains(self, oid, key):
-        return await self._manager._storage.has_key(self, oid, key)  # noqa
+    async def _load_child(self, container, key):
+        """Record of the child key of container, with the records of its
+        annotations when the storage loads them eagerly"""
+        storage = self._manager._storage
+        try:
+            if storage.eager_annotations:
+                result = None
+                annotations = []
+                for record in await storage.get_child_annotated(
+                        self, container._p_oid, key, part=self.partition(container)):
+                    if record['of'] is None:
+                        result = record
+                    else:
+                        annotations.append(record)
+            else:
+                result = await storage.get_child(
+                    self, container._p_oid, key, part=self.partition(container))
+        except KeyError:
+            self._cache_child(container._p_oid, key, None)
+            raise
+        self._cache_child(container._p_oid, key, result)
+        if result is None:
+            raise KeyError(key)
+        if storage.eager_annotations:
+            return result, annotations
+        return result
+
+    def _cache_child(self, parent_oid, key, record):
+        if self._relocated:
+            # the storage already has rows of this transaction
+            return
+        if record is None and self._manager._storage.reads_replica(self):
+            # a child missing on a lagging replica may exist, and nothing
+            # drops the entry of a missing child unless it is added again
+            return
+        self._cache.set_child(parent_oid, key, record, self._cache_generation)
+
+    async def contains(self, oid, key, part=None):
+        return await self._manager._storage.has_key(self, oid, key, part=part)  # noqa
 
-    async def len(self, oid):
-        return await self._manager._storage.len(self, oid)
+    async def len(self, oid, part=None):
+        return await self._manager._storage.len(self, oid, part=part)
 
-    async def items(self, container):
-        async for record in self._manager._storage.items(self, container._p_oid):
-            obj = reader(record)
+    async def items(self, container, start_after=None, limit=None):
+        storage = self._manager._storage
+        async for record in storage.items(self, container._p_oid, start_after, limit,
+                                          part=self.partition(container)):
+            obj = await self._read(record)
             obj.__parent__ = container
             obj._p_jar = self
+            self._cache_record(record, obj)
             yield obj.id, obj
 
+    async def get_descendants(self, obj, json=False):
+        """Records of the resources below obj with their path relative to it
+
+        With json they include their catalog data.
+        """
+        return await self._manager._storage.get_descendants(self, obj._p_oid, json=json)
+
     async def get_annotation(self, base_obj, id):
-        result = await self._manager._storage.get_annotation(self, base_obj._p_oid, id)
+        result = await self._manager._storage.get_annotation(
+            self, base_obj._p_oid, id, part=self.partition(base_obj))
         if result is None:
             raise KeyError(id)
-        obj = reader(result)
+        obj = await self._read(result)
         obj.__of__ = base_obj._p_oid
+        obj._v_part = IWriter(base_obj).part
         obj._p_jar = self
+        self._cache_record(result, obj)
         return obj
 
-    async def get_annotation_keys(self, oid):
-        return [r['id'] for r in await self._manager._storage.get_annotation_keys(self, oid)]
+    async def get_annotation_keys(self, oid, part=None):
+        return [r['id'] for r in await self._manager._storage.get_annotation_keys(
+            self, oid, part=part)]
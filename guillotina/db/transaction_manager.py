@@ -1,9 +1,27 @@
 from guillotina.db import ROOT_ID
 from guillotina.db.transaction import Transaction
+from guillotina.interfaces import LSN_HEADER
+from guillotina.interfaces import SAFE_VERBS
 from guillotina.utils import get_authenticated_user_id
 from guillotina.utils import get_current_request
 from queue import LifoQueue
 
+import re
+
+
+# Positions of the WAL as Postgres prints them
+LSN = re.compile(r'^[0-9A-F]{1,8}/[0-9A-F]{1,8}$', re.IGNORECASE)
+
+
+def get_min_lsn(request):
+    try:
+        lsn = request.headers[LSN_HEADER]
+    except (AttributeError, KeyError, TypeError):
+        return None
+    if LSN.match(lsn) is None:
+        return None
+    return lsn
+
 
 class TransactionManager(object):
     """Transaction manager for storing the managed transaction in the
@@ -20,21 +38,32 @@ class TransactionManager(object):
         self._pool = None
         self._db_conn = None
         self.request = None
+        # Position of the WAL after the last commit, with read replicas
+        self.last_lsn = None
 
     async def root(self):
         return await self._txn.get(ROOT_ID)
 
-    async def begin(self, request=None):
+    async def begin(self, request=None, read_only=None):
         """Starts a new transaction.
-        """
 
-        self._db_conn = await self._storage.open()
+        Read only transactions (by default the ones of safe http methods)
+        do not get a connection until they need to load something.
+        """
 
         if request is None:
             if self.request is None:
                 self.request = get_current_request()
             request = self.request
 
+        if read_only is None:
+            read_only = getattr(request, 'method', None) in SAFE_VERBS
+
+        if read_only:
+            self._db_conn = None
+        else:
+            self._db_conn = await self._storage.open()
+
         user = get_authenticated_user_id(request)
         if self._txn is not None:
             if self._pool is None:
@@ -42,10 +71,13 @@ class TransactionManager(object):
             # Save the actual transaction and start a new one
             self._pool.put(self._txn)
 
-        self._txn = txn = Transaction(self, request=request)
+        self._txn = txn = Transaction(self, request=request, read_only=read_only)
 
         # CACHE!!
 
+        if read_only:
+            txn.min_lsn = get_min_lsn(request)
+
         if user is not None:
             txn.user = user
         await txn.tpc_begin(self._db_conn)
@@ -58,7 +90,8 @@ class TransactionManager(object):
         txn = self.get()
         if txn is not None:
             await txn.commit()
-        await self._storage.close(txn._db_conn)
+            await self.release(txn)
+            self.last_lsn = txn.lsn
         self._txn = None
         self._db_conn = None
         if self._pool is not None and self._pool.qsize():
@@ -71,13 +104,19 @@ class TransactionManager(object):
         txn = self.get()
         if txn is not None:
             await txn.abort()
-        await self._storage.close(txn._db_conn)
+            await self.release(txn)
         self._txn = None
         self._db_conn = None
         if self._pool is not None and self._pool.qsize():
             self._txn = self._pool.get_nowait()
             self._db_conn = self._txn._db_conn
 
+    async def release(self, txn):
+        """Give back the connection of the transaction to the pool"""
+        if txn._db_conn is not None:
+            await self._storage.close(txn._db_conn)
+            txn._db_conn = None
+
     def get(self):
         """Return the current request specific transaction
         """
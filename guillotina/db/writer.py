@@ -1,5 +1,6 @@
 from guillotina import configure
 from guillotina.component import queryAdapter
+from guillotina.db.codecs import get_codec
 from guillotina.db.interfaces import IPartition
 from guillotina.db.interfaces import IWriter
 from guillotina.db.orm.interfaces import IBaseObject
@@ -7,8 +8,6 @@ from guillotina.interfaces import ICatalogDataAdapter
 from guillotina.interfaces import IResource
 from guillotina.utils import get_class_dotted_name
 
-import pickle
-
 
 @configure.adapter(
     for_=(IBaseObject),
@@ -24,6 +23,9 @@ class Writer(object):
     async def get_json(self):
         return None
 
+    def catalog_fingerprint(self):
+        return None
+
     @property
     def of(self):
         return getattr(self._obj, '__of__', None)
@@ -38,15 +40,15 @@ class Writer(object):
 
     @property
     def part(self):
-        of = self.of
-        if of is not None:
-            writer = Writer(of)
-            return writer.part
-        return None
+        # annotations are stored in the partition of their object, which
+        # is set on them when they are loaded or added
+        return getattr(self._obj, '_v_part', None)
 
-    def serialize(self):
+    def serialize(self, codec=None):
         if self._obj is not None:
-            return pickle.dumps(self._obj, protocol=pickle.HIGHEST_PROTOCOL)
+            if codec is None:
+                codec = get_codec('pickle')
+            return codec.encode(self._obj)
         else:
             return None
 
@@ -87,3 +89,10 @@ class ResourceWriter(Writer):
         adapter = queryAdapter(self._obj, ICatalogDataAdapter)
         if adapter is not None:
             return await adapter()
+
+    def catalog_fingerprint(self):
+        """Fingerprint of the catalog data, if the adapter can tell it"""
+        adapter = queryAdapter(self._obj, ICatalogDataAdapter)
+        fingerprint = getattr(adapter, 'fingerprint', None)
+        if fingerprint is not None:
+            return fingerprint()
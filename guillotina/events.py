@@ -4,6 +4,7 @@ from guillotina.interfaces import IBeforeObjectRemovedEvent
 from guillotina.interfaces import IFileFinishUploaded
 from guillotina.interfaces import INewUserAdded
 from guillotina.interfaces import IObjectAddedEvent
+from guillotina.interfaces import IObjectCopiedEvent
 from guillotina.interfaces import IObjectModifiedEvent
 from guillotina.interfaces import IObjectMovedEvent
 from guillotina.interfaces import IObjectPermissionsModifiedEvent
@@ -50,6 +51,17 @@ class BeforeObjectAddedEvent(ObjectAddedEvent):
     pass
 
 
+@implementer(IObjectCopiedEvent)
+class ObjectCopiedEvent(ObjectAddedEvent):
+    """An object has been added as the copy of another one"""
+
+    def __init__(self, object, original, new_parent=None, new_name=None,
+                 descendants=(), data=None):
+        ObjectAddedEvent.__init__(self, object, new_parent, new_name, data=data)
+        self.original = original
+        self.descendants = descendants
+
+
 @implementer(IObjectRemovedEvent)
 class ObjectRemovedEvent(ObjectMovedEvent):
     """An object has been removed from a container"""
@@ -28,6 +28,7 @@ from .events import IBeforeObjectRemovedEvent  # noqa
 from .events import IFileFinishUploaded  # noqa
 from .events import INewUserAdded  # noqa
 from .events import IObjectAddedEvent  # noqa
+from .events import IObjectCopiedEvent  # noqa
 from .events import IObjectModifiedEvent  # noqa
 from .events import IObjectMovedEvent  # noqa
 from .events import IObjectPermissionsModifiedEvent  # noqa
@@ -105,6 +106,10 @@ DEFAULT_WRITE_PERMISSION = 'guillotina.ManageContent'
 
 SHARED_CONNECTION = False
 WRITING_VERBS = ['POST', 'PUT', 'PATCH', 'DELETE']
+SAFE_VERBS = ['GET', 'HEAD', 'OPTIONS']
+# Position of the WAL after the last commit of a client, to read its own
+# writes from replicas
+LSN_HEADER = 'X-Guillotina-Lsn'
 SUBREQUEST_METHODS = ['get', 'delete', 'head', 'options', 'patch', 'put']
 
 ACTIVE_LAYERS_KEY = 'guillotina.registry.ILayers.active_layers'
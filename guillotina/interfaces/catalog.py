@@ -9,6 +9,9 @@ class ICatalogUtility(Interface):
     def get_object_by_uuid(site, uid):
         pass
 
+    def get_objects_by_uuids(site, uids):
+        pass
+
     def get_by_type(site, type_id):
         pass
 
@@ -26,9 +26,10 @@ class IAsyncContainer(Interface):
         asynchronously get subobject
         """
 
-    async def async_keys():
+    async def async_keys(start_after=None, limit=None):
         """
-        asynchronously get keys for sub objects
+        asynchronously get keys for sub objects, sorted by key after
+        start_after and up to limit if any of them is provided
         """
 
     async def async_del(name):
@@ -36,9 +37,10 @@ class IAsyncContainer(Interface):
         asynchronously delete sub object
         """
 
-    async def async_items():
+    async def async_items(start_after=None, limit=None):
         """
-        asynchronously get items
+        asynchronously get items, sorted by key after start_after and up to
+        limit if any of them is provided
         """
 
     async def async_len():
@@ -20,6 +20,15 @@ class IObjectAddedEvent(IObjectMovedEvent):
     """An object has been added to a container."""
 
 
+class IObjectCopiedEvent(IObjectAddedEvent):
+    """An object has been added as the copy of another one."""
+
+    original = Attribute("The copied object.")
+    descendants = Attribute(
+        "Records of the copies of the resources below the object, with their "
+        "catalog data.")
+
+
 class IObjectRemovedEvent(IObjectMovedEvent):
     """An object has been removed from a container."""
 
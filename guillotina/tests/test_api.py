@@ -106,6 +106,50 @@ async def test_create_delete_contenttype(site_requester):
         assert status == 200
 
 
+async def test_move_and_copy(site_requester):
+    async with await site_requester as requester:
+        for path, type_, id_ in (('/', 'Folder', 'folder1'), ('/', 'Folder', 'folder2'),
+                                 ('/folder1', 'Folder', 'sub'),
+                                 ('/folder1/sub', 'Item', 'item')):
+            response, status = await requester(
+                'POST', '/db/guillotina' + path,
+                data=json.dumps({"@type": type_, "id": id_}))
+            assert status == 201
+
+        response, status = await requester(
+            'POST', '/db/guillotina/folder1/@copy',
+            data=json.dumps({"destination": "/folder2", "new_id": "copy"}))
+        assert status == 201
+        assert response['@id'].endswith('/db/guillotina/folder2/copy')
+        response, status = await requester('GET', '/db/guillotina/folder2/copy/sub/item')
+        assert status == 200
+        copied = response['UID']
+        response, status = await requester('GET', '/db/guillotina/folder1/sub/item')
+        assert response['UID'] != copied
+
+        response, status = await requester(
+            'POST', '/db/guillotina/folder1/sub/@move',
+            data=json.dumps({"destination": "/folder2"}))
+        assert status == 200
+        response, status = await requester('GET', '/db/guillotina/folder2/sub/item')
+        assert status == 200
+        response, status = await requester('GET', '/db/guillotina/folder1/sub')
+        assert status == 404
+        response, status = await requester('GET', '/db/guillotina/folder1')
+        assert response['length'] == 0
+        response, status = await requester('GET', '/db/guillotina/folder2')
+        assert response['length'] == 2
+
+        for path, data, expected in (
+                ('/folder2/@move', {"destination": "/folder2/sub"}, 412),
+                ('/folder2/sub/@copy', {"destination": "/folder2"}, 409),
+                ('/folder2/sub/@move', {"destination": "/folder3"}, 412),
+                ('/folder2/sub/@move', {}, 400)):
+            response, status = await requester(
+                'POST', '/db/guillotina' + path, data=json.dumps(data))
+            assert status == expected
+
+
 async def test_register_registry(site_requester):
     async with await site_requester as requester:
         response, status = await requester(
@@ -233,3 +277,32 @@ async def test_get_addons(site_requester):
             'GET', '/db/guillotina/@addons'
         )
         assert status == 200
+
+
+async def test_items_pagination(site_requester):
+    async with await site_requester as requester:
+        for idx in range(5):
+            response, status = await requester(
+                'POST', '/db/guillotina/',
+                data=json.dumps({'@type': 'Item', 'id': 'item{}'.format(idx)}))
+            assert status == 201
+
+        ids = []
+        cursor = ''
+        for _ in range(3):
+            response, status = await requester(
+                'GET', '/db/guillotina/@items',
+                params={'page_size': 2, 'cursor': cursor})
+            assert status == 200
+            ids.extend(item['@id'].split('/')[-1] for item in response['items'])
+            cursor = response['cursor']
+            if cursor is None:
+                break
+        assert ids == ['item0', 'item1', 'item2', 'item3', 'item4']
+        assert cursor is None
+
+        request = utils.get_mocked_request(requester.db)
+        root = await utils.get_root(request)
+        site = await root.async_get('guillotina')
+        assert await site.async_keys(start_after='item2', limit=1) == ['item3']
+        await request._tm.abort()
@@ -0,0 +1,112 @@
+from guillotina.db import ROOT_ID
+from guillotina.db.cache import NOT_CACHED
+from guillotina.db.cache import ObjectCache
+
+import time
+
+
+def _record(oid, tid=1, size=10, type_='Item'):
+    return {
+        'zoid': oid,
+        'tid': tid,
+        'state_size': size,
+        'type': type_,
+        'state': b'x' * size
+    }
+
+
+def test_cache_policy():
+    cache = ObjectCache(policies={'Folder': 0})
+    assert not cache.set('a', _record('a'))
+    assert cache.set('b', _record('b'), default=0)
+    assert cache.set('c', _record('c', type_='Folder'))
+    assert 'a' not in cache
+    assert cache.get('b') is not None
+    assert cache.get('c') is not None
+    assert cache.hits == 2
+
+
+def test_cache_ttl():
+    cache = ObjectCache()
+    cache.set('a', _record('a'), default=60)
+    assert cache.get('a') is not None
+    cache._entries['a'] = cache._entries['a'][:2] + (time.time() - 1,)
+    assert cache.get('a') is None
+    assert cache.size == 0
+
+
+def test_cache_evicts_lru_by_size():
+    cache = ObjectCache(max_size=30)
+    for oid in ('a', 'b', 'c'):
+        cache.set(oid, _record(oid), default=0)
+    cache.get('a')
+    cache.set('d', _record('d'), default=0)
+    assert 'b' not in cache
+    assert 'a' in cache
+    assert cache.size == 30
+    assert cache.evictions == 1
+    assert not cache.set('e', _record('e', size=31), default=0)
+
+
+def test_cache_invalidation_by_tid():
+    cache = ObjectCache()
+    cache.set('a', _record('a', tid=1), default=0)
+    cache.invalidate('a', 2)
+    assert 'a' not in cache
+    # a reader that loaded the old version can not put it back
+    assert not cache.set('a', _record('a', tid=1), default=0)
+    assert cache.set('a', _record('a', tid=2), default=0)
+    assert not cache.set('a', _record('a', tid=1), default=0)
+    assert cache.get('a')['tid'] == 2
+
+
+async def test_transaction_uses_cache(dummy_txn_root):
+    async with await dummy_txn_root as root:
+        txn = root._p_jar
+        cache = txn._manager._storage._cache
+        assert ROOT_ID in cache
+        hits = cache.hits
+        await txn.get(ROOT_ID)
+        assert cache.hits == hits + 1
+
+
+def test_cache_children():
+    cache = ObjectCache(max_children=2)
+    generation = cache.generation
+    assert cache.get_child('p', 'a') is NOT_CACHED
+    assert cache.set_child('p', 'a', _record('a', tid=1), generation)
+    assert cache.set_child('p', 'missing', None, generation)
+    assert cache.get_child('p', 'a') == 'a'
+    assert cache.get_child('p', 'missing') is None
+    assert cache.tids() == {'a': 1}
+
+    # the child changed
+    cache.invalidate('a', 2)
+    assert cache.get_child('p', 'a') is NOT_CACHED
+    assert not cache.set_child('p', 'a', _record('a', tid=1), generation)
+
+    # a commit added children to p
+    cache.invalidate_children('p')
+    assert cache.get_child('p', 'missing') is NOT_CACHED
+    # a transaction that began before can not put back what it found
+    assert not cache.set_child('p', 'missing', None, generation)
+    assert cache.set_child('p', 'missing', None, cache.generation)
+
+    for id in ('b', 'c'):
+        cache.set_child('p', id, _record(id), cache.generation)
+    assert cache.get_child('p', 'missing') is NOT_CACHED
+    assert cache.stats()['children'] == 2
+
+
+def test_cache_invalidate_below():
+    cache = ObjectCache()
+    cache.set('folder', dict(_record('folder'), parent_id='deleted'), default=0)
+    cache.set('item', dict(_record('item'), parent_id='folder'), default=0)
+    cache.set('note', dict(_record('note'), of='item'), default=0)
+    cache.set('other', dict(_record('other'), parent_id=ROOT_ID), default=0)
+    # records of children do not have their parent
+    cache.set('child', _record('child'), default=0)
+    cache.set_child('item', 'child', _record('child'), cache.generation)
+    cache.invalidate_below(['deleted'])
+    assert len(cache) == 1
+    assert 'other' in cache
@@ -0,0 +1,108 @@
+from guillotina.behaviors.dublincore import IMarkerDublinCore
+from guillotina.content import create_content
+from guillotina.db.codecs import decode
+from guillotina.db.codecs import get_codec
+from guillotina.db.codecs import StateCodecError
+from guillotina.db.compression import Compressor
+from guillotina.db.compression import is_compressed
+from guillotina.db.dummy import DummyStorage
+from guillotina.db.interfaces import IWriter
+from guillotina.interfaces import Allow
+from guillotina.interfaces import IItem
+from guillotina.interfaces import IPrincipalRoleManager
+
+import os
+import pickle
+import pytest
+
+
+async def _item():
+    parent = await create_content('Folder', id='folder', title='Folder')
+    ob = await create_content('Item', id='foobar', title='A title')
+    ob.__parent__ = parent
+    IPrincipalRoleManager(ob).assign_role_to_principal('guillotina.Reader', 'user')
+    ob.tags = ['one', 'two']
+    return ob
+
+
+async def test_compact_codec_roundtrip(dummy_request):
+    ob = await _item()
+    state = IWriter(ob).serialize(get_codec('compact'))
+    assert state[0] == get_codec('compact').tag
+    assert len(state) < len(IWriter(ob).serialize())
+
+    # values with special values inside are kept as they are
+    ob.dates = [ob.created]
+    state = IWriter(ob).serialize(get_codec('compact'))
+
+    loaded = decode(state)
+    assert loaded.__name__ == 'foobar'
+    assert loaded.title == 'A title'
+    assert loaded.created == ob.created
+    assert loaded.tags == ['one', 'two']
+    assert loaded.dates == [ob.created]
+    assert IItem.providedBy(loaded)
+    assert IMarkerDublinCore.providedBy(loaded)
+    assert loaded.__parent__.title == 'Folder'
+    roles = IPrincipalRoleManager(loaded)
+    assert roles.get_setting('guillotina.Reader', 'user') is Allow
+    assert roles.get_principals_for_role('guillotina.Reader') == [('user', Allow)]
+
+
+async def test_states_of_both_codecs_are_readable(dummy_request):
+    ob = await _item()
+    for name in ('pickle', 'compact'):
+        state = get_codec(name).encode(ob)
+        assert decode(state).title == 'A title'
+    with pytest.raises(StateCodecError):
+        decode(b'\x00')
+
+
+async def test_compact_codec_layouts(dummy_request):
+    codec = get_codec('compact')
+    ob = await create_content('Item', id='foobar', title='A title')
+    state = codec.encode(ob)
+    values = pickle.loads(state[1:])
+    layout, fingerprint = codec.get_layout('Item')
+    assert values[2] == fingerprint
+    assert 'title' not in values[5]
+
+    # a state written with a layout that is not known any more
+    old_layout = ('__name__', 'title')
+    old = pickle.dumps((
+        'guillotina.content.Item', 'Item', 1, ['foobar', 'A title'], {}, {}))
+    with pytest.raises(StateCodecError):
+        decode(bytes((codec.tag,)) + old)
+    layout, fingerprint = codec.register_layout(old_layout)
+    old = pickle.dumps((
+        'guillotina.content.Item', 'Item', fingerprint, ['foobar', 'A title'], {}, {}))
+    assert decode(bytes((codec.tag,)) + old).title == 'A title'
+
+
+async def test_storage_codec_by_type():
+    storage = DummyStorage(type_codecs={'Item': 'compact'})
+    assert storage.get_codec('Item').name == 'compact'
+    assert storage.get_codec('Folder').name == 'pickle'
+    with pytest.raises(StateCodecError):
+        DummyStorage(codec='foobar')
+
+
+async def test_compressor(dummy_request):
+    compressor = Compressor(threshold=100, executor_size=1000)
+    ob = await create_content('Item', id='foobar', title='A title ' * 200)
+    state = IWriter(ob).serialize()
+    assert await compressor.compress(state[:50]) == state[:50]
+    random = os.urandom(200)
+    assert await compressor.compress(random) == random
+    assert compressor.skipped == 1
+
+    # large enough to run in the executor
+    compressed = await compressor.compress(state)
+    assert is_compressed(compressed)
+    assert len(compressed) < len(state)
+    assert await compressor.decompress(compressed) == state
+    assert decode(compressed).title == ob.title
+
+    stats = compressor.stats()
+    assert stats['compressed'] == stats['decompressed'] == 1
+    assert stats['ratio'] == len(compressed) / len(state)
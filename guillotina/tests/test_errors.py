@@ -1,4 +1,10 @@
 # -*- coding: utf-8 -*-
+from guillotina import app_settings
+from guillotina.db.transaction import Transaction
+from guillotina.exceptions import ConflictError
+from guillotina.traversal import CONFLICT_STATS
+
+import json
 
 
 async def test_non_existing_site(site_requester):
@@ -18,3 +24,48 @@ async def test_non_existing_type(site_requester):
         response, status = await requester('GET', '/db/guillotina/@types/non')
         assert status == 400
         assert response['error']['type'] == 'ViewError'
+
+
+async def test_conflict_is_retried(site_requester, monkeypatch):
+    tpc_vote = Transaction.tpc_vote
+    conflicts = []
+
+    async def conflict_once(txn):
+        if not conflicts:
+            conflicts.append(txn)
+            raise ConflictError(txn, None)
+        await tpc_vote(txn)
+
+    async with await site_requester as requester:
+        monkeypatch.setattr(Transaction, 'tpc_vote', conflict_once)
+        retries = CONFLICT_STATS['retries']
+        response, status = await requester(
+            'POST', '/db/guillotina/',
+            data=json.dumps({'@type': 'Item', 'id': 'item1'}))
+        assert status == 201
+        assert len(conflicts) == 1
+        assert CONFLICT_STATS['retries'] == retries + 1
+        monkeypatch.undo()
+
+        response, status = await requester('GET', '/db/@stats')
+        assert status == 200
+        assert response['conflicts']['retries'] == retries + 1
+        assert response['conflicts'] == CONFLICT_STATS
+        assert 'hits' in response['cache']
+
+
+async def test_conflict_without_attempts_left(site_requester, monkeypatch):
+    async def conflict(txn):
+        raise ConflictError(txn, None)
+
+    async with await site_requester as requester:
+        monkeypatch.setattr(Transaction, 'tpc_vote', conflict)
+        monkeypatch.setitem(app_settings['conflict_retry'], 'attempts', 1)
+        failures = CONFLICT_STATS['failures']
+        response, status = await requester(
+            'POST', '/db/guillotina/',
+            data=json.dumps({'@type': 'Item', 'id': 'item1'}))
+        assert status == 409
+        assert response['error']['type'] == 'ConflictDB'
+        assert CONFLICT_STATS['failures'] == failures + 1
+        monkeypatch.undo()
@@ -0,0 +1,166 @@
+from guillotina.annotations import AnnotationData
+from guillotina.content import create_content
+from guillotina.db import ROOT_ID
+from guillotina.db.db import GuillotinaDB
+from guillotina.db.memory import MemoryStorage
+from guillotina.db.transaction_manager import TransactionManager
+from guillotina.exceptions import ConflictError
+from guillotina.interfaces import IAnnotations
+from guillotina.tests.utils import get_mocked_request
+
+import pytest
+import time
+
+
+async def _storage(**kwargs):
+    storage = MemoryStorage(**kwargs)
+    await storage.initialize()
+    db = GuillotinaDB(storage)
+    await db.initialize()
+    return storage
+
+
+async def _begin(storage, read_only=False):
+    tm = TransactionManager(storage)
+    await tm.begin(request=get_mocked_request(), read_only=read_only)
+    return tm
+
+
+async def test_memory_storage_snapshots(dummy_request):
+    storage = await _storage()
+    tm = await _begin(storage)
+    root = await tm.root()
+    await root.async_set('folder', await create_content('Folder', id='folder', title='One'))
+    await tm.commit()
+
+    reader = await _begin(storage, read_only=True)
+    tm = await _begin(storage)
+    folder = await (await tm.root()).async_get('folder')
+    folder.title = 'Two'
+    folder._p_register()
+    await folder.async_set('item', await create_content('Item', id='item'))
+    await tm.commit()
+
+    # the reader keeps seeing the database as it was when it began
+    folder = await (await reader.root()).async_get('folder')
+    assert folder.title == 'One'
+    assert await folder.async_len() == 0
+    assert await folder.async_get('item') is None
+    await reader.abort()
+
+    reader = await _begin(storage, read_only=True)
+    folder = await (await reader.root()).async_get('folder')
+    assert folder.title == 'Two'
+    assert await folder.async_keys() == ['item']
+    await reader.abort()
+
+    # old versions are dropped when no transaction sees them
+    assert len(storage._versions[folder._p_oid]) == 1
+    assert storage._snapshots == {}
+
+
+async def test_memory_storage_conflicts(dummy_request):
+    storage = await _storage()
+    tm = await _begin(storage)
+    root = await tm.root()
+    await root.async_set('folder', await create_content('Folder', id='folder'))
+    await tm.commit()
+
+    first = await _begin(storage)
+    second = await _begin(storage)
+    for tm, title in ((first, 'First'), (second, 'Second')):
+        folder = await (await tm.root()).async_get('folder')
+        folder.title = title
+        folder._p_register()
+    await first.commit()
+    with pytest.raises(ConflictError):
+        await second.commit()
+    await second.abort()
+    assert not storage._get_lock().locked()
+
+    # deleting an object changed after the transaction began
+    first = await _begin(storage)
+    second = await _begin(storage)
+    folder = await (await first.root()).async_get('folder')
+    folder.title = 'Third'
+    folder._p_register()
+    folder = await (await second.root()).async_get('folder')
+    second.get().delete(folder)
+    await first.commit()
+    with pytest.raises(ConflictError):
+        await second.commit()
+    await second.abort()
+
+
+async def test_memory_storage_deletes_children(dummy_request):
+    storage = await _storage(eager_annotations=True)
+    tm = await _begin(storage)
+    root = await tm.root()
+    folder = await create_content('Folder', id='folder')
+    await root.async_set('folder', folder)
+    await folder.async_set('item', await create_content('Item', id='item'))
+    await tm.commit()
+
+    tm = await _begin(storage)
+    txn = tm.get()
+    folder = await (await tm.root()).async_get('folder')
+    txn.delete(folder)
+    await tm.commit()
+    assert list(storage._versions) == [ROOT_ID]
+    assert list(storage._members) == [('parent', None)]
+
+
+async def test_memory_storage_latency(dummy_request):
+    storage = await _storage(latency=0.02)
+    tm = await _begin(storage)
+    txn = tm.get()
+    start = time.time()
+    await storage.load(txn, ROOT_ID)
+    assert time.time() - start >= 0.02
+    await tm.abort()
+
+
+async def test_memory_storage_copy_and_move(dummy_request):
+    storage = await _storage()
+    tm = await _begin(storage)
+    root = await tm.root()
+    folder = await create_content('Folder', id='folder')
+    await root.async_set('folder', folder)
+    await root.async_set('target', await create_content('Folder', id='target'))
+    item = await create_content('Item', id='item', title='Item')
+    await folder.async_set('item', item)
+    note = AnnotationData()
+    note['text'] = 'note'
+    await IAnnotations(item).async_set('note', note)
+    await tm.commit()
+
+    tm = await _begin(storage)
+    txn = tm.get()
+    root = await tm.root()
+    folder = await root.async_get('folder')
+    target = await root.async_get('target')
+    copy, descendants = await txn.copy(folder, target, 'copy')
+    assert copy.id == 'copy'
+    assert copy._p_oid != folder._p_oid
+    assert [record['type'] for record in descendants] == ['Item']
+    await tm.commit()
+
+    tm = await _begin(storage)
+    txn = tm.get()
+    root = await tm.root()
+    target = await root.async_get('target')
+    item = await (await target.async_get('copy')).async_get('item')
+    assert item.title == 'Item'
+    assert item._p_oid == descendants[0]['zoid']
+    assert (await IAnnotations(item).async_get('note'))['text'] == 'note'
+    folder = await root.async_get('folder')
+    txn.move(folder, target, 'moved')
+    await tm.commit()
+
+    tm = await _begin(storage, read_only=True)
+    root = await tm.root()
+    assert await root.async_keys() == ['target']
+    target = await root.async_get('target')
+    assert sorted(await target.async_keys()) == ['copy', 'moved']
+    assert await (await target.async_get('moved')).async_keys() == ['item']
+    await tm.abort()
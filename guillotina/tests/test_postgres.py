@@ -1,13 +1,43 @@
+from aiohttp.test_utils import make_mocked_request
+from guillotina.annotations import AnnotationData
+from guillotina.catalog.index import remove_object
+from guillotina.commands.export import export_tree
+from guillotina.commands.export import ExportError
+from guillotina.commands.export import import_tree
+from guillotina.component import getUtility
+from guillotina.content import create_content
 from guillotina.db import ROOT_ID
+from guillotina.db import storage
+from guillotina.db.cache import NOT_CACHED
+from guillotina.db.codecs import get_codec
+from guillotina.db.compression import Compressor
+from guillotina.db.compression import is_compressed
+from guillotina.db.db import GuillotinaDB
 from guillotina.db.db import Root
 from guillotina.db.dummy import DummyStorage
 from guillotina.db.interfaces import IWriter
 from guillotina.db.reader import reader
 from guillotina.db.storage import APgStorage
+from guillotina.db.storage import COMMIT_STRATEGIES
+from guillotina.db.storage import GET_ANNOTATION
+from guillotina.db.storage import GET_CHILD
+from guillotina.db.storage import PARTITION_QUERIES
 from guillotina.db.transaction import Transaction
 from guillotina.db.transaction_manager import TransactionManager
+from guillotina.exceptions import ConflictError
+from guillotina.factory.content import Database
+from guillotina.interfaces import IAnnotations
+from guillotina.interfaces import IApplication
+from guillotina.interfaces import LSN_HEADER
+from guillotina.tests.utils import get_mocked_request
 
+import asyncio
+import asyncpg
+import json
 import pytest
+import sys
+import ujson
+import zlib
 
 
 async def cleanup(aps):
@@ -92,3 +122,966 @@ async def _test_pg_txn(postgres, guillotina_main):
     obj2 = reader(result)
     assert obj.__name__ == obj2.__name__
     await cleanup(aps)
+
+
+@pytest.mark.parametrize('strategy', COMMIT_STRATEGIES)
+async def test_store_many_objects_in_one_commit(postgres, guillotina_main, strategy):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    db._db.storage._commit_strategy = strategy
+    request = get_mocked_request(db)
+    txn = await request._tm.begin(request=request)
+    folder = await create_content('Folder', id='batch')
+    await (await request._tm.root()).async_set('batch', folder)
+    for idx in range(50):
+        item = await create_content('Item', id='item{}'.format(idx))
+        await folder.async_set(item.id, item)
+    await request._tm.commit()
+
+    txn = await request._tm.begin(request=request)
+    folder = await (await request._tm.root()).async_get('batch')
+    assert await folder.async_len() == 50
+    items = [ob async for _, ob in folder.async_items()]
+    for ob in items[:10]:
+        txn.delete(ob)
+    await request._tm.commit()
+
+    txn = await request._tm.begin(request=request)
+    folder = await (await request._tm.root()).async_get('batch')
+    assert await folder.async_len() == 40
+    txn.delete(folder)
+    await request._tm.commit()
+
+
+async def test_prepared_statements_reused_across_transactions(postgres, guillotina_main):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    statements = db._db.storage._statements
+    request = get_mocked_request(db)
+    # the commits of the setup prepare their statements too
+    misses = statements.stats()['misses']
+    for _ in range(3):
+        await request._tm.begin(request=request)
+        await (await request._tm.root()).async_len()
+        await request._tm.abort()
+    stats = statements.stats()
+    # NEXT_TID, GET_OID and NUM_CHILDS at most once per connection
+    assert stats['misses'] - misses <= stats['connections'] * 3
+    assert stats['hits'] >= 1
+
+
+async def test_read_only_transaction_gets_connection_lazily(postgres, guillotina_main):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    request = get_mocked_request(db)
+    txn = await request._tm.begin(request=request, read_only=True)
+    assert txn._db_conn is None
+    await (await request._tm.root()).async_len()
+    assert txn._db_conn is not None
+    await request._tm.abort()
+    assert txn._db_conn is None
+
+
+async def test_concurrent_commits_get_their_own_tid(postgres, guillotina_main):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+
+    async def add(idx):
+        request = get_mocked_request(db)
+        txn = await request._tm.begin(request=request)
+        item = await create_content('Item', id='concurrent{}'.format(idx))
+        await (await request._tm.root()).async_set(item.id, item)
+        await request._tm.commit()
+        return txn._tid
+
+    tids = await asyncio.gather(*[add(idx) for idx in range(5)])
+    assert len(set(tids)) == 5
+
+    request = get_mocked_request(db)
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    for idx in range(5):
+        txn.delete(await container.async_get('concurrent{}'.format(idx)))
+    await request._tm.commit()
+
+
+@pytest.mark.parametrize('strategy', COMMIT_STRATEGIES)
+async def test_commit_conflict(postgres, guillotina_main, strategy):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    db._db.storage._commit_strategy = strategy
+    request = get_mocked_request(db)
+    await request._tm.begin(request=request)
+    folder = await create_content('Folder', id='conflict')
+    await (await request._tm.root()).async_set('conflict', folder)
+    await request._tm.commit()
+
+    request2 = get_mocked_request(db)
+    await request._tm.begin(request=request)
+    await request2._tm.begin(request=request2)
+    folder = await (await request._tm.root()).async_get('conflict')
+    folder2 = await (await request2._tm.root()).async_get('conflict')
+    folder.title = 'First'
+    folder._p_register()
+    await request._tm.commit()
+    folder2.title = 'Second'
+    folder2._p_register()
+    with pytest.raises(ConflictError):
+        await request2._tm.commit()
+    await request2._tm.abort()
+
+    txn = await request._tm.begin(request=request)
+    folder = await (await request._tm.root()).async_get('conflict')
+    assert folder.title == 'First'
+    txn.delete(folder)
+    await request._tm.commit()
+
+
+async def test_get_many(postgres, guillotina_main):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    request = get_mocked_request(db)
+    await request._tm.begin(request=request)
+    folder = await create_content('Folder', id='many')
+    await (await request._tm.root()).async_set('many', folder)
+    oids = []
+    for idx in range(5):
+        item = await create_content('Item', id='item{}'.format(idx))
+        await folder.async_set(item.id, item)
+        oids.append(item._p_oid)
+    await request._tm.commit()
+
+    storage = db._db.storage
+    storage._cache.clear()
+    txn = await request._tm.begin(request=request)
+    oids.reverse()
+    objects = await txn.get_many(oids + ['missing'])
+    assert [ob.id for ob in objects] == [
+        'item4', 'item3', 'item2', 'item1', 'item0']
+    txn.delete(await (await request._tm.root()).async_get('many'))
+    await request._tm.commit()
+
+
+async def test_read_only_transactions_use_replicas(postgres, guillotina_main):
+    dsn = "postgres://postgres:@localhost:5432/guillotina"
+    aps = APgStorage(dsn=dsn, name='db', replica_dsns=[dsn])
+    await aps.initialize()
+    replica = aps._replica_pools[0]
+    tm = TransactionManager(aps)
+
+    txn = await tm.begin(request=make_mocked_request('GET', '/'))
+    await aps.last_transaction(txn)
+    assert aps._replica_conns[txn._db_conn] is replica
+    await tm.abort()
+    assert aps._replica_conns == {}
+
+    # the replica does not have the last write of the client yet
+    request = make_mocked_request('GET', '/', headers={LSN_HEADER: 'FFFFFFFF/0'})
+    txn = await tm.begin(request=request)
+    assert txn.min_lsn == 'FFFFFFFF/0'
+    await aps.last_transaction(txn)
+    assert txn._db_conn not in aps._replica_conns
+    await tm.abort()
+
+    txn = await tm.begin(request=make_mocked_request('POST', '/'))
+    assert txn._db_conn not in aps._replica_conns
+    await tm.abort()
+
+    # the missing children read on a replica are not cached
+    await tm.begin(request=make_mocked_request('GET', '/'))
+    assert await (await tm.root()).async_get('missing') is None
+    assert aps._cache.get_child(ROOT_ID, 'missing') is NOT_CACHED
+    await tm.abort()
+    await tm.begin(request=make_mocked_request('POST', '/'))
+    assert await (await tm.root()).async_get('missing') is None
+    assert aps._cache.get_child(ROOT_ID, 'missing') is None
+    await tm.abort()
+    await aps.finalize()
+
+
+def parse_lsn(lsn):
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+async def test_replica_token_follows_commit_order(postgres, guillotina_main, monkeypatch):
+    dsn = "postgres://postgres:@localhost:5432/guillotina"
+    aps = APgStorage(dsn=dsn, name='db', replica_dsns=[dsn], invalidation_channel=None)
+    await aps.initialize()
+    first, second = TransactionManager(aps), TransactionManager(aps)
+    second_committed = asyncio.Event()
+    tpc_finish = aps.tpc_finish
+
+    async def finish_after_second(txn):
+        # the first commit takes its tid before the second one, but is
+        # only visible after it
+        if txn is first.get():
+            await second_committed.wait()
+        return await tpc_finish(txn)
+
+    monkeypatch.setattr(aps, 'tpc_finish', finish_after_second)
+
+    async def add(tm, name):
+        request = get_mocked_request()
+        tm.request = request  # so get_current_request can find it...
+        txn = await tm.begin(request=request)
+        item = await create_content('Item', id=name)
+        item.__parent__ = None
+        txn.register(item)
+        await tm.commit()
+        return txn, item
+
+    committing = asyncio.ensure_future(add(first, 'lsn-first'))
+    while first.get() is None or first.get()._tid is None:
+        assert not committing.done()
+        await asyncio.sleep(0.01)
+    second_txn, second_item = await add(second, 'lsn-second')
+    second_committed.set()
+    first_txn, first_item = await committing
+
+    assert first_txn._tid < second_txn._tid
+    assert parse_lsn(first.last_lsn) > parse_lsn(second.last_lsn)
+
+    # the replica is up to date with the last commit
+    request = make_mocked_request('GET', '/', headers={LSN_HEADER: first.last_lsn})
+    txn = await first.begin(request=request)
+    assert txn.min_lsn == first.last_lsn
+    await aps.last_transaction(txn)
+    assert txn._db_conn in aps._replica_conns
+    await first.abort()
+
+    txn = await first.begin(request=first.request)
+    txn.delete(await txn.get(first_item._p_oid))
+    txn.delete(await txn.get(second_item._p_oid))
+    await first.commit()
+    await aps.finalize()
+
+
+async def test_commits_invalidate_other_processes_cache(postgres, guillotina_main, monkeypatch):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    dsn = "postgres://postgres:@localhost:5432/guillotina"
+    other = APgStorage(dsn=dsn, name='db', poll_interval=3600)
+    await other.initialize()
+    tm = TransactionManager(other)
+    await tm.begin(request=make_mocked_request('GET', '/'))
+    await tm.root()
+    await tm.abort()
+    assert ROOT_ID in other._cache
+
+    request = get_mocked_request(db)
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    container._p_register()
+    await request._tm.commit()
+    for _ in range(20):
+        if ROOT_ID not in other._cache:
+            break
+        await asyncio.sleep(0.05)
+    assert ROOT_ID not in other._cache
+    assert other.notifications == 1
+
+    # a new child drops the children of its parent cached by the others
+    assert other._cache.set_child(ROOT_ID, 'notified', None, other._cache.generation)
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    await container.async_set('notified', await create_content('Item', id='notified'))
+    await request._tm.commit()
+    for _ in range(20):
+        if other._cache.get_child(ROOT_ID, 'notified') is NOT_CACHED:
+            break
+        await asyncio.sleep(0.05)
+    assert other._cache.get_child(ROOT_ID, 'notified') is NOT_CACHED
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    request._tm.get().delete(await container.async_get('notified'))
+    await request._tm.commit()
+
+    # a record changed while the listener was not connected
+    await tm.begin(request=make_mocked_request('GET', '/'))
+    await tm.root()
+    await tm.abort()
+    await other._listener.close()
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    container._p_register()
+    await request._tm.commit()
+    await other.listen()
+    assert ROOT_ID in other._cache
+    await other.check_cache()
+    assert ROOT_ID not in other._cache
+
+    # big caches are checked in batches
+    monkeypatch.setattr(storage, 'CHECK_OIDS', 1)
+    other._cache.clear()
+    for id in ('deleted1', 'deleted2'):
+        other._cache.set_child(ROOT_ID, id, {'zoid': id, 'tid': 1}, other._cache.generation)
+    await other.check_cache()
+    assert len(other._cache.tids()) == 1
+    await other.check_cache()
+    assert other._cache.tids() == {}
+
+    # more objects with new children than changed ones
+    monkeypatch.setattr(storage, 'NOTIFY_OIDS', 1)
+    txn = await tm.begin(request=make_mocked_request('POST', '/'))
+    (await tm.root())._p_register()
+    txn._to_invalidate_parents.update(('0' * 31 + '2', '0' * 31 + '3'))
+    await tm.commit()
+    cache = db._db.storage._cache
+    for _ in range(20):
+        if '0' * 31 + '3' in cache._invalidated_parents:
+            break
+        await asyncio.sleep(0.05)
+    assert '0' * 31 + '2' in cache._invalidated_parents
+    assert '0' * 31 + '3' in cache._invalidated_parents
+    await other.finalize()
+
+
+async def test_prefetch_path(postgres, guillotina_main, monkeypatch):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    request = get_mocked_request(db)
+    await request._tm.begin(request=request)
+    parent = await request._tm.root()
+    for id in ('a', 'b', 'c'):
+        folder = await create_content('Folder', id=id)
+        await parent.async_set(id, folder)
+        parent = folder
+    await request._tm.commit()
+
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    await txn.prefetch_path(container, ('a', 'b', 'c', '@view'))
+
+    async def get_child(*args):
+        raise AssertionError('path not prefetched')
+
+    monkeypatch.setattr(db._db.storage, 'get_child', get_child)
+    ob = container
+    for id in ('a', 'b', 'c'):
+        ob = await ob.async_get(id)
+        assert ob.id == id
+    # same as a missing child loaded from the storage
+    assert await ob.async_get('@view') is None
+    monkeypatch.undo()
+
+    txn.delete(await container.async_get('a'))
+    await request._tm.commit()
+
+
+async def test_child_cache(postgres, guillotina_main, monkeypatch):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    storage = db._db.storage
+    monkeypatch.setattr(storage._cache, '_policies', {'Folder': 0, 'Item': 0})
+    request = get_mocked_request(db)
+    await request._tm.begin(request=request)
+    folder = await create_content('Folder', id='hot')
+    await (await request._tm.root()).async_set('hot', folder)
+    await folder.async_set('item', await create_content('Item', id='item'))
+    await request._tm.commit()
+
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    await txn.prefetch_path(container, ('hot', 'item', '@view'))
+    folder = await container.async_get('hot')
+    assert (await folder.async_get('item')).id == 'item'
+    assert await folder.async_get('missing') is None
+    await request._tm.abort()
+
+    async def query(*args, **kwargs):
+        raise AssertionError('child not cached')
+    for name in ('get_child', 'get_child_annotated', 'get_path',
+                 'get_path_annotated', 'load', 'load_annotated'):
+        monkeypatch.setattr(storage, name, query)
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    await txn.prefetch_path(container, ('hot', 'item', '@view'))
+    folder = await container.async_get('hot')
+    assert (await folder.async_get('item')).id == 'item'
+    assert await folder.async_get('missing') is None
+    await request._tm.abort()
+    monkeypatch.undo()
+    monkeypatch.setattr(storage._cache, '_policies', {'Folder': 0, 'Item': 0})
+
+    # adding the missing child drops the negative entry
+    await request._tm.begin(request=request)
+    folder = await (await request._tm.root()).async_get('hot')
+    await folder.async_set('missing', await create_content('Item', id='missing'))
+    await request._tm.commit()
+    await request._tm.begin(request=request)
+    folder = await (await request._tm.root()).async_get('hot')
+    assert (await folder.async_get('missing')).id == 'missing'
+    # and moving a child drops its entry
+    request._tm.get().move(await folder.async_get('item'), folder, 'moved')
+    await request._tm.commit()
+    txn = await request._tm.begin(request=request)
+    folder = await (await request._tm.root()).async_get('hot')
+    assert await folder.async_get('item') is None
+    assert (await folder.async_get('moved')).id == 'moved'
+    txn.delete(folder)
+    await request._tm.commit()
+
+
+async def test_compact_layouts_are_stored(postgres, guillotina_main, monkeypatch):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    storage = db._db.storage
+    codec = get_codec('compact')
+    monkeypatch.setattr(storage, '_type_codecs', {'Item': codec})
+    request = get_mocked_request(db)
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    await container.async_set('compact', await create_content(
+        'Item', id='compact', title='Compact'))
+    await request._tm.commit()
+    layout, fingerprint = codec.get_layout('Item')
+    assert fingerprint in storage._layouts
+
+    # the schema changed in a process that does not know the old layout
+    monkeypatch.setattr(codec, '_fingerprints', {})
+    monkeypatch.setattr(codec, '_layouts', {})
+    codec._layouts['Item'] = codec.register_layout(layout + ('new_field',))
+    storage._cache.clear()
+    txn = await request._tm.begin(request=request)
+    item = await (await request._tm.root()).async_get('compact')
+    assert item.title == 'Compact'
+    assert codec.layouts()[fingerprint] == layout
+    txn.delete(item)
+    await request._tm.commit()
+
+
+async def test_compressed_states(postgres, guillotina_main, monkeypatch):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    storage = db._db.storage
+    compressor = Compressor(threshold=1024, executor_size=1 << 16)
+    monkeypatch.setattr(storage, '_compressor', compressor)
+    request = get_mocked_request(db)
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    title = 'A large title ' * 10000
+    for id, item_title in (('small', 'Small'), ('large', title)):
+        await container.async_set(id, await create_content('Item', id=id, title=item_title))
+    await request._tm.commit()
+    assert compressor.stats()['ratio'] < 0.1
+
+    conn = await storage.open()
+    states = {
+        row['id']: row['state'] for row in await conn.fetch(
+            "SELECT id, state FROM objects WHERE id IN ('small', 'large')")}
+    await storage.close(conn)
+    assert is_compressed(states['large'])
+    assert not is_compressed(states['small'])
+
+    storage._cache.clear()
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    assert (await container.async_get('large')).title == title
+    assert (await container.async_get('small')).title == 'Small'
+    assert compressor.decompressed == 1
+    txn.delete(await container.async_get('large'))
+    txn.delete(await container.async_get('small'))
+    await request._tm.commit()
+
+
+async def test_catalog_json_fingerprint(postgres, guillotina_main, monkeypatch):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    storage = db._db.storage
+    request = get_mocked_request(db)
+
+    async def get_json():
+        conn = await storage.open()
+        value = await conn.fetchval("SELECT json FROM objects WHERE id = 'item'")
+        await storage.close(conn)
+        return value if value is None else json.loads(value)
+
+    async def edit(**values):
+        await request._tm.begin(request=request)
+        item = await (await request._tm.root()).async_get('item')
+        for name, value in values.items():
+            setattr(item, name, value)
+        item._p_register()
+        await request._tm.commit()
+
+    await request._tm.begin(request=request)
+    item = await create_content('Item', id='item', title='Item')
+    await (await request._tm.root()).async_set('item', item)
+    await request._tm.commit()
+    assert (await get_json())['title'] == 'Item'
+
+    # not indexed
+    skipped = storage.json_skipped
+    await edit(foo='bar')
+    assert storage.json_skipped == skipped + 1
+    assert (await get_json())['title'] == 'Item'
+
+    await edit(title='Changed')
+    assert storage.json_skipped == skipped + 1
+    assert (await get_json())['title'] == 'Changed'
+
+    monkeypatch.setattr(storage, '_store_json', False)
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    request._tm.get().delete(await container.async_get('item'))
+    await container.async_set('item', await create_content('Item', id='item', title='Item'))
+    await request._tm.commit()
+    assert await get_json() is None
+
+    await request._tm.begin(request=request)
+    request._tm.get().delete(await (await request._tm.root()).async_get('item'))
+    await request._tm.commit()
+
+
+@pytest.mark.parametrize('strategy', COMMIT_STRATEGIES)
+async def test_partitioned_storage(postgres, guillotina_main, strategy):
+    conn = await asyncpg.connect(dsn="postgres://postgres:@localhost:5432/guillotina")
+    await conn.execute('DROP DATABASE IF EXISTS guillotina_partitions')
+    await conn.execute('CREATE DATABASE guillotina_partitions')
+    await conn.close()
+    aps = APgStorage(
+        dsn="postgres://postgres:@localhost:5432/guillotina_partitions",
+        name='partitioned', commit_strategy=strategy, invalidation_channel=None,
+        partitioning=True)
+    await aps.initialize()
+    assert aps.partitioned
+    db = Database('partitioned', GuillotinaDB(aps, database_name='partitioned'))
+    await db._db.initialize()
+    request = get_mocked_request(db)
+
+    async def parts():
+        conn = await aps.open()
+        records = await conn.fetch('SELECT id, part FROM objects')
+        await aps.close(conn)
+        return {r['id']: r['part'] for r in records}
+
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    tenants = {}
+    for id in ('tenant1', 'tenant2'):
+        tenant = tenants[id] = await create_content('Folder', id=id)
+        await container.async_set(id, tenant)
+        folder = await create_content('Folder', id=id + '-folder')
+        await tenant.async_set(folder.id, folder)
+        item = await create_content('Item', id=id + '-item')
+        await folder.async_set(item.id, item)
+        note = AnnotationData()
+        note['text'] = id
+        await IAnnotations(item).async_set(id + '-note', note)
+    tenant3 = await create_content('Folder', id='tenant3')
+    tenant3.parent_datasource = 7
+    await container.async_set('tenant3', tenant3)
+    await request._tm.commit()
+
+    stored = await parts()
+    assert stored[None] == 0
+    part1 = zlib.crc32(tenants['tenant1']._p_oid.encode('utf-8'))
+    for id in ('tenant1', 'tenant1-folder', 'tenant1-item', 'tenant1-note'):
+        assert stored[id] == part1
+    assert stored['tenant2-item'] != part1
+    assert stored['tenant3'] == 7
+    partitions = {p['part']: p for p in await aps.get_partitions()}
+    assert set(partitions) == {0, part1, stored['tenant2'], 7}
+    assert partitions[7]['name'] == 'objects_7'
+
+    # queries below a tenant only look at its partition
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    tenant = await container.async_get('tenant1')
+    assert txn.partition(container) is None
+    assert txn.partition(tenant) == part1
+    folder = await tenant.async_get('tenant1-folder')
+    assert await folder.async_keys() == ['tenant1-item']
+    assert await folder.async_len() == 1
+    item = await folder.async_get('tenant1-item')
+    assert (await IAnnotations(item).async_get('tenant1-note'))['text'] == 'tenant1'
+    statements = aps._statements._statements[txn._db_conn._con]
+    assert PARTITION_QUERIES[GET_CHILD] in statements
+    assert PARTITION_QUERIES[GET_ANNOTATION] in statements
+
+    # a tenant moved to another partition
+    tenant2 = await container.async_get('tenant2')
+    tenant2.parent_datasource = 7
+    tenant2._p_register()
+    # children and annotations are deleted with their parent by the vacuum
+    txn.delete(tenant)
+    await request._tm.commit()
+    await aps.vacuum()
+    stored = await parts()
+    assert stored['tenant2'] == 7
+    for id in ('tenant1', 'tenant1-folder', 'tenant1-item', 'tenant1-note'):
+        assert id not in stored
+
+    # moved and copied objects take everything below them to their partition
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    tenant3 = await container.async_get('tenant3')
+    folder = await create_content('Folder', id='tenant3-folder')
+    await tenant3.async_set(folder.id, folder)
+    item = await create_content('Item', id='tenant3-item')
+    await folder.async_set(item.id, item)
+    note = AnnotationData()
+    note['text'] = 'tenant3'
+    await IAnnotations(item).async_set('tenant3-note', note)
+    tenant4 = await create_content('Folder', id='tenant4')
+    tenant4.parent_datasource = 8
+    await container.async_set('tenant4', tenant4)
+    await request._tm.commit()
+
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    tenant3 = await container.async_get('tenant3')
+    tenant4 = await container.async_get('tenant4')
+    folder = await tenant3.async_get('tenant3-folder')
+    copy, descendants = await txn.copy(folder, tenant4, 'tenant4-copy')
+    assert [r['json']['path'] for r in descendants] == ['/tenant4/tenant4-copy/tenant3-item']
+    txn.move(folder, tenant4, 'tenant4-folder')
+    await request._tm.commit()
+    conn = await aps.open()
+    records = await conn.fetch(
+        'SELECT part FROM objects WHERE id = ANY($1)',
+        ['tenant4-folder', 'tenant4-copy', 'tenant3-item', 'tenant3-note'])
+    await aps.close(conn)
+    assert [r['part'] for r in records] == [8] * 6
+
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    tenant4 = await container.async_get('tenant4')
+    assert sorted(await tenant4.async_keys()) == ['tenant4-copy', 'tenant4-folder']
+    item = await (await tenant4.async_get('tenant4-copy')).async_get('tenant3-item')
+    assert (await IAnnotations(item).async_get('tenant3-note'))['text'] == 'tenant3'
+    note = await IAnnotations(item).async_get('tenant3-note')
+    await request._tm.abort()
+
+    # objects loaded by oid keep their partition, their parents are not loaded
+    txn = await request._tm.begin(request=request)
+    for ob in await txn.get_many([item._p_oid, note._p_oid]):
+        ob._p_register()
+    await request._tm.commit()
+    conn = await aps.open()
+    records = await conn.fetch(
+        'SELECT part FROM objects WHERE zoid = ANY($1)', [item._p_oid, note._p_oid])
+    await aps.close(conn)
+    assert [r['part'] for r in records] == [8] * 2
+
+    await db._db.finalize()
+    conn = await asyncpg.connect(dsn="postgres://postgres:@localhost:5432/guillotina")
+    await conn.execute('DROP DATABASE guillotina_partitions')
+    await conn.close()
+
+
+async def test_eager_annotations(postgres, guillotina_main, monkeypatch):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    storage = db._db.storage
+    request = get_mocked_request(db)
+    await request._tm.begin(request=request)
+    folder = await create_content('Folder', id='folder')
+    await (await request._tm.root()).async_set('folder', folder)
+    item = await create_content('Item', id='item')
+    await folder.async_set('item', item)
+    for key in ('one', 'two'):
+        note = AnnotationData()
+        note['text'] = key
+        await IAnnotations(item).async_set(key, note)
+    await request._tm.commit()
+
+    async def get_annotation(*args, **kwargs):
+        raise AssertionError('annotation not loaded with its object')
+
+    monkeypatch.setattr(storage, 'eager_annotations', True)
+    monkeypatch.setattr(storage, 'get_annotation', get_annotation)
+
+    async def check(ob):
+        annotations = IAnnotations(ob)
+        assert (await annotations.async_get('one'))['text'] == 'one'
+        assert (await annotations.async_get('two'))['text'] == 'two'
+        with pytest.raises(KeyError):
+            await annotations.async_get('three')
+
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    folder = await container.async_get('folder')
+    await check(await folder.async_get('item'))
+
+    # by oid
+    storage._cache.invalidate(item._p_oid)
+    await check(await txn.get(item._p_oid))
+
+    # by path
+    txn._path_records.clear()
+    await txn.prefetch_path(container, ('folder', 'item'))
+    folder = await container.async_get('folder')
+    assert await IAnnotations(folder).async_keys() == []
+    await check(await folder.async_get('item'))
+    with pytest.raises(KeyError):
+        await IAnnotations(folder).async_get('one')
+    monkeypatch.undo()
+
+    txn.delete(folder)
+    await request._tm.commit()
+
+
+@pytest.mark.parametrize('strategy', COMMIT_STRATEGIES)
+async def test_children_counts(postgres, guillotina_main, monkeypatch, strategy):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    storage = db._db.storage
+    monkeypatch.setattr(storage, '_commit_strategy', strategy)
+    request = get_mocked_request(db)
+
+    async def counts():
+        conn = await storage.open()
+        records = await conn.fetch(
+            "SELECT id, children FROM objects WHERE id IN ('one', 'two')")
+        await storage.close(conn)
+        return {r['id']: r['children'] for r in records}
+
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    for id in ('one', 'two'):
+        folder = await create_content('Folder', id=id)
+        await container.async_set(id, folder)
+    for idx in range(3):
+        item = await create_content('Item', id='item{}'.format(idx))
+        await folder.async_set(item.id, item)
+    await request._tm.commit()
+    assert await counts() == {'one': 0, 'two': 3}
+
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    one = await container.async_get('one')
+    two = await container.async_get('two')
+    await one.async_set('new', await create_content('Item', id='new'))
+    txn.delete(await two.async_get('item0'))
+    moved = await two.async_get('item1')
+    moved.__parent__ = one
+    moved._p_register()
+    edited = await two.async_get('item2')
+    edited.title = 'Edited'
+    edited._p_register()
+    await request._tm.commit()
+    assert await counts() == {'one': 2, 'two': 1}
+
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    one = await container.async_get('one')
+    assert await one.async_len() == 2
+
+    # approximate
+    monkeypatch.setattr(storage, '_children_count', 'approximate')
+    assert await one.async_len() == 2
+    monkeypatch.setattr(storage, '_approximate_threshold', 0)
+    assert isinstance(await one.async_len(), int)
+    monkeypatch.setattr(storage, '_children_count', 'counter')
+    await request._tm.abort()
+
+    conn = await storage.open()
+    await conn.execute("UPDATE objects SET children = 10 WHERE id = 'one'")
+    await conn.execute("UPDATE objects SET children = NULL WHERE id = 'two'")
+    await storage.close(conn)
+    assert await storage.repair_children_counts() >= 2
+    assert await counts() == {'one': 2, 'two': 1}
+
+    # commits that lock the same parents in another order
+    requests = [get_mocked_request(db), get_mocked_request(db)]
+    for other, (locked, parent) in zip(requests, (('one', 'two'), ('two', 'one'))):
+        txn = await other._tm.begin(request=other)
+        container = await other._tm.root()
+        locked = await container.async_get(locked)
+        await txn._db_conn.execute(
+            'SELECT 1 FROM objects WHERE zoid = $1 FOR UPDATE', locked._p_oid)
+        parent = await container.async_get(parent)
+        await parent.async_set('locked', await create_content('Item', id='locked'))
+    results = await asyncio.gather(
+        *[other._tm.commit() for other in requests], return_exceptions=True)
+    assert len([r for r in results if isinstance(r, ConflictError)]) == 1
+    for other, result in zip(requests, results):
+        if isinstance(result, ConflictError):
+            await other._tm.abort()
+
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    txn.delete(await container.async_get('one'))
+    txn.delete(await container.async_get('two'))
+    await request._tm.commit()
+
+
+async def test_instrumented_pool(postgres, guillotina_main):
+    dsn = "postgres://postgres:@localhost:5432/guillotina"
+    aps = APgStorage(dsn=dsn, name='db', pool_size=2, pool_min_size=1, pool_max_size=4,
+                     pool_long_hold=0.05, poll_interval=3600, pool_resize_interval=3600)
+    await aps.initialize()
+    pool = aps._pool
+    one = await aps.open()
+    two = await aps.open()
+    assert pool.in_use == 2
+
+    # the third one waits until a connection is released
+    waiting = asyncio.ensure_future(aps.open())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    assert pool.waiting == 1
+    await aps.close(one)
+    three = await waiting
+    assert pool.stats()['waits'] == 1
+    assert pool.stats()['max_wait'] >= 0.01
+
+    # connections had to be waited for
+    assert pool.resize() == 3
+    assert pool.resize() == 3
+    await aps.close(three)
+
+    class View(object):
+        request = make_mocked_request('GET', '/db/container/@slow')
+
+        async def __call__(self, conn):
+            await asyncio.sleep(0.05)
+            await aps.close(conn)
+
+    await View()(two)
+    stats = aps.pool_stats()['primary']
+    assert stats['in_use'] == 0
+    assert stats['max_in_use'] == 2
+    assert stats['acquires'] == stats['holds']
+    holds = {hold['path']: hold for hold in stats['long_holds']}
+    assert holds['GET /db/container/@slow']['count'] == 1
+    assert holds['GET /db/container/@slow']['max'] >= 0.05
+
+    # two were in use after the last resize, none since then
+    assert pool.resize() == 3
+    assert pool.resize() == 2
+    assert pool.resize() == 1
+    assert pool.resize() == 1
+    async with pool.acquire() as conn:
+        assert await conn.fetchval('SELECT 1') == 1
+    await aps.finalize()
+
+
+async def test_delete_subtree(postgres, guillotina_main, monkeypatch):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    storage = db._db.storage
+    monkeypatch.setattr(storage, '_vacuum_batch_size', 2)
+    request = get_mocked_request(db)
+
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    tree = await create_content('Folder', id='tree')
+    await container.async_set('tree', tree)
+    oids = [tree._p_oid]
+    parent = tree
+    for depth in range(3):
+        folder = await create_content('Folder', id='folder{}'.format(depth))
+        await parent.async_set(folder.id, folder)
+        item = await create_content('Item', id='item{}'.format(depth))
+        await folder.async_set(item.id, item)
+        note = AnnotationData()
+        note['text'] = 'note'
+        await IAnnotations(item).async_set('note', note)
+        oids.extend([folder._p_oid, item._p_oid, note._p_oid])
+        parent = folder
+    await request._tm.commit()
+
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    tree = await container.async_get('tree')
+    descendants = {r['path'] for r in await txn.get_descendants(tree)}
+    assert 'folder0/folder1/item1' in descendants
+    assert len(descendants) == 6
+
+    # the catalog gets the removal of everything below in one go
+    class Hook(object):
+        remove = []
+        index = {}
+
+    class View(object):
+        def __init__(self, request):
+            self.request = request
+
+        async def __call__(self):
+            await remove_object(tree, None)
+
+    monkeypatch.setattr(sys.modules[remove_object.__module__], 'get_hook', lambda: Hook)
+    await View(request)()
+    assert len(Hook.remove) == 7
+    assert ('/tree/folder0/item0' in [path for _, _, path in Hook.remove])
+
+    # the commit only moves the deleted object to the trash
+    monkeypatch.setattr(storage, 'schedule_vacuum', lambda: None)
+    monkeypatch.setitem(storage._cache._policies, 'Folder', 0)
+    monkeypatch.setitem(storage._cache._policies, 'Item', 0)
+    await txn.get_many(oids[1:3])
+    assert oids[2] in storage._cache
+    txn.delete(tree)
+    await request._tm.commit()
+    assert oids[1] not in storage._cache
+    assert oids[2] not in storage._cache
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    assert not await container.async_contains('tree')
+    # neither the objects below it until the trash is vacuumed
+    for oid in oids[:4]:
+        with pytest.raises(KeyError):
+            await txn.get(oid)
+    assert await txn.get_many(oids) == []
+    await request._tm.abort()
+
+    assert await storage.vacuum() == len(oids)
+    conn = await storage.open()
+    assert await conn.fetchval(
+        'SELECT count(*) FROM objects WHERE zoid = ANY($1)', oids) == 0
+    await storage.close(conn)
+
+
+async def test_export_import(postgres, guillotina_main, tmpdir):
+    root = getUtility(IApplication, name='root')
+    db = root['db']
+    request = get_mocked_request(db)
+
+    await request._tm.begin(request=request)
+    container = await request._tm.root()
+    source = await create_content('Folder', id='source', title='Source')
+    await container.async_set('source', source)
+    folder = await create_content('Folder', id='folder')
+    await source.async_set('folder', folder)
+    item = await create_content('Item', id='item', title='Item')
+    await folder.async_set('item', item)
+    note = AnnotationData()
+    note['text'] = 'note'
+    await IAnnotations(item).async_set('note', note)
+    target = await create_content('Folder', id='target')
+    await container.async_set('target', target)
+    await request._tm.commit()
+
+    filename = str(tmpdir.join('source.gz'))
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    source = await container.async_get('source')
+    assert await export_tree(txn, source, filename) == 4
+    target = await container.async_get('target')
+    imported = await import_tree(txn, filename, target, 'copy')
+    assert imported.title == 'Source'
+    assert imported._p_oid != source._p_oid
+    await request._tm.commit()
+
+    txn = await request._tm.begin(request=request)
+    container = await request._tm.root()
+    target = await container.async_get('target')
+    assert await target.async_keys() == ['copy']
+    assert await target.async_len() == 1
+    item = await (await (await target.async_get('copy')).async_get('folder')).async_get('item')
+    assert item.title == 'Item'
+    assert (await IAnnotations(item).async_get('note'))['text'] == 'note'
+    json = await txn._db_conn.fetchval(
+        'SELECT json FROM objects WHERE zoid = $1', item._p_oid)
+    assert ujson.loads(json)['path'] == '/target/copy/folder/item'
+
+    with open(filename, 'wb') as fi:
+        fi.write(b'foobar')
+    with pytest.raises(ExportError):
+        await import_tree(txn, filename, target)
+    for id in ('source', 'target'):
+        txn.delete(await container.async_get(id))
+    await request._tm.commit()
@@ -1,7 +1,44 @@
 # -*- coding: utf-8 -*-
+from guillotina.component import getGlobalSiteManager
+from guillotina.content import Item
+from guillotina.interfaces import IRequest
+from guillotina.interfaces import IResource
+from guillotina.traversal import FactoryCache
 from guillotina.traversal import TraversalRouter
+from zope.interface import Interface
+
+
+class IFactoryCacheTest(Interface):
+    pass
 
 
 def test_make_app(dummy_guillotina):
     assert dummy_guillotina is not None
     assert type(dummy_guillotina.router) == TraversalRouter
+
+
+def test_factory_cache(dummy_request):
+    cache = FactoryCache(max_size=2)
+    item = Item()
+    assert cache.query((item, dummy_request), IFactoryCacheTest, 'test') is None
+    assert len(cache.factories) == 1
+
+    # registering an adapter drops the cached lookups
+    registry = getGlobalSiteManager()
+
+    def factory(context, request):
+        return (context, request)
+    registry.registerAdapter(
+        factory, (IResource, IRequest), IFactoryCacheTest, 'test')
+    try:
+        assert cache.query((item, dummy_request), IFactoryCacheTest,
+                           'test') == (item, dummy_request)
+        assert cache.lookup((item, dummy_request), IFactoryCacheTest, 'test') is factory
+        assert len(cache.factories) == 1
+        cache.lookup((item, dummy_request), IFactoryCacheTest, 'other')
+        cache.lookup((item, dummy_request), IFactoryCacheTest, 'another')
+        assert len(cache.factories) == 1
+    finally:
+        registry.unregisterAdapter(
+            factory, (IResource, IRequest), IFactoryCacheTest, 'test')
+    assert cache.query((item, dummy_request), IFactoryCacheTest, 'test') is None
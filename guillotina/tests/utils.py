@@ -57,7 +57,10 @@ class FakeConnection(object):
         self.containments = {}
         self.refs = {}
 
-    async def contains(self, oid, key):
+    def partition(self, ob):
+        return None
+
+    async def contains(self, oid, key, part=None):
         oids = self.containments[oid]
         return key in [self.refs[oid].id for oid in oids]
 
@@ -13,8 +13,8 @@ from guillotina.auth.participation import AnonymousParticipation
 from guillotina.browser import ErrorResponse
 from guillotina.browser import Response
 from guillotina.browser import UnauthorizedResponse
+from guillotina.component import getSiteManager
 from guillotina.component import getUtility
-from guillotina.component import queryMultiAdapter
 from guillotina.component.interfaces import ISite
 from guillotina.contentnegotiation import content_type_negotiation
 from guillotina.contentnegotiation import language_negotiation
@@ -35,6 +35,7 @@ from guillotina.interfaces import IRequest
 from guillotina.interfaces import ITranslated
 from guillotina.interfaces import ITraversable
 from guillotina.interfaces import ITraversableView
+from guillotina.interfaces import LSN_HEADER
 from guillotina.interfaces import SUBREQUEST_METHODS
 from guillotina.interfaces import WRITING_VERBS
 from guillotina.registry import REGISTRY_DATA_KEY
@@ -45,11 +46,13 @@ from guillotina.utils import apply_cors
 from guillotina.utils import get_authenticated_user_id
 from guillotina.utils import import_class
 from zope.interface import alsoProvides
+from zope.interface import providedBy
 
 import aiohttp
 import asyncio
 import asyncpg
 import json
+import random
 import traceback
 import uuid
 
@@ -122,6 +125,12 @@ async def traverse(request, parent, path):
     if not ITraversable.providedBy(parent):
         # not a traversable context
         return parent, path
+
+    if len(path) > 1 and getattr(parent, '_p_jar', None) is not None:
+        # resolve the rest of the path in one go, the next async_get
+        # calls do not go to the database
+        await parent._p_jar.prefetch_path(parent, path)
+
     try:
         if path[0].startswith('_'):
             raise HTTPUnauthorized()
@@ -131,6 +140,8 @@ async def traverse(request, parent, path):
             context = parent[path[0]]
     except (TypeError, KeyError, AttributeError):
         return parent, path
+    if context is None:
+        return parent, path
 
     if IDatabase.providedBy(context):
         request._db_write_enabled = False
@@ -198,10 +209,68 @@ def generate_error_response(e, request, error, status=400):
     return ErrorResponse(
         error,
         message,
-        status
+        status=status
     )
 
 
+# Counters of the conflicts found committing write requests
+CONFLICT_STATS = {
+    'conflicts': 0,
+    'retries': 0,
+    'failures': 0
+}
+
+
+class FactoryCache:
+    """Adapter factories by the specifications of the objects they adapt
+
+    Resolving a request looks up the same translator, view and renderer
+    adapters for every resource type, layers, method and view name. They are
+    cached until an adapter is registered or unregistered. Names come from
+    the url, so the cache is emptied when it has max_size lookups.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.factories = {}
+        self.registry = self.generation = None
+
+    def lookup(self, objects, provided, name=''):
+        registry = getSiteManager().adapters
+        changed = registry is not self.registry or registry._generation != self.generation
+        if changed or len(self.factories) >= self.max_size:
+            self.factories = {}
+            self.registry = registry
+            self.generation = registry._generation
+        key = (tuple(providedBy(ob) for ob in objects), provided, name)
+        try:
+            return self.factories[key]
+        except KeyError:
+            factory = self.factories[key] = registry.lookup(key[0], provided, name)
+            return factory
+
+    def query(self, objects, provided, name='', default=None):
+        """Same as queryMultiAdapter, with the cached factory"""
+        factory = self.lookup(objects, provided, name)
+        if factory is None:
+            return default
+        result = factory(*objects)
+        if result is None:
+            return default
+        return result
+
+
+FACTORY_CACHE = FactoryCache()
+
+
+def can_replay(request):
+    """The view can only run again if the body was not consumed as a stream
+    """
+    if request._read_bytes is not None:
+        return True
+    return getattr(request.content, 'total_bytes', 0) == 0
+
+
 class MatchInfo(AbstractMatchInfo):
     """Function that returns from traversal request on aiohttp."""
 
@@ -217,29 +286,36 @@ class MatchInfo(AbstractMatchInfo):
     async def handler(self, request):
         """Main handler function for aiohttp."""
         if request.method in WRITING_VERBS:
-            try:
-                request._db_write_enabled = True
-                # We try to avoid collisions on the same instance of
-                # guillotina
-                view_result = await self.view()
-                if isinstance(view_result, ErrorResponse) or \
-                        isinstance(view_result, UnauthorizedResponse):
-                    # If we don't throw an exception and return an specific
-                    # ErrorReponse just abort
+            attempt = 0
+            while True:
+                try:
+                    request._db_write_enabled = True
+                    # We try to avoid collisions on the same instance of
+                    # guillotina
+                    view_result = await self.view()
+                    if isinstance(view_result, ErrorResponse) or \
+                            isinstance(view_result, UnauthorizedResponse):
+                        # If we don't throw an exception and return an specific
+                        # ErrorReponse just abort
+                        await abort(request)
+                    else:
+                        await commit(request)
+
+                except Unauthorized as e:
                     await abort(request)
-                else:
-                    await commit(request)
-
-            except Unauthorized as e:
-                await abort(request)
-                view_result = generate_unauthorized_response(e, request)
-            except ConflictError as e:
-                view_result = generate_error_response(
-                    e, request, 'ConflictDB', 409)
-            except Exception as e:
-                await abort(request)
-                view_result = generate_error_response(
-                    e, request, 'ServiceError')
+                    view_result = generate_unauthorized_response(e, request)
+                except ConflictError as e:
+                    await abort(request)
+                    if await self.retry(request, attempt):
+                        attempt += 1
+                        continue
+                    view_result = generate_error_response(
+                        e, request, 'ConflictDB', 409)
+                except Exception as e:
+                    await abort(request)
+                    view_result = generate_error_response(
+                        e, request, 'ServiceError')
+                break
         else:
             try:
                 view_result = await self.view()
@@ -263,6 +339,11 @@ class MatchInfo(AbstractMatchInfo):
         cors_headers.update(view_result.headers)
         view_result.headers = cors_headers
 
+        # Clients send it back to read their writes from replicas
+        lsn = getattr(getattr(request, '_tm', None), 'last_lsn', None)
+        if lsn is not None:
+            view_result.headers[LSN_HEADER] = lsn
+
         resp = await self.rendered(view_result)
         if not resp.prepared:
             await resp.prepare(request)
@@ -276,6 +357,30 @@ class MatchInfo(AbstractMatchInfo):
 
         return resp
 
+    async def retry(self, request, attempt):
+        """Prepare the view to be run again after a conflict
+
+        The request is resolved again, so the view gets a new transaction
+        and fresh objects. Returns False if there are no attempts left or
+        the body of the request can not be read again.
+        """
+        settings = app_settings['conflict_retry']
+        CONFLICT_STATS['conflicts'] += 1
+        if attempt >= settings['attempts'] or not can_replay(request):
+            CONFLICT_STATS['failures'] += 1
+            return False
+        CONFLICT_STATS['retries'] += 1
+        logger.info('Conflict on {path}, retrying ({attempt})'.format(
+            path=request.path, attempt=attempt + 1))
+        await asyncio.sleep(random.uniform(0, settings['backoff'] * 2 ** attempt))
+
+        request.security = None
+        match_info = await request.app.router.resolve(request)
+        self.resource = match_info.resource
+        self.view = match_info.view
+        self.rendered = match_info.rendered
+        return True
+
     def get_info(self):
         return {
             'request': self.request,
@@ -376,7 +481,7 @@ class TraversalRouter(AbstractRouter):
 
         await self.apply_authorization(request)
 
-        translator = queryMultiAdapter(
+        translator = FACTORY_CACHE.query(
             (language_object, resource, request),
             ITranslated)
         if translator is not None:
@@ -389,7 +494,7 @@ class TraversalRouter(AbstractRouter):
 
         # Site registry lookup
         try:
-            view = queryMultiAdapter(
+            view = FACTORY_CACHE.query(
                 (resource, request), method, name=view_name)
         except AttributeError:
             view = None
@@ -439,7 +544,7 @@ class TraversalRouter(AbstractRouter):
         renderer = content_type_negotiation(request, resource, view)
         renderer_object = renderer(request)
 
-        rendered = queryMultiAdapter(
+        rendered = FACTORY_CACHE.query(
             (renderer_object, view, request), IRendered)
 
         if rendered is not None:
@@ -84,7 +84,11 @@ setup(
             'guillotina = guillotina.commands.server:ServerCommand',
             'gcli = guillotina.commands.cli:CliCommand',
             'gshell = guillotina.commands.shell:ShellCommand',
-            'gcreate = guillotina.commands.create:CreateCommand'
+            'gcreate = guillotina.commands.create:CreateCommand',
+            'gpartitions = guillotina.commands.partitions:PartitionsCommand',
+            'gcounts = guillotina.commands.counts:CountsCommand',
+            'gexport = guillotina.commands.export:ExportCommand',
+            'gimport = guillotina.commands.export:ImportCommand'
         ]
     }
 )